@@ -10,39 +10,742 @@ remote machine will use the SCOClient to access SCO resources.
 """
 
 from abc import abstractmethod
+from collections import OrderedDict
 import logging
+import os
 from neuropythy.freesurfer import add_subject_path
 import shutil
 import tempfile
+import threading
 import scodata.modelrun as runs
 import scodata.funcdata as funcdata
-from scoworker.workflow import sco_run
+from scoworker.cache import directory_size
+from scoworker.metrics import Metrics
+from scoworker.plans import SharedValues, canonical_value
+from scoworker.pipeline import Pipeline
+from scoworker.handoff import HandOff
+from scoworker.isolation import run_isolated
+from scoworker.scratch import ScratchQuotaExceeded, estimate_scratch_size
+from scoworker.workflow import BackgroundTask, run_arguments, sco_compute, sco_evaluate, sco_render, sco_run, sco_sweep, varying_arguments
+
+
+class RunJob(object):
+    """Model run that is being executed by a worker. Keeps the handles for all
+    resources of the run and the outputs of the individual workflow stages.
+
+    Attributes
+    ----------
+    model_run : Model Run handle
+        Handle for model run resource
+    model : scoengine.ModelHandle
+        Descriptor for SCO model
+    subject : Subject handle
+        Handle for subject resource
+    image_group : Image group handle
+        Handle for image group resource
+    fmri_data : fMRI handle
+        Handle for functional MRI data (may be None)
+    output_dir : string
+        Temporal directory for run results
+    pinned : list(string)
+        Keys of pinned entries in the resource cache
+    request : scoengine.ModelRunRequest
+        Request for the model run
+    output : scoworker.workflow.ModelOutput
+        Output of the compute stage
+    prediction_file : string
+        Path to prediction file (output of render stage)
+    attachments : dict
+        Dictionary of attachments (output of render stage)
+    """
+    def __init__(self, model_run, model, subject, image_group, fmri_data, output_dir, pinned=None):
+        """Initialize the resource handles and the output directory.
+
+        Parameters
+        ----------
+        model_run : Model Run handle
+            Handle for model run resource
+        model : scoengine.ModelHandle
+            Descriptor for SCO model
+        subject : Subject handle
+            Handle for subject resource
+        image_group : Image group handle
+            Handle for image group resource
+        fmri_data : fMRI handle
+            Handle for functional MRI data (may be None)
+        output_dir : string
+            Temporal directory for run results
+        pinned : list(string), optional
+            Keys of pinned entries in the resource cache
+        """
+        self.model_run = model_run
+        self.model = model
+        self.subject = subject
+        self.image_group = image_group
+        self.fmri_data = fmri_data
+        self.output_dir = output_dir
+        self.pinned = pinned if not pinned is None else []
+        self.request = None
+        self.output = None
+        self.prediction_file = None
+        self.attachments = None
+
+
+class RequestGuard(object):
+    """Keep track of model run requests that are currently executed or that
+    have been completed recently by a worker. Used to skip redelivered
+    duplicates of requests without accessing the data store.
+
+    Attributes
+    ----------
+    active : set(string)
+        Keys of requests that are being executed
+    completed : collections.OrderedDict
+        Keys of recently completed requests (in order of completion)
+    history : int
+        Maximum number of completed requests that are remembered
+    """
+    def __init__(self, history=1000):
+        """Initialize the request sets.
+
+        Parameters
+        ----------
+        history : int, optional
+            Maximum number of completed requests that are remembered
+        """
+        self.history = history
+        self.active = set()
+        self.completed = OrderedDict()
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        """Mark a request as active. Returns False if the request is active or
+        has been completed already.
+
+        Parameters
+        ----------
+        key : string
+            Unique request key
+
+        Returns
+        -------
+        bool
+        """
+        with self.lock:
+            if key in self.active or key in self.completed:
+                return False
+            self.active.add(key)
+            return True
+
+    def end(self, key):
+        """Mark an active request as completed.
+
+        Parameters
+        ----------
+        key : string
+            Unique request key
+        """
+        with self.lock:
+            self.active.discard(key)
+            self.completed[key] = True
+            while len(self.completed) > self.history:
+                self.completed.popitem(last=False)
 
 
 class SCOWorker(object):
     """SCO worker executes the predictive SCO model. Different implementations
     for the worker may exists, e.g., local or remote worker.
     """
-    def __init__(self, env_subject):
+    def __init__(self, env_subject, render_processes=1, subject_cache=None, stimulus_cache=None, result_index=None, incremental=None, checkpoints=None, scratch=None, run_limits=None):
         """Initialize the environment path for 'average' subject fsaverage_sym.
 
         Parameters
         ----------
         env_subject : string
             Path to directory containing subject fsaverage_sym.
+        render_processes : int, optional
+            Number of processes used to render cortical images. Uses one
+            process per CPU if the value is smaller than one.
+        subject_cache : scoworker.plans.SubjectCache, optional
+            Cache for subject-level intermediate values of model runs
+        stimulus_cache : scoworker.plans.StimulusCache, optional
+            Cache for preprocessed stimulus images
+        result_index : scoworker.results.ResultIndex, optional
+            Index of results of previous runs. Runs with identical inputs are
+            served from the index without running the model.
+        incremental : scoworker.incremental.IncrementalCache, optional
+            Per-image results of previous runs. Only stimuli without cached
+            results are computed and rendered.
+        checkpoints : scoworker.checkpoints.CheckpointStore, optional
+            Checkpoints of model runs. Runs that are restarted on this host
+            resume from their checkpoint.
+        scratch : scoworker.scratch.ScratchSpace, optional
+            Scratch space for the output directories of model runs. Uses
+            temporary directories without quotas if not given.
+        run_limits : scoworker.isolation.RunLimits, optional
+            Run the model in a disposable child process with the given
+            resource limits
         """
         add_subject_path(env_subject)
+        self.render_processes = render_processes
+        self.subject_cache = subject_cache
+        self.stimulus_cache = stimulus_cache
+        self.result_index = result_index
+        self.incremental = incremental
+        self.checkpoints = checkpoints
+        self.scratch = scratch
+        self.run_limits = run_limits
+        # Wall times of workflow stages and other worker metrics
+        self.metrics = Metrics()
+        # Requests that are active or have been completed by this worker
+        self.guard = RequestGuard()
+        # Resources that are shared by the runs of a batch while the batch is
+        # being fetched (keyed by resource Url)
+        self.shared_resources = None
+
+    @abstractmethod
+    def abort(self, request, errors):
+        """Set the state of the model run for the given request to FAILED
+        without executing the run (e.g., if the process that was executing the
+        run crashed).
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+        errors : list(string)
+            List of error messages
+        """
+        pass
+
+    def check_output_dir(self, job):
+        """Raise ScratchQuotaExceeded if the output of a model run exceeds
+        the per-run scratch quota.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        """
+        if not self.scratch is None:
+            self.scratch.check(job.output_dir)
+
+    def checkpoint(self, job):
+        """Get the checkpoint for a model run.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+
+        Returns
+        -------
+        scoworker.checkpoints.Checkpoint
+            None if checkpoints are not used
+        """
+        if self.checkpoints is None or job.request is None:
+            return None
+        return self.checkpoints.checkpoint(request_key(job.request))
+
+    def cleanup(self, job):
+        """Remove the temporary output directory of a model run and release
+        all resources that are held by the run.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        """
+        self.release(job)
+        if self.scratch is None:
+            shutil.rmtree(job.output_dir, ignore_errors=True)
+        else:
+            size = self.scratch.release(job.output_dir)
+            self.metrics.observe('scratch_usage', size)
+            logging.info('Scratch usage %d bytes' % (size))
+        if not job.request is None:
+            self.guard.end(request_key(job.request))
+            # The run is either SUCCESS or FAILED
+            self.remove_checkpoint(job.request)
+
+    def compute(self, job, shared_values=None):
+        """Compute stage of a model run. Runs the model and computes the
+        prediction.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        shared_values : scoworker.plans.SharedValues, optional
+            Values that are shared with other runs of the same group (ignored
+            if runs are isolated)
+
+        Returns
+        -------
+        scoworker.RunJob
+        """
+        if not self.run_limits is None:
+            # Run the complete workflow in a child process. The render stage
+            # has nothing left to do.
+            job.prediction_file, job.attachments = run_isolated(
+                lambda: sco_run(
+                    job.model_run,
+                    job.model,
+                    job.subject,
+                    job.image_group,
+                    job.output_dir,
+                    fmri_data=job.fmri_data,
+                    render_processes=self.render_processes,
+                    subject_cache=self.subject_cache,
+                    stimulus_cache=self.stimulus_cache,
+                    result_index=self.result_index,
+                    incremental=self.incremental,
+                    checkpoint=self.checkpoint(job)
+                ),
+                limits=self.run_limits,
+                metrics=self.metrics
+            )
+            return job
+        job.output = sco_compute(
+            job.model_run,
+            job.model,
+            job.subject,
+            job.image_group,
+            job.output_dir,
+            fmri_data=job.fmri_data,
+            subject_cache=self.subject_cache,
+            stimulus_cache=self.stimulus_cache,
+            result_index=self.result_index,
+            shared_values=shared_values,
+            incremental=self.incremental,
+            checkpoint=self.checkpoint(job)
+        )
+        return job
+
+    def create_output_dir(self, image_group):
+        """Create the output directory for a model run. The directory is
+        allocated in the scratch space based on the estimated output size of
+        the run.
+
+        Parameters
+        ----------
+        image_group : Image group handle
+            Handle for image group resource of the run
+
+        Returns
+        -------
+        string
+            Path to output directory
+        """
+        if self.scratch is None:
+            return tempfile.mkdtemp()
+        return self.scratch.allocate(
+            estimate_scratch_size(len(image_group.images))
+        )
 
     @abstractmethod
+    def fail(self, job, ex):
+        """Set the state of a model run to FAILED after the compute or render
+        stage raised an exception.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        ex : Exception
+            Exception that was raised
+        """
+        pass
+
+    @abstractmethod
+    def fetch(self, request):
+        """Fetch stage of a model run. Gets the model run and all associated
+        resources and sets the run state to RUNNING. Sets the model run state
+        to FAILED if either of the resources does not exist.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+
+        Returns
+        -------
+        scoworker.RunJob
+            None if the model run cannot be executed
+        """
+        pass
+
+    def pipeline(self, depth=1):
+        """Create a pipeline that executes the stages of consecutive model
+        runs concurrently. Requests are submitted to the pipeline using
+        Pipeline.submit(). Raises ValueError if cortical images are rendered
+        by more than one process. A render pool cannot be forked safely while
+        the threads of the other stages are running.
+
+        Parameters
+        ----------
+        depth : int, optional
+            Maximum number of runs that wait in front of each stage
+
+        Returns
+        -------
+        scoworker.pipeline.Pipeline
+        """
+        if self.render_processes != 1:
+            raise ValueError('pipeline requires a single render process')
+        return Pipeline(
+            [
+                ('fetch', self.start),
+                ('compute', self.compute),
+                ('render', self.render),
+                ('upload', self.upload)
+            ],
+            depth=depth,
+            on_failure=self.stage_failed,
+            metrics=self.metrics
+        )
+
+    def release(self, job):
+        """Release resources that are held by a model run once the results
+        have been generated. Nothing to do by default.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        """
+        pass
+
+    def remove_checkpoint(self, request):
+        """Remove the checkpoint of a model run once the run is SUCCESS or
+        FAILED.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+        """
+        if not self.checkpoints is None:
+            self.checkpoints.remove(request_key(request))
+
+    def render(self, job):
+        """Render stage of a model run. Generates cortical images and exports
+        model outputs.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+
+        Returns
+        -------
+        scoworker.RunJob
+        """
+        if job.output is None:
+            # Results have been generated in an isolated child process
+            self.release(job)
+            self.check_output_dir(job)
+            return job
+        job.prediction_file, job.attachments = sco_render(
+            job.output,
+            render_processes=self.render_processes
+        )
+        # Model outputs are no longer needed
+        job.output = None
+        self.release(job)
+        self.check_output_dir(job)
+        return job
+
     def run(self, request):
         """Run SCO model for given request. Expects a model run request
         containing run and experiment identifier as well as run resource URL.
+        Executes all stages of the model run one after another.
 
         Parameters
         ----------
         request : scoengine.ModelRunRequest
             Object containing information about requested model run
         """
+        job = self.start(request)
+        if job is None:
+            return
+        # Make sure to catch all exceptions while running the model.
+        try:
+            self.compute(job)
+            self.render(job)
+        except Exception as ex:
+            logging.exception(ex)
+            self.fail(job, ex)
+            return
+        self.upload(job)
+
+    def run_batch(self, requests):
+        """Run a batch of model run requests. All requests are fetched first.
+        Runs are then grouped by subject and image group and the runs of each
+        group are executed one after another (see run_group()). Each run has
+        its own state transitions and result upload.
+
+        Parameters
+        ----------
+        requests : list(scoengine.ModelRunRequest)
+            Requests for model runs
+        """
+        groups = group_jobs(self.start_batch(requests))
+        for key in groups:
+            logging.info('Run group of %d run(s) for subject %s and image group %s' % (len(groups[key]), key[0], key[1]))
+            self.run_group(groups[key])
+
+    def run_group(self, jobs):
+        """Run a group of fetched model runs for the same subject and image
+        group. Runs of the same model share the values of all plan nodes that
+        do not depend on arguments whose values differ between the runs (e.g.,
+        subject setup and stimulus preprocessing), i.e., these values are only
+        computed by the first run.
+
+        Parameters
+        ----------
+        jobs : list(scoworker.RunJob)
+            Fetched model runs
+        """
+        shared = {}
+        for job in jobs:
+            model_id = job.model.identifier
+            if not model_id in shared:
+                shared[model_id] = SharedValues(varying_arguments(
+                    [j.model_run for j in jobs if j.model.identifier == model_id]
+                ))
+            # Make sure to catch all exceptions while running the model.
+            try:
+                self.compute(job, shared_values=shared[model_id])
+                self.render(job)
+            except Exception as ex:
+                logging.exception(ex)
+                self.fail(job, ex)
+                continue
+            self.upload(job)
+
+    def run_models(self, requests):
+        """Run a batch of model run requests for (possibly) different models.
+        All requests are fetched first. Runs are then grouped by subject, image
+        group, and functional data and the runs of each group are evaluated in
+        a single pass by sco_evaluate(), where values of plan nodes that the
+        models have in common are computed only once. Runs are executed in
+        groups (see run_group()) if runs are isolated. The result of each run
+        is uploaded to the respective model run.
+
+        Parameters
+        ----------
+        requests : list(scoengine.ModelRunRequest)
+            Requests for model runs
+        """
+        jobs = self.start_batch(requests)
+        if not self.run_limits is None:
+            groups = group_jobs(jobs)
+            for key in groups:
+                self.run_group(groups[key])
+            return
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault(experiment_key(job), []).append(job)
+        for key in groups:
+            group = groups[key]
+            logging.info('Evaluate %d model run(s) for subject %s and image group %s' % (len(group), key[0], key[1]))
+            results = sco_evaluate(
+                [job.model_run for job in group],
+                [job.model for job in group],
+                group[0].subject,
+                group[0].image_group,
+                [job.output_dir for job in group],
+                fmri_data=group[0].fmri_data,
+                render_processes=self.render_processes,
+                subject_cache=self.subject_cache,
+                stimulus_cache=self.stimulus_cache,
+                result_index=self.result_index
+            )
+            for job, result in zip(group, results):
+                if isinstance(result, Exception):
+                    self.fail(job, result)
+                    continue
+                job.prediction_file, job.attachments = result
+                try:
+                    self.check_output_dir(job)
+                except ScratchQuotaExceeded as ex:
+                    self.fail(job, ex)
+                    continue
+                self.upload(job)
+
+    def run_size(self, request):
+        """Get the number of stimulus images and the size of the subject
+        directory for a model run request. Used to estimate the resources that
+        are required by the run. The size is unknown by default.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+
+        Returns
+        -------
+        int, int
+            Number of images and size of subject directory in bytes or None if
+            unknown
+        """
+        return None
+
+    def run_sweep(self, requests):
+        """Run the model runs of a parameter sweep. The first request is the
+        base run of the sweep. All runs that use the same model, subject,
+        image group, and functional data as the base run are executed by
+        sco_sweep(), where each run overrides the base run arguments that it
+        differs in. All other runs (and all runs if runs are isolated) are
+        executed in groups (see run_group()). The result of each run is
+        uploaded to the respective model run.
+
+        Parameters
+        ----------
+        requests : list(scoengine.ModelRunRequest)
+            Requests for the model runs of the sweep
+        """
+        jobs = self.start_batch(requests)
+        if len(jobs) == 0:
+            return
+        base = jobs[0]
+        base_args = run_arguments(base.model_run)
+        sweep = []
+        others = []
+        for job in jobs:
+            args = run_arguments(job.model_run)
+            # A run can only be expressed by overrides if it has all base run
+            # arguments
+            if self.run_limits is None and same_inputs(base, job) and set(base_args).issubset(args):
+                overrides = {}
+                for attr in args:
+                    if not attr in base_args or canonical_value(args[attr]) != canonical_value(base_args[attr]):
+                        overrides[attr] = args[attr]
+                sweep.append((job, overrides))
+            else:
+                others.append(job)
+        logging.info('Run sweep of %d run(s) for model %s' % (len(sweep), base.model.identifier))
+        results = sco_sweep(
+            base.model_run,
+            base.model,
+            base.subject,
+            base.image_group,
+            [overrides for job, overrides in sweep],
+            [job.output_dir for job, overrides in sweep],
+            fmri_data=base.fmri_data,
+            render_processes=self.render_processes,
+            subject_cache=self.subject_cache,
+            stimulus_cache=self.stimulus_cache,
+            result_index=self.result_index
+        )
+        for i in range(len(sweep)):
+            job = sweep[i][0]
+            if isinstance(results[i], Exception):
+                self.fail(job, results[i])
+                continue
+            job.prediction_file, job.attachments = results[i]
+            try:
+                self.check_output_dir(job)
+            except ScratchQuotaExceeded as ex:
+                self.fail(job, ex)
+                continue
+            self.upload(job)
+        groups = group_jobs(others)
+        for key in groups:
+            self.run_group(groups[key])
+
+    def start(self, request):
+        """Fetch stage of a model run with a guard against duplicate requests.
+        Requests that are active or have been completed by this worker are
+        skipped (the message broker redelivers requests that have not been
+        acknowledged when a connection is lost).
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+
+        Returns
+        -------
+        scoworker.RunJob
+            None if the model run cannot be executed
+        """
+        key = request_key(request)
+        if not self.guard.begin(key):
+            logging.info('Skip duplicate request [' + key + ']')
+            return None
+        try:
+            job = self.fetch(request)
+        except Exception:
+            self.guard.end(key)
+            raise
+        if job is None:
+            self.guard.end(key)
+            return None
+        job.request = request
+        return job
+
+    def start_batch(self, requests):
+        """Fetch stage for a batch of model runs (see start()). Resources that
+        are shared by runs of the batch are only fetched once.
+
+        Parameters
+        ----------
+        requests : list(scoengine.ModelRunRequest)
+            Requests for model runs
+
+        Returns
+        -------
+        list(scoworker.RunJob)
+            Model runs that can be executed
+        """
+        jobs = []
+        self.shared_resources = dict()
+        try:
+            for request in requests:
+                job = self.start(request)
+                if not job is None:
+                    jobs.append(job)
+        finally:
+            self.shared_resources = None
+        return jobs
+
+    def stage_failed(self, stage, job, ex):
+        """Failure handler for the stages of a pipeline. The fetch stage
+        handles errors for missing resources itself and the upload stage
+        always cleans up after itself. Unexpected errors in the fetch stage
+        only release the request guard.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage that failed
+        job : scoengine.ModelRunRequest or scoworker.RunJob
+            Input of the failed stage
+        ex : Exception
+            Exception that was raised
+        """
+        if stage in ['compute', 'render']:
+            self.fail(job, ex)
+        elif stage == 'fetch':
+            self.guard.end(request_key(job))
+
+    @abstractmethod
+    def upload(self, job):
+        """Upload stage of a model run. Uploads the prediction file (setting
+        the run state to SUCCESS) and all attachments. Removes the temporary
+        output directory.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+
+        Returns
+        -------
+        scoworker.RunJob
+        """
         pass
 
 
@@ -51,7 +754,7 @@ class SCODataStoreWorker(SCOWorker):
     store. Uses and instance of the SCODataStore to access and manipulate SCO
     resources.
     """
-    def __init__(self, db, engine, env_subject):
+    def __init__(self, db, engine, env_subject, render_processes=1, subject_cache=None, stimulus_cache=None, result_index=None, incremental=None, checkpoints=None, scratch=None, run_limits=None, handoff=False):
         """Initialize the data store instance and average subject path.
 
         Parameters
@@ -62,20 +765,60 @@ class SCODataStoreWorker(SCOWorker):
             Registry of SCO models
         env_subject : string
             Path to directory containing subject fsaverage_sym.
+        render_processes : int, optional
+            Number of processes used to render cortical images
+        subject_cache : scoworker.plans.SubjectCache, optional
+            Cache for subject-level intermediate values of model runs
+        stimulus_cache : scoworker.plans.StimulusCache, optional
+            Cache for preprocessed stimulus images
+        result_index : scoworker.results.ResultIndex, optional
+            Index of results of previous runs. Runs with identical inputs are
+            served from the index without running the model.
+        incremental : scoworker.incremental.IncrementalCache, optional
+            Per-image results of previous runs. Only stimuli without cached
+            results are computed and rendered.
+        checkpoints : scoworker.checkpoints.CheckpointStore, optional
+            Checkpoints of model runs. Runs that are restarted on this host
+            resume from their checkpoint.
+        scratch : scoworker.scratch.ScratchSpace, optional
+            Scratch space for the output directories of model runs. Uses
+            temporary directories without quotas if not given.
+        run_limits : scoworker.isolation.RunLimits, optional
+            Run the model in a disposable child process with the given
+            resource limits
+        handoff : bool, optional
+            Hand off result files to the data store by hard links instead of
+            copies. Requires output directories on the same file system as
+            the data store (e.g., a scratch space in the staging area of the
+            data store directory).
         """
-        super(SCODataStoreWorker, self).__init__(env_subject)
+        super(SCODataStoreWorker, self).__init__(
+            env_subject,
+            render_processes=render_processes,
+            subject_cache=subject_cache,
+            stimulus_cache=stimulus_cache,
+            result_index=result_index,
+            incremental=incremental,
+            checkpoints=checkpoints,
+            scratch=scratch,
+            run_limits=run_limits
+        )
         self.db = db
         self.engine = engine
+        self.handoff = handoff
 
-    def run(self, request):
-        """Run SCO model for given request on a local instance of the SCO data
-        store. Expects a model run request containing run and experiment
-        identifier as well as run resource URL.
+    def fetch(self, request):
+        """Get the model run and all associated resources from the local
+        instance of the SCO data store (see SCOWorker.fetch()).
 
         Parameters
         ----------
         request : scoengine.ModelRunRequest
             Object containing information about requested model run
+
+        Returns
+        -------
+        scoworker.RunJob
         """
         # Get model run handler from database. Ensure that it is in state IDLE
         # or RUNNING.
@@ -87,12 +830,14 @@ class SCODataStoreWorker(SCOWorker):
             if model_run is None:
                 raise ValueError('unknown model run: ' + request.run_id + ':' + request.experiment_id)
             if not (model_run.state.is_idle or model_run.state.is_running):
-                raise ValueError('invalid run state: ' + str(model_run.state))
+                # Duplicate request for a run that has been completed already
+                logging.info('Skip model run in state ' + str(model_run.state) + ': ' + request.run_id + ':' + request.experiment_id)
+                return None
         except ValueError as ex:
             # In case of an exception return. No point in updating the state
             # of a non-existing model run
             logging.exception(ex)
-            return
+            return None
         # Get resources that are associated with the model run and necessary to
         # run the prediction. Raise ValueError (and set model run state to
         # FAILED) if either of the resources does not exist.
@@ -126,59 +871,114 @@ class SCODataStoreWorker(SCOWorker):
                 model_run.identifier,
                 [str(ex)]
             )
-            return
-        # Set run state to RUNNING (only if IDLE) and call generic run_sco
-        # workflow. Make sure to catch all exceptions.
+            return None
+        # Scratch directory for run results
+        try:
+            output_dir = self.create_output_dir(image_group)
+        except ScratchQuotaExceeded as ex:
+            logging.exception(ex)
+            self.abort(request, [str(ex)])
+            return None
+        # Set run state to RUNNING (only if IDLE)
         if model_run.state.is_idle:
             self.db.experiments_predictions_update_state_active(
                 model_run.experiment_id,
                 model_run.identifier
             )
-        # Temporal directory for run results
-        temp_dir = tempfile.mkdtemp()
+        return RunJob(
+            model_run,
+            model,
+            subject,
+            image_group,
+            fmri_data,
+            output_dir
+        )
+
+    def abort(self, request, errors):
+        """Set the state of a model run in the local data store to FAILED (see
+        SCOWorker.abort()).
+        """
+        self.db.experiments_predictions_update_state_error(
+            request.experiment_id,
+            request.run_id,
+            errors
+        )
+        self.remove_checkpoint(request)
+
+    def fail(self, job, ex):
+        """Set the state of a model run in the local data store to FAILED (see
+        SCOWorker.fail()).
+        """
+        model_run = job.model_run
+        # In case of an exception set run state to failed and return. The
+        # output directory is removed even if the state cannot be updated.
         try:
-            prediction_file, attachments = sco_run(
-                model_run,
-                model,
-                subject,
-                image_group,
-                temp_dir,
-                fmri_data=fmri_data
-            )
-        except Exception as ex:
-            logging.exception(ex)
-            # In case of an exception set run state to failed and return
             self.db.experiments_predictions_update_state_error(
                 model_run.experiment_id,
                 model_run.identifier,
                 [type(ex).__name__ + ': ' + str(ex)]
             )
-            return
-        # Update run state to success by uploading resoult file
-        self.db.experiments_predictions_update_state_success(
-            model_run.experiment_id,
-            model_run.identifier,
-            prediction_file
+        finally:
+            self.cleanup(job)
+
+    def run_size(self, request):
+        """Get the number of stimulus images and the size of the subject
+        directory from the local data store (see SCOWorker.run_size()).
+        """
+        model_run = self.db.experiments_predictions_get(
+            request.experiment_id,
+            request.run_id
         )
-        # Upload any attachments returned by the model run
-        for resource_id in attachments:
-            filename, mime_type = attachments[resource_id]
-            self.db.experiments_predictions_attachments_create(
-                model_run.experiment_id,
-                model_run.identifier,
-                resource_id,
-                filename,
-                mime_type=mime_type
-            )
-        # Clean-up
-        shutil.rmtree(temp_dir)
+        if model_run is None:
+            return None
+        experiment = self.db.experiments_get(model_run.experiment_id)
+        if experiment is None:
+            return None
+        subject = self.db.subjects_get(experiment.subject_id)
+        image_group = self.db.image_groups_get(experiment.image_group_id)
+        if subject is None or image_group is None:
+            return None
+        return len(image_group.images), directory_size(subject.data_directory)
+
+    def upload(self, job):
+        """Add results of a model run to the local data store (see
+        SCOWorker.upload()).
+        """
+        model_run = job.model_run
+        if self.handoff:
+            filenames = [job.prediction_file]
+            filenames += [job.attachments[r][0] for r in job.attachments]
+        else:
+            filenames = []
+        try:
+            with HandOff(filenames):
+                # Update run state to success by uploading resoult file
+                self.db.experiments_predictions_update_state_success(
+                    model_run.experiment_id,
+                    model_run.identifier,
+                    job.prediction_file
+                )
+                # Upload any attachments returned by the model run
+                for resource_id in job.attachments:
+                    filename, mime_type = job.attachments[resource_id]
+                    self.db.experiments_predictions_attachments_create(
+                        model_run.experiment_id,
+                        model_run.identifier,
+                        resource_id,
+                        filename,
+                        mime_type=mime_type
+                    )
+        finally:
+            # Clean-up
+            self.cleanup(job)
+        return job
 
 
 class SCOClientWorker(SCOWorker):
     """Implementation for SCO worker that uses the SCO client to access and
     create resources.
     """
-    def __init__(self, sco, env_subject):
+    def __init__(self, sco, env_subject, render_processes=1, subject_cache=None, stimulus_cache=None, result_index=None, incremental=None, checkpoints=None, scratch=None, run_limits=None, resource_cache=None, uploader=None):
         """Initialize the SCO client instance and average subject path.
 
         Parameters
@@ -187,50 +987,100 @@ class SCOClientWorker(SCOWorker):
             Connection to SCO data store via SCO client
         env_subject : string
             Path to directory containing subject fsaverage_sym.
+        render_processes : int, optional
+            Number of processes used to render cortical images
+        subject_cache : scoworker.plans.SubjectCache, optional
+            Cache for subject-level intermediate values of model runs
+        stimulus_cache : scoworker.plans.StimulusCache, optional
+            Cache for preprocessed stimulus images
+        result_index : scoworker.results.ResultIndex, optional
+            Index of results of previous runs. Runs with identical inputs are
+            served from the index without running the model.
+        incremental : scoworker.incremental.IncrementalCache, optional
+            Per-image results of previous runs. Only stimuli without cached
+            results are computed and rendered.
+        checkpoints : scoworker.checkpoints.CheckpointStore, optional
+            Checkpoints of model runs. Runs that are restarted on this host
+            resume from their checkpoint.
+        scratch : scoworker.scratch.ScratchSpace, optional
+            Scratch space for the output directories of model runs. Uses
+            temporary directories without quotas if not given.
+        run_limits : scoworker.isolation.RunLimits, optional
+            Run the model in a disposable child process with the given
+            resource limits
+        resource_cache : scoworker.resources.ResourceCache, optional
+            Index of downloaded resources in the data directory of the SCO
+            client
+        uploader : scoworker.uploads.Uploader, optional
+            Upload attachments concurrently and retry uploads that fail with a
+            transport error
         """
-        super(SCOClientWorker, self).__init__(env_subject)
+        super(SCOClientWorker, self).__init__(
+            env_subject,
+            render_processes=render_processes,
+            subject_cache=subject_cache,
+            stimulus_cache=stimulus_cache,
+            result_index=result_index,
+            incremental=incremental,
+            checkpoints=checkpoints,
+            scratch=scratch,
+            run_limits=run_limits
+        )
         self.sco = sco
+        self.resource_cache = resource_cache
+        self.uploader = uploader
 
-    def run(self, request):
-        """Run SCO model for given request. Uses the resource URL in the given
-        request to access the model run information and to fetch associated
-        resources.
+    def fetch_resources(self, model_run):
+        """Fetch the experiment, functional data, subject, image group, and
+        model for a model run. The experiment and the model are fetched
+        concurrently. All other resources are fetched concurrently once the
+        experiment is available. Sets the model run state to FAILED if either
+        of the resources does not exist.
 
         Parameters
         ----------
-        request : scoengine.ModelRunRequest
-            Object containing information about requested model run
+        model_run : scocli.ModelRunHandle
+            Handle for model run
+
+        Returns
+        -------
+        tuple
+            Experiment, functional data, subject, image group, and model or
+            None if fetching one of the resources failed
         """
-        # Get model run handler from database. Ensure that it is in state IDLE
-        # or RUNNING.
-        try:
-            model_run = self.sco.experiments_predictions_get(request.resource_url)
-            if model_run is None:
-                raise ValueError('unknown model run: ' + request.run_id + ':' + request.experiment_id)
-            if not (model_run.state.is_idle or model_run.state.is_running):
-                raise ValueError('invalid run state: ' + str(model_run.state))
-        except ValueError as ex:
-            # In case of an exception return. No point in updating the state
-            # of a non-existing model run
-            logging.exception(ex)
-            return
-        # Get resources that are associated with the model run and necessary to
-        # run the prediction. Catch ValueError (and set model run state to
-        # FAILED) if either of the resources does not exist.
+        # Reuse resources that have been fetched for another run of the same
+        # batch
+        shared = self.shared_resources
+        if not shared is None and model_run.experiment_url in shared and model_run.model_url in shared:
+            experiment, fmri_data, subject, image_group = shared[model_run.experiment_url]
+            return experiment, fmri_data, subject, image_group, shared[model_run.model_url]
+        # The model does not depend on the experiment.
+        fetch_model = BackgroundTask(lambda: model_run.model)
+        fetch_model.start()
         try:
             # Get experiment. Raise exception if experiment does not exist.
             experiment = model_run.experiment
         except ValueError as ex:
             logging.exception(ex)
+            fetch_model.join()
             # In case of an exception set run state to failed and return
             model_run.update_state_error([
                 'unknown experiment: ' + model_run.experiment_url,
                 str(ex)
             ])
-            return
+            return None
+        fetch_fmri = BackgroundTask(lambda: experiment.fmri_data)
+        fetch_subject = BackgroundTask(lambda: experiment.subject)
+        fetch_images = BackgroundTask(lambda: experiment.image_group)
+        tasks = [fetch_fmri, fetch_subject, fetch_images, fetch_model]
+        for task in tasks[:-1]:
+            task.start()
+        # Wait for all downloads to finish before any errors are reported
+        for task in tasks:
+            task.join()
         try:
             # Get fMRI data. Raise exception if experiment does not exist.
-            fmri_data = experiment.fmri_data
+            fmri_data = fetch_fmri.result()
         except ValueError as ex:
             logging.exception(ex)
             # In case of an exception set run state to failed and return
@@ -238,20 +1088,20 @@ class SCOClientWorker(SCOWorker):
                 'unknown functional data: ' + experiment.fmri_url,
                 str(ex)
             ])
-            return
+            return None
         try:
             # Get associated subject. Raise exception if subject does not exist
-            subject = experiment.subject
+            subject = fetch_subject.result()
         except ValueError as ex:
             # In case of an exception set run state to failed and return
             model_run.update_state_error([
                 'unknown subject: ' + model_run.subject_url,
                 str(ex)
             ])
-            return
+            return None
         try:
             # Get associated image group. Raise exception if image group does not exist
-            image_group = experiment.image_group
+            image_group = fetch_images.result()
         except ValueError as ex:
             logging.exception(ex)
             # In case of an exception set run state to failed and return
@@ -259,11 +1109,11 @@ class SCOClientWorker(SCOWorker):
                 'unknown image group: ' + experiment.image_group_url,
                 [str(ex)]
             )
-            return
+            return None
         try:
             # Get model that is being run. Raises an exception if the model does
             # not exist
-            model = model_run.model
+            model = fetch_model.result()
         except ValueError as ex:
             logging.exception(ex)
             # In case of an exception set run state to failed and return
@@ -271,37 +1121,280 @@ class SCOClientWorker(SCOWorker):
                 'unknown model: ' + model_run.model_url,
                 str(ex)
             ])
-            return
-        # Set run state to RUNNING (only if IDLE) and call generic run_sco
-        # workflow. Make sure to catch all exceptions.
+            return None
+        if not shared is None:
+            shared[model_run.experiment_url] = (experiment, fmri_data, subject, image_group)
+            shared[model_run.model_url] = model
+        return experiment, fmri_data, subject, image_group, model
+
+    def fetch(self, request):
+        """Get the model run and all associated resources using the resource
+        URL in the given request (see SCOWorker.fetch()).
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Object containing information about requested model run
+
+        Returns
+        -------
+        scoworker.RunJob
+        """
+        # Get model run handler from database. Ensure that it is in state IDLE
+        # or RUNNING.
+        try:
+            model_run = self.sco.experiments_predictions_get(request.resource_url)
+            if model_run is None:
+                raise ValueError('unknown model run: ' + request.run_id + ':' + request.experiment_id)
+            if not (model_run.state.is_idle or model_run.state.is_running):
+                # Duplicate request for a run that has been completed already
+                logging.info('Skip model run in state ' + str(model_run.state) + ': ' + request.run_id + ':' + request.experiment_id)
+                return None
+        except ValueError as ex:
+            # In case of an exception return. No point in updating the state
+            # of a non-existing model run
+            logging.exception(ex)
+            return None
+        # Get resources that are associated with the model run and necessary to
+        # run the prediction. Catch ValueError (and set model run state to
+        # FAILED) if either of the resources does not exist. Resources that do
+        # not depend on each other are fetched concurrently. Errors are
+        # reported in the same order as if resources were fetched one after
+        # another.
+        with self.metrics.timer('fetch') as fetch_timer:
+            resources = self.fetch_resources(model_run)
+        logging.info('Fetch resources in %.3f s' % (fetch_timer.elapsed))
+        if resources is None:
+            return None
+        # Pin downloaded resources in the resource cache. Fetch resources
+        # again if a resource has been evicted by another worker in the
+        # meantime.
+        pinned = []
+        if not self.resource_cache is None:
+            pinned = self.resource_cache.acquire(resource_files(resources))
+            if pinned is None:
+                resources = self.fetch_resources(model_run)
+                if resources is None:
+                    return None
+                pinned = self.resource_cache.acquire(resource_files(resources))
+                if pinned is None:
+                    logging.warning('Resource evicted during model run')
+                    pinned = []
+        experiment, fmri_data, subject, image_group, model = resources
+        # Scratch directory for run results
+        try:
+            output_dir = self.create_output_dir(image_group)
+        except ScratchQuotaExceeded as ex:
+            logging.exception(ex)
+            if not self.resource_cache is None and len(pinned) > 0:
+                self.resource_cache.release(pinned)
+            self.abort(request, [str(ex)])
+            return None
+        # Set run state to RUNNING (only if IDLE)
         if model_run.state.is_idle:
             model_run.update_state_active()
-        # Temporal directory for run results
-        temp_dir = tempfile.mkdtemp()
+        return RunJob(
+            model_run,
+            model,
+            subject,
+            image_group,
+            fmri_data,
+            output_dir,
+            pinned=pinned
+        )
+
+    def abort(self, request, errors):
+        """Set the state of a model run to FAILED (see SCOWorker.abort())."""
+        model_run = self.sco.experiments_predictions_get(request.resource_url)
+        model_run.update_state_error(errors)
+        self.remove_checkpoint(request)
+
+    def fail(self, job, ex):
+        """Set the state of a model run to FAILED (see SCOWorker.fail())."""
+        # In case of an exception set run state to failed and return. The
+        # output directory is removed even if the state cannot be updated.
         try:
-            prediction_file, attachments = sco_run(
-                model_run,
-                model,
-                subject,
-                image_group,
-                temp_dir,
-                fmri_data=fmri_data
-            )
-        except Exception as ex:
-            logging.exception(ex)
-            # In case of an exception set run state to failed and return
-            model_run.update_state_error([type(ex).__name__ + ': ' + str(ex)])
-            return
-        # Update run state to success. This will upload the given tar file as
-        # model run result
-        model_run.update_state_success(prediction_file)
+            job.model_run.update_state_error([type(ex).__name__ + ': ' + str(ex)])
+        finally:
+            self.cleanup(job)
 
-        # Upload any attachments returned by the model run
-        for resource_id in attachments:
-            filename, mime_type = attachments[resource_id]
-            try:
-                model_run.attach_file(filename, resource_id=resource_id)
-            except ValueError as ex:
-                logging.exception(ex)
-        # Clean-up
-        shutil.rmtree(temp_dir)
+    def release(self, job):
+        """Unpin the downloaded resources of a model run in the resource
+        cache.
+
+        Parameters
+        ----------
+        job : scoworker.RunJob
+            Model run that is being executed
+        """
+        if not self.resource_cache is None and len(job.pinned) > 0:
+            self.resource_cache.release(job.pinned)
+            job.pinned = []
+
+    def upload(self, job):
+        """Upload results of a model run (see SCOWorker.upload())."""
+        model_run = job.model_run
+        try:
+            if self.uploader is None:
+                # Update run state to success. This will upload the given tar
+                # file as model run result
+                model_run.update_state_success(job.prediction_file)
+                # Upload any attachments returned by the model run
+                for resource_id in job.attachments:
+                    filename, mime_type = job.attachments[resource_id]
+                    try:
+                        model_run.attach_file(filename, resource_id=resource_id)
+                    except ValueError as ex:
+                        logging.exception(ex)
+            else:
+                # Attachments can only be added to runs in state SUCCESS. The
+                # state transition may have happened even if the request
+                # failed. Re-read the run state before a retry.
+                self.uploader.run(
+                    lambda: model_run.update_state_success(job.prediction_file),
+                    os.path.basename(job.prediction_file),
+                    completed=lambda: self.sco.experiments_predictions_get(
+                        job.request.resource_url
+                    ).state.is_success
+                )
+                # Upload attachments concurrently. Attachments that cannot be
+                # uploaded after retries are logged. The run remains SUCCESS.
+                uploads = dict()
+                for resource_id in job.attachments:
+                    uploads[resource_id] = self.uploader.submit(
+                        upload_attachment(model_run, resource_id, job.attachments[resource_id][0]),
+                        resource_id
+                    )
+                for resource_id in uploads:
+                    try:
+                        uploads[resource_id].result()
+                    except (IOError, ValueError) as ex:
+                        logging.error('Failed to upload attachment ' + resource_id + ': ' + str(ex))
+        finally:
+            # Clean-up
+            self.cleanup(job)
+        return job
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def experiment_key(job):
+    """Key for the subject, image group, and functional data of a fetched
+    model run.
+
+    Parameters
+    ----------
+    job : scoworker.RunJob
+        Fetched model run
+
+    Returns
+    -------
+    (string, string, string)
+        Identifiers of subject, image group, and functional data (None if the
+        run has no functional data)
+    """
+    return (
+        job.subject.identifier,
+        job.image_group.identifier,
+        job.fmri_data.identifier if not job.fmri_data is None else None
+    )
+
+
+def group_jobs(jobs):
+    """Group fetched model runs by subject and image group.
+
+    Parameters
+    ----------
+    jobs : list(scoworker.RunJob)
+        Fetched model runs
+
+    Returns
+    -------
+    collections.OrderedDict
+        Lists of model runs keyed by subject and image group identifier (in
+        order of first occurrence)
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        key = (job.subject.identifier, job.image_group.identifier)
+        groups.setdefault(key, []).append(job)
+    return groups
+
+
+def request_key(request):
+    """Unique key for a model run request.
+
+    Parameters
+    ----------
+    request : scoengine.ModelRunRequest
+        Object containing information about requested model run
+
+    Returns
+    -------
+    string
+    """
+    return request.experiment_id + ':' + request.run_id
+
+
+def resource_files(resources):
+    """List of resource identifiers and paths to downloaded resource files for
+    the resources of a model run.
+
+    Parameters
+    ----------
+    resources : tuple
+        Experiment, functional data, subject, image group, and model
+
+    Returns
+    -------
+    list((string, string))
+    """
+    experiment, fmri_data, subject, image_group, model = resources
+    files = [(subject.identifier, subject.data_directory)]
+    for img in image_group.images:
+        files.append((image_group.identifier, img.filename))
+    if not fmri_data is None:
+        files.append((fmri_data.identifier, fmri_data.data_file))
+    return files
+
+
+def same_inputs(job, other):
+    """Test if two fetched model runs use the same model, subject, image
+    group, and functional data.
+
+    Parameters
+    ----------
+    job : scoworker.RunJob
+    other : scoworker.RunJob
+
+    Returns
+    -------
+    bool
+    """
+    return (
+        job.model.identifier == other.model.identifier and
+        experiment_key(job) == experiment_key(other)
+    )
+
+
+def upload_attachment(model_run, resource_id, filename):
+    """Function that attaches a file to a model run via the SCO client.
+
+    Parameters
+    ----------
+    model_run : scocli.ModelRunHandle
+        Handle for model run resource
+    resource_id : string
+        Resource identifier of the attachment
+    filename : string
+        Path to attachment file
+
+    Returns
+    -------
+    callable
+    """
+    return lambda: model_run.attach_file(filename, resource_id=resource_id)
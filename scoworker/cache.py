@@ -0,0 +1,578 @@
+"""Size-bounded caches on local disk. A cache is a directory that contains
+one sub-directory per cache entry and an index file. The index keeps the
+size of every entry. Lookups record the time of last access as the
+modification time of the entry directory, i.e., the index is only rewritten
+when entries are added or removed. If the total size of all entries exceeds
+the size budget of the cache, the least recently used entries are evicted.
+
+Entries are created in a temporary directory and moved into place with a
+single rename. Access to the index is serialized with a lock file, i.e., a
+cache directory can be shared by multiple worker processes on the same
+machine.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+# Name of the index file and the lock file in a cache directory
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+# Prefix for temporary directories of entries that are being created
+TEMP_PREFIX = '.tmp-'
+
+# Buffer size for reading files when computing content hashes
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+class DiskCache(object):
+    """Cache of directories on local disk with least-recently-used eviction.
+
+    Attributes
+    ----------
+    directory : string
+        Path to cache directory
+    max_size : int
+        Size budget of the cache in bytes. No entries are evicted if None.
+    hits : int
+        Number of successful lookups
+    misses : int
+        Number of failed lookups
+    evictions : int
+        Number of evicted entries
+    """
+    def __init__(self, directory, max_size=None):
+        """Initialize the cache directory. The directory is created if it does
+        not exist. Leftovers from entries whose creation was interrupted are
+        removed.
+
+        Parameters
+        ----------
+        directory : string
+            Path to cache directory
+        max_size : int, optional
+            Size budget of the cache in bytes
+        """
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.thread_lock = threading.Lock()
+        with self.lock():
+            for name in os.listdir(self.directory):
+                if name.startswith(TEMP_PREFIX):
+                    path = os.path.join(self.directory, name)
+                    if is_stale(path):
+                        shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self.lock():
+            index = self.read_index()
+            for key in index:
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            self.write_index({})
+
+    def entry_path(self, key):
+        """Path to the directory of the cache entry with the given key.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+
+        Returns
+        -------
+        string
+        """
+        return os.path.join(self.directory, key)
+
+    def evict(self, index, keep=None):
+        """Remove least recently used entries from the given index until the
+        total size of all entries is within the size budget. Entries that are
+        pinned by a running process are not evicted. Expects the caller to
+        hold the cache lock.
+
+        Parameters
+        ----------
+        index : dict
+            Cache index. Will be modified.
+        keep : string, optional
+            Key of an entry that is not evicted
+        """
+        if self.max_size is None:
+            return
+        total_size = sum([index[key]['size'] for key in index])
+        candidates = sorted(
+            [key for key in index if key != keep and not is_pinned(index[key])],
+            key=lambda k: self.last_access(k, index[k])
+        )
+        while total_size > self.max_size and len(candidates) > 0:
+            key = candidates.pop(0)
+            total_size -= index[key]['size']
+            del index[key]
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            self.evictions += 1
+            logging.info('Cache evict [' + self.directory + ']: ' + key)
+
+    def get(self, key):
+        """Get the directory of the cache entry with the given key. Updates the
+        time of last access for the entry (without rewriting the index).
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+
+        Returns
+        -------
+        string
+            Path to entry directory or None if no entry with the given key
+            exists
+        """
+        with self.lock():
+            index = self.read_index()
+            path = self.entry_path(key)
+            if key in index and os.path.isdir(path):
+                touch(path)
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def last_access(self, key, entry):
+        """Time of last access for a cache entry. The later of the access
+        time in the index and the modification time of the entry directory.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+        entry : dict
+            Index entry
+
+        Returns
+        -------
+        float
+        """
+        try:
+            return max(entry['accessed'], os.path.getmtime(self.entry_path(key)))
+        except OSError:
+            return entry['accessed']
+
+    def lock(self):
+        """Lock that serializes access to the cache index across threads and
+        processes.
+
+        Returns
+        -------
+        CacheLock
+        """
+        return CacheLock(self)
+
+    def pin(self, key):
+        """Protect the entry with the given key from eviction until unpin() is
+        called by the same process. Pins of processes that no longer exist are
+        ignored.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+
+        Returns
+        -------
+        bool
+            True, if the entry exists
+        """
+        with self.lock():
+            index = self.read_index()
+            if not key in index:
+                return False
+            pins = index[key].setdefault('pins', {})
+            pid = str(os.getpid())
+            pins[pid] = pins.get(pid, 0) + 1
+            self.write_index(index)
+            return True
+
+    def put(self, key, write_func):
+        """Create a new cache entry. The given function is called with the path
+        to an empty directory and is expected to write the entry content into
+        that directory. If an entry with the given key already exists, the
+        existing entry is kept.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+        write_func : callable
+            Function that writes entry content into a given directory
+
+        Returns
+        -------
+        string
+            Path to entry directory
+        """
+        temp_dir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=self.directory)
+        try:
+            write_func(temp_dir)
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        size = directory_size(temp_dir)
+        with self.lock():
+            index = self.read_index()
+            path = self.entry_path(key)
+            if key in index and os.path.isdir(path):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                if os.path.exists(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                os.rename(temp_dir, path)
+                now = time.time()
+                index[key] = {'size' : size, 'created' : now, 'accessed' : now}
+                self.evict(index, keep=key)
+                self.write_index(index)
+            return path
+
+    def read_index(self):
+        """Read the cache index. Expects the caller to hold the cache lock.
+
+        Returns
+        -------
+        dict
+        """
+        index_file = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.isfile(index_file):
+            return {}
+        try:
+            with open(index_file, 'r') as f:
+                return json.load(f)
+        except ValueError as ex:
+            # Start with an empty index if the index file is corrupted
+            logging.exception(ex)
+            return {}
+
+    def remove(self, key):
+        """Remove the entry with the given key from the cache.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+
+        Returns
+        -------
+        bool
+            True, if the entry existed
+        """
+        with self.lock():
+            index = self.read_index()
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            if key in index:
+                del index[key]
+                self.write_index(index)
+                return True
+            return False
+
+    def size(self):
+        """Total size of all entries in the cache (in bytes).
+
+        Returns
+        -------
+        int
+        """
+        with self.lock():
+            index = self.read_index()
+            return sum([index[key]['size'] for key in index])
+
+    def unpin(self, key):
+        """Remove a pin that was added by pin() for the entry with the given
+        key.
+
+        Parameters
+        ----------
+        key : string
+            Unique entry key
+        """
+        with self.lock():
+            index = self.read_index()
+            if not key in index:
+                return
+            pins = index[key].get('pins', {})
+            pid = str(os.getpid())
+            if pins.get(pid, 0) > 1:
+                pins[pid] -= 1
+            elif pid in pins:
+                del pins[pid]
+            self.write_index(index)
+
+    def write_index(self, index):
+        """Write the cache index. Expects the caller to hold the cache lock.
+
+        Parameters
+        ----------
+        index : dict
+            Cache index
+        """
+        index_file = os.path.join(self.directory, INDEX_FILE)
+        temp_file = index_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(index, f)
+        os.rename(temp_file, index_file)
+
+
+class CacheLock(object):
+    """Context manager for exclusive access to a cache index. Combines a
+    thread lock with an advisory lock on the cache's lock file.
+    """
+    def __init__(self, cache):
+        """Initialize the cache that is being locked.
+
+        Parameters
+        ----------
+        cache : DiskCache
+        """
+        self.cache = cache
+        self.fd = None
+
+    def __enter__(self):
+        self.cache.thread_lock.acquire()
+        try:
+            self.fd = open(os.path.join(self.cache.directory, LOCK_FILE), 'a')
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except:
+            if not self.fd is None:
+                self.fd.close()
+            self.cache.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+        finally:
+            self.cache.thread_lock.release()
+        return False
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+# Content hashes of directories keyed by directory path. Each hash is stored
+# together with the list of file names, sizes and modification times that it
+# was computed for.
+_directory_hashes = {}
+_directory_hashes_lock = threading.Lock()
+
+# Content hashes of files keyed by file path. Each hash is stored together
+# with the file size and modification time that it was computed for.
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def directory_size(directory):
+    """Total size of all files in a directory (in bytes).
+
+    Parameters
+    ----------
+    directory : string
+        Path to directory
+
+    Returns
+    -------
+    int
+    """
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def hash_directory(directory):
+    """Content hash for all files in a directory. The hash is computed from
+    relative file names and file contents. Hashes are remembered for the
+    lifetime of the process and only recomputed if the list of files or the
+    size or modification time of one of the files changes.
+
+    Parameters
+    ----------
+    directory : string
+        Path to directory
+
+    Returns
+    -------
+    string
+    """
+    directory = os.path.abspath(directory)
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            files.append((
+                os.path.relpath(path, directory),
+                stat.st_size,
+                stat.st_mtime
+            ))
+    with _directory_hashes_lock:
+        if directory in _directory_hashes:
+            signature, digest = _directory_hashes[directory]
+            if signature == files:
+                return digest
+    sha = hashlib.sha1()
+    for rel_path, size, mtime in files:
+        sha.update(rel_path + '\0')
+        sha.update(hash_file(os.path.join(directory, rel_path)))
+    digest = sha.hexdigest()
+    with _directory_hashes_lock:
+        _directory_hashes[directory] = (files, digest)
+    return digest
+
+
+def hash_file(filename):
+    """Content hash for a single file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to file
+
+    Returns
+    -------
+    string
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(HASH_BUFFER_SIZE)
+            if not buf:
+                break
+            sha.update(buf)
+    return sha.hexdigest()
+
+
+def hash_files(filenames):
+    """Content hashes for a list of files. Hashes are remembered for the
+    lifetime of the process and only recomputed if the size or modification
+    time of a file changes.
+
+    Parameters
+    ----------
+    filenames : list(string)
+        List of file paths
+
+    Returns
+    -------
+    list(string)
+    """
+    digests = []
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        signature = (stat.st_size, stat.st_mtime)
+        with _file_hashes_lock:
+            entry = _file_hashes.get(filename)
+        if not entry is None and entry[0] == signature:
+            digests.append(entry[1])
+        else:
+            digest = hash_file(filename)
+            with _file_hashes_lock:
+                _file_hashes[filename] = (signature, digest)
+            digests.append(digest)
+    return digests
+
+
+def hash_values(*values):
+    """Hash for a list of string values.
+
+    Parameters
+    ----------
+    values : list(string)
+
+    Returns
+    -------
+    string
+    """
+    sha = hashlib.sha1()
+    for value in values:
+        sha.update(str(value) + '\0')
+    return sha.hexdigest()
+
+
+def is_pinned(entry):
+    """Test if a cache index entry is pinned by a running process.
+
+    Parameters
+    ----------
+    entry : dict
+        Cache index entry
+
+    Returns
+    -------
+    bool
+    """
+    for pid in entry.get('pins', {}):
+        try:
+            os.kill(int(pid), 0)
+            return True
+        except OSError as ex:
+            # The process exists but belongs to a different user
+            if ex.errno == errno.EPERM:
+                return True
+    return False
+
+
+def is_stale(path, max_age=3600):
+    """Test if the file or directory at the given path has not been modified
+    for the given number of seconds.
+
+    Parameters
+    ----------
+    path : string
+    max_age : int, optional
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        return time.time() - os.path.getmtime(path) > max_age
+    except OSError:
+        return False
+
+
+def touch(path):
+    """Set the modification time of a file or directory to the current time.
+    Errors are ignored (e.g., if the entry has been evicted by another
+    process in the meantime).
+
+    Parameters
+    ----------
+    path : string
+        Path to file or directory
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
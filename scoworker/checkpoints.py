@@ -0,0 +1,247 @@
+"""Checkpoints for interrupted model runs. Values of plan nodes are written to
+a per-run checkpoint directory as soon as they are computed. A model run that
+is restarted on the same host (e.g., because the worker died and the request
+was redelivered) resumes from its checkpoint, i.e., nodes whose values are in
+the checkpoint are not computed again. Checkpoints are removed once the run
+reaches SUCCESS or FAILED. Checkpoints of runs that were never completed on
+this host (e.g., because the request was redelivered to another host) are
+removed after a maximum age.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import pimms
+from pimms.calculation import Calc
+
+from cache import hash_values, is_stale
+from plans import OUTPUT_AFFERENTS, RUN_AFFERENTS, canonical_value, freeze_nodes, load_values, node_afferents, save_values
+
+
+# Name of the file that identifies the arguments of a checkpointed run
+ARGUMENTS_FILE = 'arguments.txt'
+
+# Prefix for temporary directories in checkpoint directories
+TEMP_PREFIX = '.tmp-'
+
+# Time after which checkpoints of runs that were not completed are removed
+# (in seconds)
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+
+class CheckpointStore(object):
+    """Directory that contains the checkpoints of model runs. Each checkpoint
+    is kept in a sub-folder that is named by the hash of the run key.
+    """
+    def __init__(self, directory, max_age=CHECKPOINT_MAX_AGE):
+        """Initialize the checkpoint directory. Removes checkpoints that have
+        not been modified for the given maximum age.
+
+        Parameters
+        ----------
+        directory : string
+            Path to checkpoint directory. The directory is created if it does
+            not exist.
+        max_age : int, optional
+            Time after which checkpoints of runs that were not completed are
+            removed (in seconds)
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_age = max_age
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.sweep()
+
+    def checkpoint(self, key):
+        """Get the checkpoint for a model run.
+
+        Parameters
+        ----------
+        key : string
+            Unique key of the model run
+
+        Returns
+        -------
+        scoworker.checkpoints.Checkpoint
+        """
+        return Checkpoint(self.checkpoint_path(key))
+
+    def checkpoint_path(self, key):
+        """Path to the checkpoint directory for a given run key.
+
+        Parameters
+        ----------
+        key : string
+            Unique key of the model run
+
+        Returns
+        -------
+        string
+        """
+        return os.path.join(self.directory, hash_values(key))
+
+    def remove(self, key):
+        """Remove the checkpoint of a model run (if it exists).
+
+        Parameters
+        ----------
+        key : string
+            Unique key of the model run
+        """
+        path = self.checkpoint_path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self):
+        """Remove all checkpoints that have not been modified for the maximum
+        age.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path) and is_stale(path, max_age=self.max_age):
+                logging.info('Remove stale checkpoint ' + name)
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class Checkpoint(object):
+    """Checkpoint of a single model run.
+
+    Attributes
+    ----------
+    directory : string
+        Path to checkpoint directory
+    """
+    def __init__(self, directory):
+        """Initialize the checkpoint directory.
+
+        Parameters
+        ----------
+        directory : string
+            Path to checkpoint directory
+        """
+        self.directory = directory
+
+    def prepare(self, plan, args):
+        """Prepare a model run. Returns a copy of the plan where nodes whose
+        values are in the checkpoint are replaced by these values and all
+        other nodes write their values to the checkpoint once they are
+        computed. The checkpoint is reset if it was written for different
+        arguments. Nodes without parameters (e.g., nodes whose values were
+        taken from a cache) and nodes that write output files are not
+        checkpointed.
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+        args : dict
+            Model run arguments
+
+        Returns
+        -------
+        pimms.Plan
+        """
+        signature = hash_values(
+            *[k + '=' + canonical_value(args[k]) for k in sorted(args) if not k in RUN_AFFERENTS]
+        )
+        values = {}
+        arguments_file = os.path.join(self.directory, ARGUMENTS_FILE)
+        if os.path.isfile(arguments_file):
+            with open(arguments_file, 'r') as f:
+                if f.read() == signature:
+                    try:
+                        values = load_values(self.directory)
+                    except Exception as ex:
+                        logging.exception(ex)
+                        values = {}
+        if len(values) > 0:
+            logging.info('Resume run from checkpoint with %d value(s)' % (len(values)))
+            plan = freeze_nodes(plan, values)
+        else:
+            if os.path.isdir(self.directory):
+                shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+            with open(arguments_file, 'w') as f:
+                f.write(signature)
+        nodes = dict(plan.nodes)
+        for name in plan.nodes:
+            node = plan.nodes[name]
+            if len(node.afferents) == 0 or len(node.efferents) == 0:
+                continue
+            if len(node_afferents(plan, node).intersection(OUTPUT_AFFERENTS)) > 0:
+                continue
+            nodes[name] = checkpoint_calc(node, name, self.directory)
+        return pimms.plan(nodes)
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def checkpoint_calc(node, name, directory):
+    """Calculation node that computes the values of the given node and writes
+    them to a checkpoint directory.
+
+    Parameters
+    ----------
+    node : pimms.Calc
+        Plan node
+    name : string
+        Name of the plan node
+    directory : string
+        Path to checkpoint directory
+
+    Returns
+    -------
+    pimms.Calc
+    """
+    def checkpoint_values(*values):
+        result = node(dict(zip(node.afferents, values)))
+        write_checkpoint(directory, name, result)
+        return result
+    # Disable memoization. The memoization key of a node is its function name
+    # and all checkpoint nodes share the same function name.
+    return Calc(
+        node.afferents,
+        checkpoint_values,
+        node.efferents,
+        node.defaults,
+        lazy=node.lazy,
+        meta_data=node.meta_data,
+        cache=node.cache,
+        memoize=False
+    )
+
+
+def write_checkpoint(directory, name, values):
+    """Add the values of a plan node to a checkpoint directory. Values are
+    written to a temporary directory first and then moved into the checkpoint
+    directory to ensure that the checkpoint only contains complete files.
+    Errors are logged but not raised.
+
+    Parameters
+    ----------
+    directory : string
+        Path to checkpoint directory
+    name : string
+        Name of the plan node
+    values : dict(string:any)
+        Dictionary of efferent values
+    """
+    try:
+        temp_dir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            save_values(temp_dir, {name : values})
+            for filename in os.listdir(temp_dir):
+                os.rename(
+                    os.path.join(temp_dir, filename),
+                    os.path.join(directory, filename)
+                )
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    except (IOError, OSError) as ex:
+        logging.exception(ex)
@@ -0,0 +1,407 @@
+"""Asynchronous consumer for model run requests. The consumer runs the pika
+I/O loop in the main thread and hands requests over to a dispatcher thread
+that executes them using a worker, a pipeline, or a supervisor. The I/O loop
+is never blocked by model runs, i.e., heartbeats are answered and several
+requests can be in flight at the same time.
+
+Requests are acknowledged when the run is done. If the connection is lost the
+consumer reconnects with exponential backoff. Runs that are in flight
+continue. Their redelivered requests are not executed again but acknowledged
+once the original run is done.
+
+With subject-affinity routing (see scoworker.routing) the consumer always
+consumes from the affinity queue of the host and from the shared queue only
+while no request is in flight.
+"""
+
+import json
+import logging
+import pika
+from pika.adapters.select_connection import IOLoop
+import Queue
+import threading
+import time
+
+from scoengine import ModelRunRequest
+from scoworker import request_key
+
+
+# Initial and maximum delay before reconnecting to the server (in seconds)
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+
+
+class Dispatcher(threading.Thread):
+    """Thread that hands requests over to a submit function. The submit
+    function may block (e.g., while a pipeline is full). It receives the
+    request and a callback that has to be called when the request is done.
+    An optional poll function is called regularly (e.g., to check the state
+    of a supervisor's children). Submit and poll are always called from the
+    dispatcher thread.
+
+    Attributes
+    ----------
+    submit : callable
+        Function that takes a request and a callback
+    poll : callable
+        Function without arguments (optional)
+    interval : float
+        Maximum interval between calls to the poll function (in seconds)
+    queue : Queue.Queue
+        Queue of pending requests
+    """
+    def __init__(self, submit, poll=None, interval=1.0):
+        """Initialize the dispatcher thread.
+
+        Parameters
+        ----------
+        submit : callable
+            Function that takes a request and a callback
+        poll : callable, optional
+            Function without arguments
+        interval : float, optional
+            Maximum interval between calls to the poll function (in seconds)
+        """
+        super(Dispatcher, self).__init__()
+        self.daemon = True
+        self.submit = submit
+        self.poll = poll
+        self.interval = interval
+        self.queue = Queue.Queue()
+
+    def close(self):
+        """Stop the dispatcher thread after all pending requests have been
+        handed over.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def put(self, request, callback):
+        """Add a request to the queue of pending requests.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Request for a model run
+        callback : callable
+            Function without arguments that is called when the request is done
+        """
+        self.queue.put((request, callback))
+
+    def run(self):
+        """Hand pending requests over to the submit function."""
+        while True:
+            try:
+                item = self.queue.get(timeout=self.interval)
+                if item is None:
+                    break
+                request, callback = item
+                self.submit(request, callback)
+            except Queue.Empty:
+                pass
+            except Exception as ex:
+                logging.exception(ex)
+            if not self.poll is None:
+                try:
+                    self.poll()
+                except Exception as ex:
+                    logging.exception(ex)
+
+
+class BatchDispatcher(Dispatcher):
+    """Dispatcher that hands requests over in batches. A batch is complete
+    when it contains the maximum number of requests or when the maximum wait
+    time since the first request of the batch has passed and no further
+    requests are queued. The submit
+    function receives a list of requests and a list of callbacks.
+
+    Attributes
+    ----------
+    batch_size : int
+        Maximum number of requests in a batch
+    batch_wait : float
+        Maximum wait time for a batch to fill up (in seconds)
+    """
+    def __init__(self, submit, batch_size, batch_wait, poll=None, interval=1.0):
+        """Initialize the dispatcher thread.
+
+        Parameters
+        ----------
+        submit : callable
+            Function that takes a list of requests and a list of callbacks
+        batch_size : int
+            Maximum number of requests in a batch
+        batch_wait : float
+            Maximum wait time for a batch to fill up (in seconds)
+        poll : callable, optional
+            Function without arguments
+        interval : float, optional
+            Maximum interval between calls to the poll function (in seconds)
+        """
+        super(BatchDispatcher, self).__init__(submit, poll=poll, interval=interval)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+    def run(self):
+        """Hand batches of pending requests over to the submit function."""
+        closed = False
+        while not closed:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.interval)
+                deadline = time.time() + self.batch_wait
+                while not item is None:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    timeout = deadline - time.time()
+                    if timeout > 0:
+                        item = self.queue.get(timeout=timeout)
+                    else:
+                        # Requests that are already queued are added to the
+                        # batch after the wait time has passed
+                        item = self.queue.get_nowait()
+                closed = item is None
+            except Queue.Empty:
+                pass
+            if len(batch) > 0:
+                try:
+                    self.submit([r for r, c in batch], [c for r, c in batch])
+                except Exception as ex:
+                    logging.exception(ex)
+            if not self.poll is None:
+                try:
+                    self.poll()
+                except Exception as ex:
+                    logging.exception(ex)
+
+
+class RequestConsumer(object):
+    """Asynchronous consumer for requests in a RabbitMQ message queue.
+
+    Attributes
+    ----------
+    parameters : pika.ConnectionParameters
+        Connection parameters for the RabbitMQ server
+    queue : string
+        Name of the message queue
+    dispatcher : scoworker.consumer.Dispatcher
+        Dispatcher that executes the requests
+    prefetch : int
+        Maximum number of unacknowledged requests
+    ioloop : pika.adapters.select_connection.IOLoop
+        I/O loop that is shared by all connections
+    connection : pika.SelectConnection
+        Current connection (None while disconnected)
+    channel : pika.channel.Channel
+        Current channel (None while disconnected)
+    in_flight : dict
+        Channel and delivery tag of active requests by request key
+    reconnect_delay : float
+        Delay before the next attempt to reconnect (in seconds)
+    affinity : scoworker.routing.AffinityRouting
+        Subject-affinity routing (optional)
+    shared_consumer : string
+        Consumer tag for the shared queue if the consumer is active (only
+        used with subject-affinity routing)
+    """
+    def __init__(self, parameters, queue, dispatcher, prefetch=1, affinity=None):
+        """Initialize the consumer.
+
+        Parameters
+        ----------
+        parameters : pika.ConnectionParameters
+            Connection parameters for the RabbitMQ server
+        queue : string
+            Name of the message queue
+        dispatcher : scoworker.consumer.Dispatcher
+            Dispatcher that executes the requests
+        prefetch : int, optional
+            Maximum number of unacknowledged requests
+        affinity : scoworker.routing.AffinityRouting, optional
+            Consume from the affinity queue and from the shared queue only
+            while idle
+        """
+        self.parameters = parameters
+        self.queue = queue
+        self.dispatcher = dispatcher
+        self.prefetch = prefetch
+        self.ioloop = IOLoop()
+        self.connection = None
+        self.channel = None
+        self.in_flight = dict()
+        self.reconnect_delay = RECONNECT_DELAY
+        self.stopping = False
+        self.affinity = affinity
+        self.shared_consumer = None
+
+    def acknowledge(self, key):
+        """Acknowledge the request with the given key. Has to be called from
+        the I/O loop. Requests that were received on a channel that has been
+        closed in the meantime cannot be acknowledged. They are redelivered
+        by the server.
+
+        Parameters
+        ----------
+        key : string
+            Unique request key
+        """
+        channel, delivery_tag = self.in_flight.pop(key)
+        if channel is self.channel and channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            logging.info('Channel closed before request [' + key + '] was done')
+        self.update_shared_consumer()
+
+    def complete(self, key):
+        """Callback for requests that are done. Can be called from any
+        thread.
+
+        Parameters
+        ----------
+        key : string
+            Unique request key
+        """
+        self.ioloop.add_callback_threadsafe(lambda: self.acknowledge(key))
+
+    def connect(self):
+        """Open a new connection to the RabbitMQ server."""
+        logging.info('Connect : [HOST=' + self.parameters.host + ', QUEUE=' + self.queue + ']')
+        self.connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_error,
+            on_close_callback=self.on_connection_closed,
+            stop_ioloop_on_close=False,
+            custom_ioloop=self.ioloop
+        )
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Close the connection if the channel is closed by the server."""
+        logging.warning('Channel closed: (%s) %s' % (reply_code, reply_text))
+        self.channel = None
+        self.shared_consumer = None
+        if not self.connection.is_closed and not self.connection.is_closing:
+            self.connection.close()
+
+    def on_channel_open(self, channel):
+        """Set prefetch count and declare the request queue."""
+        self.channel = channel
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.basic_qos(prefetch_count=self.prefetch)
+        channel.queue_declare(self.on_queue_declared, queue=self.queue, durable=True)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """Reconnect unless the consumer is being stopped."""
+        self.channel = None
+        self.shared_consumer = None
+        if self.stopping:
+            self.ioloop.stop()
+        else:
+            logging.warning('Connection closed: (%s) %s' % (reply_code, reply_text))
+            self.reconnect()
+
+    def on_connection_error(self, connection, error):
+        """Reconnect if the connection cannot be established."""
+        logging.warning('Connection failed: ' + str(error))
+        self.reconnect()
+
+    def on_connection_open(self, connection):
+        """Open a channel on the new connection."""
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_message(self, channel, method, properties, body):
+        """Callback handler for requests. Hands requests over to the
+        dispatcher.
+        """
+        # Read model run request (expects Json object)
+        try:
+            request = ModelRunRequest.from_dict(json.loads(body))
+        except Exception as ex:
+            logging.exception(ex)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        key = request_key(request)
+        if key in self.in_flight:
+            active_channel, delivery_tag = self.in_flight[key]
+            if active_channel is channel:
+                # Duplicate message for an active run
+                logging.info('Skip duplicate request [' + key + ']')
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                # Request has been redelivered after a reconnect. Acknowledge
+                # the new delivery when the active run is done.
+                logging.info('Request [' + key + '] is still running')
+                self.in_flight[key] = (channel, method.delivery_tag)
+            return
+        self.in_flight[key] = (channel, method.delivery_tag)
+        logging.info('Submit model run [' + key + ']')
+        self.dispatcher.put(request, lambda: self.complete(key))
+        self.update_shared_consumer()
+
+    def on_affinity_declared(self):
+        """Start consuming requests from the affinity queue (and from the
+        shared queue while idle).
+        """
+        self.channel.basic_consume(self.on_message, queue=self.affinity.queue)
+        self.update_shared_consumer()
+        self.reconnect_delay = RECONNECT_DELAY
+        logging.info('Waiting for requests on ' + self.affinity.queue + ' (%d in flight)' % (len(self.in_flight)))
+
+    def on_queue_declared(self, frame):
+        """Start consuming requests."""
+        if not self.affinity is None:
+            self.affinity.declare(self.channel, self.on_affinity_declared)
+            return
+        self.channel.basic_consume(self.on_message, queue=self.queue)
+        self.reconnect_delay = RECONNECT_DELAY
+        logging.info('Waiting for requests (%d in flight)' % (len(self.in_flight)))
+
+    def reconnect(self):
+        """Open a new connection after a delay. The delay is doubled after
+        each failed attempt.
+        """
+        delay = self.reconnect_delay
+        self.reconnect_delay = min(2 * delay, MAX_RECONNECT_DELAY)
+        logging.info('Reconnect in %.1f s' % (delay))
+        self.ioloop.add_timeout(delay, self.connect)
+
+    def run(self):
+        """Connect to the server and run the I/O loop until the consumer is
+        stopped (or interrupted).
+        """
+        if not self.dispatcher.is_alive():
+            self.dispatcher.start()
+        self.connect()
+        try:
+            self.ioloop.start()
+        except KeyboardInterrupt:
+            self.stop()
+            self.ioloop.start()
+
+    def stop(self):
+        """Close the connection and stop the I/O loop. Has to be called from
+        the I/O loop.
+        """
+        self.stopping = True
+        if not self.connection is None and self.connection.is_open:
+            self.connection.close()
+        else:
+            self.ioloop.stop()
+
+    def update_shared_consumer(self):
+        """Consume from the shared queue while no request is in flight. Only
+        used with subject-affinity routing. Requests that have been delivered
+        before the consumer is cancelled are still executed.
+        """
+        if self.affinity is None or self.channel is None:
+            return
+        idle = len(self.in_flight) == 0
+        if idle and self.shared_consumer is None:
+            self.shared_consumer = self.channel.basic_consume(
+                self.on_message,
+                queue=self.queue
+            )
+        elif not idle and not self.shared_consumer is None:
+            self.channel.basic_cancel(consumer_tag=self.shared_consumer)
+            self.shared_consumer = None
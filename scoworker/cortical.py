@@ -6,10 +6,16 @@ img.identifier, Func/Pred, V1-3, Filename
 
 """
 
+from collections import namedtuple
+import ctypes
+import io
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import os
 import shutil
 import tempfile
 import tarfile
+import time
 import sco
 import pimms
 import pint
@@ -19,8 +25,27 @@ import numpy as np
 
 DEFAULT_TARFILE_NAME = 'cortical-images.tar'
 
+# Model output values that are used to create cortical images. Values for
+# functional data are only used if functional data is given.
+CORTICAL_IMAGE_DATA = ['cortex_indices', 'measurement_indices', 'labels', 'pRFs', 'max_eccentricity']
+CORTICAL_IMAGE_FUNC_DATA = ['measurement_labels', 'measurement_pRFs']
 
-def create_cortical_image_tar(data, input_images, func_filename, output_dir):
+# File name prefix and additional sco.util.cortical_image arguments for each
+# type of cortical image
+IMAGE_TYPES = {
+    'FUNCTIONAL' : ('func_', {'smoothing' : 0.5, 'speckle' : 500}),
+    'PREDICTION' : ('pred_', {})
+}
+
+# pRF geometry in degrees. Contains the pRF properties that are used to
+# render cortical images.
+PRFGeometry = namedtuple('PRFGeometry', ['center', 'radius'])
+
+# Render data of the current process. Set by init_renderer().
+_renderer = None
+
+
+def create_cortical_image_tar(data, input_images, func_filename, output_dir, processes=1, stream=True, fileobj=None, prediction=None, cached_images=None):
     """Create a tar-file of cortical images for given model output.
 
     Parameters
@@ -34,94 +59,493 @@ def create_cortical_image_tar(data, input_images, func_filename, output_dir):
         for functional data are generated.
     output_dir : stringd
         Path to the directory where the tar file is created.
+    processes : int, optional
+        Number of processes that are used to render cortical images. Uses
+        one process per CPU if the value is smaller than one.
+    stream : bool, optional
+        If True, rendered images are serialized in memory and appended to the
+        tar archive directly. Otherwise, images are written to a temporary
+        directory first.
+    fileobj : file-like object, optional
+        Stream the tar archive is written to. If given, no tar file is
+        created in the output directory.
+    prediction : numpy.ndarray, optional
+        Predicted responses (one row per cortex voxel and one column per
+        image) as returned by the SCO model. If not given, the prediction is
+        read from the exported prediction.nii.gz file in the output directory.
+    cached_images : dict, optional
+        Content of previously rendered images by file name. These images are
+        added to the tar archive without being rendered again.
+
+    Returns
+    -------
+    string
+        Name of the tar file (relative to the output directory)
     """
     cortex_idcs = data['cortex_indices']
     measurement_idcs = data['measurement_indices']
 
-    # Get the filename of the predicted results out of the exported_files list:
-    pred_filename = os.path.join(output_dir, 'prediction.nii.gz')
-
-    # use nibabel (import nibabel as nib) to load this file
-    pred_nii = nib.load(pred_filename)
+    if not prediction is None:
+        # Rows of the prediction matrix correspond to the cortex voxels
+        pred = np.asarray(prediction)
+    else:
+        # Get the filename of the predicted results out of the exported_files list:
+        pred_filename = os.path.join(output_dir, 'prediction.nii.gz')
+        # Gather the time series of all cortex voxels in a single indexed read
+        pred = extract_voxels(pred_filename, cortex_idcs)
 
-    # the header and data can be obtained like so:
-    pred_hdr = pred_nii.header
-    pred_dat = pred_nii.dataobj.get_unscaled()
-    pred = np.asarray([pred_dat[ii,jj,kk,:] for (ii,jj,kk) in cortex_idcs])
-
-    if not func_filename is None:
-        func_nii = nib.load(func_filename)
-        func_hdr = func_nii.header
-        func_dat = func_nii.dataobj.get_unscaled()
-        func = np.asarray([func_dat[ii,jj,kk,:] for (ii,jj,kk) in measurement_idcs])
-
-    # Create temporary directory for cortical images
-    tar_dir = tempfile.mkdtemp()
+    # List of (image type, image number, visual area) triples for all cortical
+    # images that are being generated. The order of this list determines the
+    # order of rows in the final CSV file.
+    tasks = []
+    for img_type in ['FUNCTIONAL', 'PREDICTION']:
+        if img_type == 'PREDICTION' or not func_filename is None:
+            for imno in range(len(input_images.images)):
+                for va in range(1,4):
+                    tasks.append((img_type, imno, va))
 
     # List of rows in the final CSV file
     csv_rows = []
+    for img_type, imno, va in tasks:
+        csv_rows.append([
+            input_images.images[imno].identifier,
+            img_type,
+            str(va),
+            cortical_image_filename(img_type, imno, va)
+        ])
+    csv_content = ''.join([','.join(row) + '\n' for row in csv_rows])
 
-    if not func_filename is None:
-        for imno in range(len(input_images.images)):
-            for va in range(1,4):
-                img = sco.util.cortical_image(
-                    func,
-                    data['measurement_labels'],
-                    data['measurement_pRFs'],
-                    data['max_eccentricity'],
-                    visual_area=va,
-                    image_number=imno,
-                    smoothing=0.5, speckle=500
-                )
-                img_filename = 'func_' + str(imno) + '.v' + str(va) + '.png'
-                img.savefig(os.path.join(tar_dir, img_filename))
-                img.clf()
-                csv_rows.append([
-                    input_images.images[imno].identifier,
-                    'FUNCTIONAL',
-                    str(va),
-                    img_filename
-                ])
-
-    sco_load = sco.reload_sco()
-
-    for imno in range(len(input_images.images)):
-        for va in range(1,4):
-            img = sco.util.cortical_image(
-                pred,
-                data['labels'],
-                data['pRFs'],
+    # Only render images that are not given in the cached images
+    if cached_images is None:
+        cached_images = dict()
+    render_tasks = [
+        t for t in tasks if not cortical_image_filename(*t) in cached_images
+    ]
+
+    # Data that is used to render the cortical images of each image type. The
+    # functional data is only read if any functional image is rendered.
+    render_data = {'PREDICTION' : (pred, data['labels'], data['pRFs'])}
+    if any([t[0] == 'FUNCTIONAL' for t in render_tasks]):
+        render_data['FUNCTIONAL'] = (
+            extract_voxels(func_filename, measurement_idcs),
+            data['measurement_labels'],
+            data['measurement_pRFs']
+        )
+
+    # Create tar file. Files are added in a fixed order (index file first,
+    # followed by images in the order of the index rows).
+    if fileobj is None:
+        tar_file_name = os.path.join(output_dir, DEFAULT_TARFILE_NAME)
+        tFile = tarfile.open(tar_file_name, 'w')
+    else:
+        tFile = tarfile.open(fileobj=fileobj, mode='w|')
+    try:
+        if stream:
+            # Serialize each image in memory and append it to the archive as
+            # soon as it is rendered
+            add_tar_member(tFile, 'index.csv', csv_content)
+            images = render_cortical_images(
+                render_data,
                 data['max_eccentricity'],
-                visual_area=va,
-                image_number=imno
+                render_tasks,
+                processes=processes
             )
-            img_filename = 'pred_' + str(imno) + '.v' + str(va) + '.png'
-            img.savefig(os.path.join(tar_dir, img_filename))
-            img.clf()
-            csv_rows.append([
-                input_images.images[imno].identifier,
-                'PREDICTION',
-                str(va),
-                img_filename
-            ])
+            for task in tasks:
+                img_filename = cortical_image_filename(*task)
+                if img_filename in cached_images:
+                    img_content = cached_images[img_filename]
+                else:
+                    img_filename, img_content = next(images)
+                add_tar_member(tFile, img_filename, img_content)
+        else:
+            # Create temporary directory for cortical images in the output
+            # directory (to count it against the scratch space of the run)
+            tar_dir = tempfile.mkdtemp(dir=output_dir)
+            try:
+                with open(os.path.join(tar_dir, 'index.csv'), 'w') as f:
+                    f.write(csv_content)
+                tFile.add(os.path.join(tar_dir, 'index.csv'), arcname='index.csv')
+                images = render_cortical_images(
+                    render_data,
+                    data['max_eccentricity'],
+                    render_tasks,
+                    output_dir=tar_dir,
+                    processes=processes
+                )
+                for task in tasks:
+                    img_filename = cortical_image_filename(*task)
+                    if img_filename in cached_images:
+                        with open(os.path.join(tar_dir, img_filename), 'wb') as f:
+                            f.write(cached_images[img_filename])
+                    else:
+                        img_filename, img_content = next(images)
+                    tFile.add(
+                        os.path.join(tar_dir, img_filename),
+                        arcname=img_filename
+                    )
+            finally:
+                # Clean up. Remove temporary tar directory
+                shutil.rmtree(tar_dir)
+    finally:
+        tFile.close()
 
-    with open(os.path.join(tar_dir, 'index.csv'), 'w') as f:
-        for row in csv_rows:
-            f.write(','.join(row) + '\n')
+    return DEFAULT_TARFILE_NAME
 
-    tar_file_name = os.path.join(output_dir, DEFAULT_TARFILE_NAME)
 
-    # TODO: Create a tar-file that contains all the files in directory tar_dir
-    #Create Tar file
-    tFile = tarfile.open(tar_file_name, 'w')
+def evaluate_cortical_image_data(data, func_filename):
+    """Evaluate all model output values that create_cortical_image_tar() reads
+    from the (lazy) model output. Allows to compute remaining model outputs
+    (e.g., exported files) in parallel with rendering without evaluating the
+    same values concurrently.
 
-    files = os.listdir(tar_dir)
-    for f in files:
-        tFile.add(os.path.join(tar_dir, f), arcname=f)
+    Parameters
+    ----------
+    data : sco.model output
+        Data object returned by SCO model
+    func_filename : string
+        Path to functionl data file. May be None.
+    """
+    keys = list(CORTICAL_IMAGE_DATA)
+    if not func_filename is None:
+        keys.extend(CORTICAL_IMAGE_FUNC_DATA)
+    for key in keys:
+        data[key]
 
-    tFile.close()
 
-    # Clean up. Remove temporary ter directory
-    shutil.rmtree(tar_dir)
+def extract_voxels(filename, indices):
+    """Extract the values along the 4th dimension for a list of voxels from a
+    NIfTI volume. The values for all voxels are gathered in a single indexed
+    read. For uncompressed files the volume is memory-mapped, i.e., only the
+    pages that contain the requested voxels are read from disk. Values are
+    returned unscaled, i.e., as they are stored in the file.
 
-    return DEFAULT_TARFILE_NAME
+    Parameters
+    ----------
+    filename : string
+        Path to NIfTI file
+    indices : list((int, int, int))
+        List of (i,j,k) voxel indices
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (len(indices), n) where n is the size of the volume's
+        4th dimension (1 for 3-D volumes).
+    """
+    img = nib.load(filename, mmap=True)
+    dat = img.dataobj.get_unscaled()
+    idcs = np.asarray(indices, dtype=np.intp).reshape(-1, 3)
+    voxels = dat[idcs[:,0], idcs[:,1], idcs[:,2], ...]
+    # Fancy indexing always copies, i.e., the result does not reference the
+    # memory-mapped file. Make sure it is a plain ndarray.
+    voxels = np.asarray(voxels)
+    if voxels.ndim == 1:
+        voxels = voxels.reshape(-1, 1)
+    return voxels
+
+
+class SharedArray(object):
+    """Numpy array that is kept in shared memory. Shared arrays are passed to
+    the rendering pool when the pool is created. Pool workers inherit the
+    memory instead of receiving a pickled copy of the data with every task.
+
+    Attributes
+    ----------
+    buffer : multiprocessing.sharedctypes.RawArray
+        Shared memory buffer containing the array data
+    dtype : string
+        String representation of the array data type
+    shape : tuple(int)
+        Array shape
+    """
+    def __init__(self, array):
+        """Copy the given array into a new shared memory buffer.
+
+        Parameters
+        ----------
+        array : numpy.ndarray
+            Array that is being shared
+        """
+        array = np.ascontiguousarray(array)
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+        self.buffer = RawArray(ctypes.c_byte, max(array.nbytes, 1))
+        self.array()[...] = array
+
+    def array(self):
+        """Numpy view on the shared memory buffer.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        count = int(np.prod(self.shape))
+        return np.frombuffer(
+            self.buffer,
+            dtype=self.dtype,
+            count=count
+        ).reshape(self.shape)
+
+
+def init_renderer(render_data, max_eccentricity, output_dir):
+    """Set the data that is used by render_image() in the current process.
+
+    Parameters
+    ----------
+    render_data : dict(string:(numpy.ndarray, list, list))
+        Dictionary of (values, labels, pRFs) triples keyed by image type
+    max_eccentricity : pint.Quantity
+        Maximum eccentricity of the cortical images
+    output_dir : string
+        Path to the directory where image files are written
+    """
+    global _renderer
+    _renderer = {
+        'data' : render_data,
+        'max_eccentricity' : max_eccentricity,
+        'directory' : output_dir
+    }
+
+
+def init_shared_renderer(shared_data, max_eccentricity, output_dir):
+    """Initializer for rendering pool workers. Creates numpy views on the
+    shared memory buffers and sets the render data of the worker process.
+
+    Parameters
+    ----------
+    shared_data : dict(string:tuple(SharedArray))
+        Dictionary of (values, labels, pRF centers, pRF radii) quadruples keyed
+        by image type
+    max_eccentricity : pint.Quantity
+        Maximum eccentricity of the cortical images
+    output_dir : string
+        Path to the directory where image files are written
+    """
+    render_data = {}
+    for img_type in shared_data:
+        values, labels, centers, radii = [a.array() for a in shared_data[img_type]]
+        render_data[img_type] = (values, labels, prf_list(centers, radii))
+    init_renderer(render_data, max_eccentricity, output_dir)
+
+
+def prf_geometry(pRFs):
+    """Get arrays of pRF centers and radii (in degrees) for a list of pRFs.
+
+    Parameters
+    ----------
+    pRFs : list
+        List of pRF objects as generated by the SCO model
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+    """
+    centers = np.asarray(
+        [pimms.mag(p.center, 'deg') for p in pRFs],
+        dtype=np.float64
+    ).reshape(-1, 2)
+    radii = np.asarray(
+        [pimms.mag(p.radius, 'deg') for p in pRFs],
+        dtype=np.float64
+    )
+    return centers, radii
+
+
+def prf_list(centers, radii):
+    """Get list of pRF geometries from arrays of pRF centers and radii (in
+    degrees). Images are rendered from the same pRF geometries in a single
+    process and in a pool of processes.
+
+    Parameters
+    ----------
+    centers : numpy.ndarray
+        Array of pRF centers
+    radii : numpy.ndarray
+        Array of pRF radii
+
+    Returns
+    -------
+    list(PRFGeometry)
+    """
+    return [PRFGeometry(c, r) for c, r in zip(centers, radii)]
+
+
+def read_cortical_images(filename, img_type):
+    """Read the content of all cortical images of a given type from a tar
+    file that was created by create_cortical_image_tar().
+
+    Parameters
+    ----------
+    filename : string
+        Path to tar file
+    img_type : string
+        Image type (FUNCTIONAL or PREDICTION)
+
+    Returns
+    -------
+    dict
+        Image content by file name
+    """
+    images = dict()
+    tar = tarfile.open(filename, 'r')
+    try:
+        for member in tar.getmembers():
+            if member.name.startswith(IMAGE_TYPES[img_type][0]):
+                images[member.name] = tar.extractfile(member).read()
+    finally:
+        tar.close()
+    return images
+
+
+def render_cortical_images(render_data, max_eccentricity, tasks, output_dir=None, processes=1):
+    """Render cortical images for a list of (image type, image number, visual
+    area) triples. If an output directory is given, images are written as PNG
+    files to that directory. Otherwise, images are serialized in memory. If
+    more than one process is used, the image values, labels and pRF geometries
+    are copied into shared memory once and images are rendered by a pool of
+    worker processes.
+
+    The result is a generator of (file name, content) pairs that are returned
+    in the order of the given tasks as soon as they are available. The content
+    is None if images are written to the output directory.
+
+    Parameters
+    ----------
+    render_data : dict(string:(numpy.ndarray, list, list))
+        Dictionary of (values, labels, pRFs) triples keyed by image type
+    max_eccentricity : pint.Quantity
+        Maximum eccentricity of the cortical images
+    tasks : list((string, int, int))
+        List of (image type, image number, visual area) triples
+    output_dir : string, optional
+        Path to the directory where image files are written
+    processes : int, optional
+        Number of rendering processes. Uses one process per CPU if the value is
+        smaller than one.
+
+    Returns
+    -------
+    generator((string, string))
+    """
+    if processes < 1:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    geometry = {}
+    for img_type in render_data:
+        values, labels, pRFs = render_data[img_type]
+        centers, radii = prf_geometry(pRFs)
+        geometry[img_type] = (values, labels, centers, radii)
+    if processes <= 1:
+        local_data = {}
+        for img_type in geometry:
+            values, labels, centers, radii = geometry[img_type]
+            local_data[img_type] = (values, labels, prf_list(centers, radii))
+        init_renderer(local_data, max_eccentricity, output_dir)
+        try:
+            for task in tasks:
+                yield render_image(task)
+        finally:
+            init_renderer(None, None, None)
+        return
+    shared_data = {}
+    for img_type in geometry:
+        values, labels, centers, radii = geometry[img_type]
+        shared_data[img_type] = (
+            SharedArray(values),
+            SharedArray(labels),
+            SharedArray(centers),
+            SharedArray(radii)
+        )
+    pool = multiprocessing.Pool(
+        processes,
+        initializer=init_shared_renderer,
+        initargs=(shared_data, max_eccentricity, output_dir)
+    )
+    try:
+        # Pool.imap returns results in the order of the given tasks
+        for result in pool.imap(render_image, tasks, chunksize=1):
+            yield result
+        pool.close()
+    finally:
+        # Stop the rendering processes if the caller stops consuming the
+        # results or the generator is interrupted (e.g., by CTRL+C)
+        pool.terminate()
+        pool.join()
+
+
+def render_image(task):
+    """Render a single cortical image using the render data of the current
+    process (see init_renderer()).
+
+    Parameters
+    ----------
+    task : (string, int, int)
+        Image type, image number, and visual area
+
+    Returns
+    -------
+    (string, string)
+        Name of the image file and the PNG content of the image. The content
+        is None if the image was written to the renderer's output directory.
+    """
+    img_type, imno, va = task
+    values, labels, pRFs = _renderer['data'][img_type]
+    prefix, options = IMAGE_TYPES[img_type]
+    img = sco.util.cortical_image(
+        values,
+        labels,
+        pRFs,
+        _renderer['max_eccentricity'],
+        visual_area=va,
+        image_number=imno,
+        **options
+    )
+    img_filename = cortical_image_filename(img_type, imno, va)
+    if _renderer['directory'] is None:
+        buf = io.BytesIO()
+        img.savefig(buf, format='png')
+        img_content = buf.getvalue()
+    else:
+        img.savefig(os.path.join(_renderer['directory'], img_filename))
+        img_content = None
+    img.clf()
+    return img_filename, img_content
+
+
+def add_tar_member(tar, name, content):
+    """Append a file with the given content to an open tar archive without
+    writing it to disk first.
+
+    Parameters
+    ----------
+    tar : tarfile.TarFile
+        Tar archive that is open for writing
+    name : string
+        Name of the archive member
+    content : string
+        File content
+    """
+    info = tarfile.TarInfo(name=name)
+    info.size = len(content)
+    info.mtime = time.time()
+    info.mode = 0644
+    tar.addfile(info, io.BytesIO(content))
+
+
+def cortical_image_filename(img_type, imno, va):
+    """Name of the file for a cortical image.
+
+    Parameters
+    ----------
+    img_type : string
+        Image type (FUNCTIONAL or PREDICTION)
+    imno : int
+        Image number
+    va : int
+        Visual area
+
+    Returns
+    -------
+    string
+    """
+    return IMAGE_TYPES[img_type][0] + str(imno) + '.v' + str(va) + '.png'
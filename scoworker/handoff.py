@@ -0,0 +1,148 @@
+"""Zero-copy hand-off of model run results to a co-located SCO data store. The
+data store copies the prediction file and the attachments of a model run into
+its own directory. If the worker writes its output into a staging area inside
+the data store directory (i.e., on the same file system) these copies can be
+replaced by hard links, i.e., every result file is written to disk only once.
+Result files are not modified after the hand-off. The data store and the
+staging area share the file content until the run directory in the staging
+area is removed.
+
+The data store has no interface for taking ownership of existing files and
+the paths of the copies are only known inside the data store. While the
+result files of a run are uploaded, the hand-off therefore replaces the
+shutil module that is used by the data store modules which copy run results
+with a stand-in that links the result files. The shutil module itself is not
+modified, i.e., copies in all other modules and copies of all other files
+are not affected.
+"""
+
+import importlib
+import os
+import shutil
+import sys
+import threading
+
+
+# Name of the staging area for run output directories inside the data store
+# directory
+STAGING_DIR = '.staging'
+
+# Data store modules that copy the prediction file and the attachments of
+# model runs into the data store directory
+DATASTORE_MODULES = ['scodata.funcdata', 'scodata.modelrun']
+
+
+class HandOff(object):
+    """Context for adding the result files of a model run to the data store.
+    Inside the context, the data store takes over the given files by hard
+    links instead of copies.
+    """
+    def __init__(self, filenames, modules=DATASTORE_MODULES):
+        """Initialize the list of result files.
+
+        Parameters
+        ----------
+        filenames : list(string)
+            Paths to result files that are handed off to the data store
+        modules : list(string), optional
+            Names of the modules that copy the result files
+        """
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        self.modules = modules
+
+    def __enter__(self):
+        if len(self.filenames) == 0:
+            return self
+        with _handoff_lock:
+            for filename in self.filenames:
+                _handoff_files[filename] = _handoff_files.get(filename, 0) + 1
+            for name in self.modules:
+                _handoff_modules[name] = _handoff_modules.get(name, 0) + 1
+                importlib.import_module(name).shutil = _handoff_shutil
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if len(self.filenames) == 0:
+            return False
+        with _handoff_lock:
+            for filename in self.filenames:
+                _handoff_files[filename] -= 1
+                if _handoff_files[filename] == 0:
+                    del _handoff_files[filename]
+            for name in self.modules:
+                _handoff_modules[name] -= 1
+                if _handoff_modules[name] == 0:
+                    del _handoff_modules[name]
+                    sys.modules[name].shutil = shutil
+        return False
+
+
+class HandOffShutil(object):
+    """Stand-in for the shutil module in the data store modules while result
+    files are handed off. Links handed off files in copyfile() and delegates
+    everything else to shutil.
+    """
+    def __getattr__(self, name):
+        return getattr(shutil, name)
+
+    def copyfile(self, src, dst):
+        handoff_copyfile(src, dst)
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+# Reference counts for result files that are currently handed off to the data
+# store keyed by file path and for modules that use the shutil stand-in keyed
+# by module name
+_handoff_files = {}
+_handoff_modules = {}
+_handoff_lock = threading.Lock()
+
+# Stand-in for shutil in the data store modules
+_handoff_shutil = HandOffShutil()
+
+
+def handoff_copyfile(src, dst):
+    """Copy function of the shutil stand-in while result files are handed off.
+    Creates a hard link for result files that are handed off and copies all
+    other files. Falls back to copying if the link cannot be created (e.g.,
+    if source and target are on different file systems).
+
+    Parameters
+    ----------
+    src : string
+        Path to existing file
+    dst : string
+        Path to new file
+    """
+    with _handoff_lock:
+        handoff = os.path.abspath(src) in _handoff_files
+    if handoff:
+        if os.path.isfile(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def staging_directory(data_dir):
+    """Path to the staging area for run output directories inside the data
+    store directory.
+
+    Parameters
+    ----------
+    data_dir : string
+        Path to data store directory
+
+    Returns
+    -------
+    string
+    """
+    return os.path.join(data_dir, STAGING_DIR)
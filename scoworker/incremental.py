@@ -0,0 +1,285 @@
+"""Incremental re-runs for image groups that change slightly. The incremental
+cache keeps the per-image results of completed runs, i.e., the prediction
+column and the cortical prediction images of each stimulus, keyed by the run
+context (model, subject, functional data, and arguments) and the content hash
+of the image file. A re-run with the same context only computes and renders
+the stimuli that have no cached result and merges the new results with the
+cached ones.
+
+Assumes that the predicted response of a stimulus does not depend on the
+other stimuli of the image group.
+"""
+
+import logging
+import os
+import tarfile
+
+import nibabel as nib
+import numpy as np
+
+from cache import hash_files, hash_values
+from cortical import cortical_image_filename
+from plans import canonical_value
+from registry import model_signature
+
+
+# Name of the file that contains the prediction column of a stimulus
+COLUMN_FILE = 'prediction.npy'
+
+# Name of the file that contains the cortical prediction image of a stimulus
+# for a given visual area
+IMAGE_FILE = 'v%d.png'
+
+# Visual areas that cortical images are rendered for
+VISUAL_AREAS = [1, 2, 3]
+
+
+class IncrementalCache(object):
+    """Per-image results of completed model runs that are kept in a
+    DiskCache. Each entry contains the prediction column and the cortical
+    prediction images of a single stimulus.
+    """
+    def __init__(self, cache):
+        """Initialize the disk cache.
+
+        Parameters
+        ----------
+        cache : scoworker.cache.DiskCache
+            Cache for per-image results
+        """
+        self.cache = cache
+
+    def get(self, key):
+        """Get the cached result for a single stimulus. The result is read
+        into memory to ensure that it remains available even if the entry is
+        evicted during the run.
+
+        Parameters
+        ----------
+        key : string
+            Entry key
+
+        Returns
+        -------
+        numpy.ndarray, dict
+            Prediction column and cortical image content for each visual area
+            or None if no result for the given key exists
+        """
+        path = self.cache.get(key)
+        if path is None:
+            return None
+        try:
+            column = np.load(os.path.join(path, COLUMN_FILE))
+            images = dict()
+            for va in VISUAL_AREAS:
+                with open(os.path.join(path, IMAGE_FILE % (va)), 'rb') as f:
+                    images[va] = f.read()
+        except (IOError, OSError, ValueError) as ex:
+            # Remove incomplete or corrupted entries
+            logging.exception(ex)
+            self.cache.remove(key)
+            return None
+        return column, images
+
+    def prepare(self, model_def, subject, fmri_data, args, image_files):
+        """Get the cached results for the stimuli of a model run.
+
+        Parameters
+        ----------
+        model_def : scoengine.ModelHandle
+            Descriptor for SCO model
+        subject : SubjectHandle
+            Handle for subject
+        fmri_data : FMRIDataHandle
+            Handle for functional data (may be None)
+        args : dict
+            Converted image group options and model run arguments
+        image_files : list(string)
+            Paths to the image files of the image group
+
+        Returns
+        -------
+        scoworker.incremental.IncrementalRun
+        """
+        context = hash_values(
+            model_signature(model_def),
+            subject.identifier,
+            fmri_data.identifier if not fmri_data is None else None,
+            canonical_value(args)
+        )
+        keys = [hash_values(context, h) for h in hash_files(image_files)]
+        entries = dict()
+        for i, key in enumerate(keys):
+            entry = self.get(key)
+            if not entry is None:
+                entries[i] = entry
+        return IncrementalRun(self, keys, entries)
+
+    def put(self, key, column, images):
+        """Add the result for a single stimulus to the cache.
+
+        Parameters
+        ----------
+        key : string
+            Entry key
+        column : numpy.ndarray
+            Prediction column (one value per cortex voxel)
+        images : dict
+            Cortical image content for each visual area
+        """
+        def write_result(directory):
+            np.save(os.path.join(directory, COLUMN_FILE), column)
+            for va in images:
+                with open(os.path.join(directory, IMAGE_FILE % (va)), 'wb') as f:
+                    f.write(images[va])
+        self.cache.put(key, write_result)
+
+
+class IncrementalRun(object):
+    """Cached and new stimuli of a model run.
+
+    Attributes
+    ----------
+    cache : scoworker.incremental.IncrementalCache
+        Cache that the run results are added to
+    keys : list(string)
+        Entry keys for all stimuli of the image group
+    entries : dict
+        Prediction column and cortical images of the cached stimuli (by image
+        number)
+    new : list(int)
+        Numbers of the images that are computed by the model
+    """
+    def __init__(self, cache, keys, entries):
+        """Initialize the run information.
+
+        Parameters
+        ----------
+        cache : scoworker.incremental.IncrementalCache
+            Cache that the run results are added to
+        keys : list(string)
+            Entry keys for all stimuli of the image group
+        entries : dict
+            Prediction column and cortical images of the cached stimuli
+        """
+        self.cache = cache
+        self.keys = keys
+        self.entries = entries
+        self.new = [i for i in range(len(keys)) if not i in entries]
+        # The model is run on at least one image
+        if len(self.new) == 0 and len(keys) > 0:
+            self.new = [0]
+            del self.entries[0]
+        logging.info(
+            'Incremental run: %d of %d stimuli cached' % (len(self.entries), len(keys))
+        )
+
+    def cached_images(self):
+        """Content of the cortical prediction images of all cached stimuli.
+
+        Returns
+        -------
+        dict
+            Image content by file name (as used in the cortical image tar)
+        """
+        images = dict()
+        for imno in self.entries:
+            content = self.entries[imno][1]
+            for va in VISUAL_AREAS:
+                images[cortical_image_filename('PREDICTION', imno, va)] = content[va]
+        return images
+
+    def merge(self, prediction):
+        """Merge the prediction matrix for the new stimuli with the cached
+        prediction columns.
+
+        Parameters
+        ----------
+        prediction : numpy.ndarray
+            Prediction matrix for the new stimuli (one row per cortex voxel and
+            one column per new image)
+
+        Returns
+        -------
+        numpy.ndarray
+            Prediction matrix for all stimuli
+        """
+        prediction = np.asarray(prediction)
+        if prediction.shape[1] != len(self.new):
+            raise ValueError('invalid prediction shape: ' + str(prediction.shape))
+        result = np.zeros(
+            (prediction.shape[0], len(self.keys)),
+            dtype=prediction.dtype
+        )
+        result[:, self.new] = prediction
+        for imno in self.entries:
+            column = self.entries[imno][0]
+            if column.shape != (prediction.shape[0],):
+                raise ValueError('invalid cached prediction: ' + self.keys[imno])
+            result[:, imno] = column
+        return result
+
+    def stimulus(self, image_files):
+        """Image files that are computed by the model.
+
+        Parameters
+        ----------
+        image_files : list(string)
+            Paths to the image files of the image group
+
+        Returns
+        -------
+        list(string)
+        """
+        return [image_files[i] for i in self.new]
+
+    def update(self, prediction, tar_filename):
+        """Add the results of the new stimuli to the cache.
+
+        Parameters
+        ----------
+        prediction : numpy.ndarray
+            Prediction matrix for all stimuli
+        tar_filename : string
+            Path to the cortical image tar file of the run
+        """
+        tar = tarfile.open(tar_filename, 'r')
+        try:
+            for imno in self.new:
+                images = dict()
+                for va in VISUAL_AREAS:
+                    member = tar.extractfile(
+                        cortical_image_filename('PREDICTION', imno, va)
+                    )
+                    images[va] = member.read()
+                self.cache.put(self.keys[imno], prediction[:, imno], images)
+        finally:
+            tar.close()
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def merge_prediction_file(filename, cortex_indices, prediction):
+    """Replace the content of an exported prediction file by the given
+    prediction matrix. The exported file is used as template for the volume
+    geometry. Voxels outside the cortex are set to zero.
+
+    Parameters
+    ----------
+    filename : string
+        Path to prediction file (NIfTI format)
+    cortex_indices : numpy.ndarray
+        Volume indices of the cortex voxels
+    prediction : numpy.ndarray
+        Prediction matrix (one row per cortex voxel and one column per image)
+    """
+    img = nib.load(filename)
+    prediction = np.asarray(prediction)
+    idcs = np.asarray(cortex_indices, dtype=np.intp).reshape(-1, 3)
+    volume = np.zeros(img.shape[:3] + (prediction.shape[1],), dtype=prediction.dtype)
+    volume[idcs[:, 0], idcs[:, 1], idcs[:, 2], :] = prediction
+    nib.Nifti1Image(volume, img.affine, img.header).to_filename(filename)
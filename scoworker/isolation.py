@@ -0,0 +1,153 @@
+"""Execution of model runs in disposable child processes. Memory that is
+allocated during a run (figures, cached values, large arrays) is reclaimed
+when the child exits. The worker monitors the resident memory of the child
+(and its descendants) and the wall time of the run, and kills the child if
+one of the limits is exceeded. The error is raised in the worker, i.e., it is
+reported like any other error of the model run.
+"""
+
+import logging
+import multiprocessing
+import resource
+import time
+
+from supervisor import kill_process_tree, process_memory
+
+
+# Interval for checking memory usage and wall time of a run (in seconds)
+MONITOR_INTERVAL = 0.5
+
+
+class RunLimits(object):
+    """Resource limits for a model run that is executed in a child process.
+
+    Attributes
+    ----------
+    max_memory : int
+        Maximum resident memory of the child and its descendants (in bytes).
+        Unlimited if None.
+    timeout : float
+        Maximum wall time of the run (in seconds). Unlimited if None.
+    """
+    def __init__(self, max_memory=None, timeout=None):
+        """Initialize the limits.
+
+        Parameters
+        ----------
+        max_memory : int, optional
+            Maximum resident memory (in bytes)
+        timeout : float, optional
+            Maximum wall time (in seconds)
+        """
+        self.max_memory = max_memory
+        self.timeout = timeout
+
+
+class RunLimitExceeded(Exception):
+    """Exception that is raised if a model run exceeds one of its limits."""
+    pass
+
+
+def run_isolated(func, limits=None, metrics=None):
+    """Evaluate a function in a child process and return its result. The
+    result and any exception that is raised by the function are passed back to
+    the calling process (both have to be picklable).
+
+    Parameters
+    ----------
+    func : callable
+        Function without arguments
+    limits : scoworker.isolation.RunLimits, optional
+        Resource limits for the child process
+    metrics : scoworker.metrics.Metrics, optional
+        Collection of metrics. The peak memory of the child is recorded as
+        'peak_memory'.
+
+    Returns
+    -------
+    any
+        Result of the function
+    """
+    if limits is None:
+        limits = RunLimits()
+    conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=run_child,
+        args=(func, child_conn)
+    )
+    # The child has to be able to start its own processes (e.g., to render
+    # cortical images)
+    process.daemon = False
+    start = time.time()
+    process.start()
+    child_conn.close()
+    peak_memory = 0
+    message = None
+    violation = None
+    try:
+        while True:
+            if conn.poll(MONITOR_INTERVAL):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    pass
+                break
+            if not process.is_alive():
+                break
+            memory = process_memory(process.pid)
+            peak_memory = max(peak_memory, memory)
+            if not limits.max_memory is None and memory > limits.max_memory:
+                violation = 'memory limit exceeded (%d MB)' % (memory / (1024 * 1024))
+            elif not limits.timeout is None and time.time() - start > limits.timeout:
+                violation = 'time limit exceeded (%d s)' % (limits.timeout)
+            if not violation is None:
+                kill_process_tree(process.pid)
+                break
+    finally:
+        process.join()
+        conn.close()
+    if not message is None:
+        status, value, child_peak_memory = message
+        peak_memory = max(peak_memory, child_peak_memory)
+    logging.info('Peak memory of run: %.1f MB' % (peak_memory / (1024.0 * 1024.0)))
+    if not metrics is None:
+        metrics.observe('peak_memory', peak_memory)
+    if not violation is None:
+        raise RunLimitExceeded(violation)
+    if message is None:
+        raise RuntimeError(
+            'model run process terminated unexpectedly (exit code ' + str(process.exitcode) + ')'
+        )
+    if status == 'error':
+        raise value
+    return value
+
+
+def run_child(func, conn):
+    """Evaluate a function and send the result (or the raised exception)
+    together with the peak memory usage of the process and its children to
+    the parent.
+
+    Parameters
+    ----------
+    func : callable
+        Function without arguments
+    conn : multiprocessing.Connection
+        Child end of the pipe to the parent
+    """
+    try:
+        message = ('ok', func())
+    except Exception as ex:
+        logging.exception(ex)
+        message = ('error', ex)
+    # Maximum resident set size is given in kilobytes on Linux
+    peak_memory = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) * 1024
+    try:
+        conn.send(message + (peak_memory,))
+    except Exception as ex:
+        # The exception cannot be pickled
+        conn.send(('error', RuntimeError(str(message[1])), peak_memory))
+    conn.close()
@@ -0,0 +1,101 @@
+"""Simple in-process metrics for workers. Metrics are named series of
+observed values (e.g., wall time of a workflow stage). For each metric the
+number of observations, the total, the last, and the maximum value are kept.
+"""
+
+import threading
+import time
+
+
+class Metrics(object):
+    """Thread-safe collection of named metrics."""
+    def __init__(self):
+        """Initialize the (empty) collection."""
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Get summary of the observations for a metric.
+
+        Parameters
+        ----------
+        name : string
+            Metric name
+
+        Returns
+        -------
+        dict
+            Dictionary with keys 'count', 'total', 'last', and 'max' or None
+            if no value has been observed for the metric
+        """
+        with self.lock:
+            if not name in self.values:
+                return None
+            return dict(self.values[name])
+
+    def observe(self, name, value):
+        """Add an observed value for a metric.
+
+        Parameters
+        ----------
+        name : string
+            Metric name
+        value : float
+            Observed value
+        """
+        with self.lock:
+            if name in self.values:
+                entry = self.values[name]
+                entry['count'] += 1
+                entry['total'] += value
+                entry['last'] = value
+                entry['max'] = max(entry['max'], value)
+            else:
+                self.values[name] = {
+                    'count' : 1,
+                    'total' : value,
+                    'last' : value,
+                    'max' : value
+                }
+
+    def timer(self, name):
+        """Context manager that observes the wall time (in seconds) of the
+        enclosed block for a metric.
+
+        Parameters
+        ----------
+        name : string
+            Metric name
+
+        Returns
+        -------
+        Timer
+        """
+        return Timer(self, name)
+
+
+class Timer(object):
+    """Context manager that measures wall time."""
+    def __init__(self, metrics, name):
+        """Initialize the metric that the wall time is added to.
+
+        Parameters
+        ----------
+        metrics : Metrics
+            Collection of metrics
+        name : string
+            Metric name
+        """
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.start
+        self.metrics.observe(self.name, self.elapsed)
+        return False
@@ -0,0 +1,141 @@
+"""Staged execution of model runs. A pipeline consists of a sequence of stages
+(e.g., fetch, compute, render, and upload) that are connected by bounded
+queues. Each stage runs in its own thread, i.e., the stages of consecutive
+model runs overlap: while the model for one run is computed, the resources for
+the next run are fetched and the results of the previous run are uploaded.
+
+The size of the queues (pipeline depth) limits the number of runs that are
+waiting in front of each stage. Submitting a run blocks while the queue of the
+first stage is full.
+"""
+
+import logging
+import Queue
+import threading
+
+
+# Marker that is passed through the pipeline when the pipeline is closed
+END_OF_QUEUE = None
+
+
+class Pipeline(object):
+    """Sequence of stages that are connected by bounded queues. A stage is a
+    function that takes a job and returns the job for the next stage. If a
+    stage returns None the job is dropped (e.g., because the stage handled an
+    error). If a stage raises an exception the failure handler is called and
+    the job is dropped. An optional callback is called for each job when it
+    leaves the pipeline.
+    """
+    def __init__(self, stages, depth=1, on_failure=None, metrics=None):
+        """Initialize the queues and start one thread per stage.
+
+        Parameters
+        ----------
+        stages : list((string, callable))
+            List of stage names and stage functions
+        depth : int, optional
+            Maximum number of jobs that wait in front of each stage
+        on_failure : callable, optional
+            Function that is called with the stage name, the job, and the
+            exception if a stage fails
+        metrics : scoworker.metrics.Metrics, optional
+            Collection of metrics for the wall time of each stage (metric
+            name is 'stage.' followed by the stage name)
+        """
+        if len(stages) == 0:
+            raise ValueError('empty pipeline')
+        if depth < 1:
+            raise ValueError('invalid pipeline depth: ' + str(depth))
+        self.stages = stages
+        self.depth = depth
+        self.on_failure = on_failure
+        self.metrics = metrics
+        self.queues = [Queue.Queue(maxsize=depth) for stage in stages]
+        self.threads = []
+        for i in range(len(stages)):
+            thread = threading.Thread(
+                target=self.run_stage,
+                args=(i,),
+                name='stage-' + stages[i][0]
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def capacity(self):
+        """Maximum number of jobs in the pipeline (waiting in the queues or
+        being processed by a stage).
+
+        Returns
+        -------
+        int
+        """
+        return len(self.stages) * (self.depth + 1)
+
+    def close(self):
+        """Wait for all submitted jobs to finish and stop the stage threads."""
+        self.queues[0].put(END_OF_QUEUE)
+        for thread in self.threads:
+            thread.join()
+
+    def run_stage(self, index):
+        """Process jobs in the input queue of the stage with the given index
+        until the end of the queue is reached.
+
+        Parameters
+        ----------
+        index : int
+            Stage index
+        """
+        name, func = self.stages[index]
+        queue = self.queues[index]
+        if index < len(self.stages) - 1:
+            next_queue = self.queues[index + 1]
+        else:
+            next_queue = None
+        while True:
+            item = queue.get()
+            if item is END_OF_QUEUE:
+                if not next_queue is None:
+                    next_queue.put(END_OF_QUEUE)
+                break
+            job, callback = item
+            try:
+                if not self.metrics is None:
+                    with self.metrics.timer('stage.' + name):
+                        job = func(job)
+                else:
+                    job = func(job)
+            except Exception as ex:
+                logging.exception(ex)
+                if not self.on_failure is None:
+                    try:
+                        self.on_failure(name, job, ex)
+                    except Exception as ex:
+                        logging.exception(ex)
+                job = None
+            if not job is None and not next_queue is None:
+                next_queue.put((job, callback))
+            elif not callback is None:
+                # The job is done (completed, dropped, or failed)
+                try:
+                    callback()
+                except Exception as ex:
+                    logging.exception(ex)
+
+    def submit(self, job, callback=None):
+        """Add a job to the input queue of the first stage. Blocks while the
+        queue is full.
+
+        Parameters
+        ----------
+        job : any
+            Input for the first stage
+        callback : callable, optional
+            Function without arguments that is called (in the thread of the
+            respective stage) when the job leaves the pipeline, i.e., when the
+            last stage is done or when the job was dropped or failed
+        """
+        if job is END_OF_QUEUE:
+            raise ValueError('invalid job')
+        self.queues[0].put((job, callback))
@@ -0,0 +1,687 @@
+"""Helper methods to analyze and modify the pimms calculation plans of SCO
+models, and caches for intermediate values of model runs.
+
+An SCO model is a pimms plan, i.e., a graph of calculation nodes. Each node
+computes one or more (efferent) values from model parameters and values of
+other nodes. Values of nodes that only depend on a subset of the model
+parameters (e.g., only on the subject) can be reused by all runs that share
+the values of these parameters. Reuse is implemented by replacing these nodes
+with nodes that return the previously computed values (see freeze_nodes()).
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+import pimms
+
+from cache import hash_directory, hash_files, hash_values
+from registry import model_signature
+
+
+# Suffix for files that contain pickled node values and numpy arrays
+VALUE_FILE_SUFFIX = '.pp'
+ARRAY_FILE_SUFFIX = '.npy'
+
+# Model parameters that identify the subject of a model run
+SUBJECT_AFFERENTS = ('subject',)
+
+# Model parameters that identify the stimulus images of a model run
+STIMULUS_AFFERENTS = ('stimulus',)
+
+# Model parameters that are specific to individual runs. Nodes that depend on
+# these parameters are never cached.
+RUN_AFFERENTS = ('output_directory', 'measurements_filename')
+
+# Model parameters of nodes that write output files. Values of nodes that
+# depend on these parameters are never shared between runs.
+OUTPUT_AFFERENTS = ('output_directory',)
+
+
+def canonical_value(value):
+    """String representation of a model parameter value that is independent
+    of dictionary key order.
+
+    Parameters
+    ----------
+    value : any
+        Model parameter value
+
+    Returns
+    -------
+    string
+    """
+    return json.dumps(value, sort_keys=True, default=repr)
+
+
+def computed_values(data, nodes):
+    """Get the values of the given nodes that have already been computed for a
+    model run. Values of nodes where not all efferent values have been
+    computed are ignored.
+
+    Parameters
+    ----------
+    data : pimms.IMap
+        Model output
+    nodes : list(string)
+        Names of plan nodes
+
+    Returns
+    -------
+    dict(string:dict(string:any))
+        Dictionary of efferent values keyed by node name
+    """
+    efferents = getattr(data, 'efferents', {})
+    plan_nodes = data.plan.nodes
+    values = {}
+    for name in nodes:
+        effs = plan_nodes[name].efferents
+        if len(effs) > 0 and all([eff in efferents for eff in effs]):
+            values[name] = {eff : efferents[eff] for eff in effs}
+    return values
+
+
+def constant_calc(values):
+    """Calculation node without parameters that returns the given values.
+
+    Parameters
+    ----------
+    values : dict(string:any)
+        Dictionary of efferent values
+
+    Returns
+    -------
+    pimms.Calc
+    """
+    efferents = tuple(sorted(values.keys()))
+    values = dict(values)
+    def constant_values():
+        return values
+    # Disable memoization. The memoization key of a node is its function name
+    # and all constant nodes share the same function name.
+    return pimms.calc(*efferents, memoize=False)(constant_values)
+
+
+def freeze_nodes(plan, values):
+    """Create a copy of the given plan where all nodes whose efferent values
+    are contained in the given dictionary are replaced by nodes that return
+    these values.
+
+    Parameters
+    ----------
+    plan : pimms.Plan
+        SCO model
+    values : dict(string:any)
+        Dictionary of efferent values
+
+    Returns
+    -------
+    pimms.Plan
+    """
+    nodes = dict(plan.nodes)
+    for name in plan.nodes:
+        effs = plan.nodes[name].efferents
+        if len(effs) > 0 and all([eff in values for eff in effs]):
+            nodes[name] = constant_calc({eff : values[eff] for eff in effs})
+    return pimms.plan(nodes)
+
+
+def dependent_nodes(plan, afferents, excluded=()):
+    """Get the names of all lazy plan nodes that depend on at least one of the
+    given model parameters but on none of the excluded parameters.
+
+    Parameters
+    ----------
+    plan : pimms.Plan
+        SCO model
+    afferents : list(string)
+        Names of model parameters
+    excluded : list(string), optional
+        Names of excluded model parameters
+
+    Returns
+    -------
+    list(string)
+    """
+    afferents = set(afferents)
+    excluded = set(excluded)
+    nodes = []
+    for name in plan.nodes:
+        node = plan.nodes[name]
+        if not node.lazy or len(node.efferents) == 0:
+            continue
+        deps = node_afferents(plan, node)
+        if len(deps.intersection(afferents)) > 0 and len(deps.intersection(excluded)) == 0:
+            nodes.append(name)
+    return sorted(nodes)
+
+
+def is_plain_array(value):
+    """Test if a value is a numpy array that can be stored in .npy format
+    without pickling.
+
+    Parameters
+    ----------
+    value : any
+
+    Returns
+    -------
+    bool
+    """
+    return type(value) is np.ndarray and not value.dtype.hasobject
+
+
+def load_values(directory):
+    """Load node values from a directory that was written by save_values().
+    Numpy arrays are memory-mapped copy-on-write, i.e., the model may modify
+    the arrays without changing the cached files.
+
+    Parameters
+    ----------
+    directory : string
+        Path to directory
+
+    Returns
+    -------
+    dict(string:any)
+        Dictionary of efferent values
+    """
+    values = {}
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if filename.endswith(VALUE_FILE_SUFFIX):
+            eff = filename[:-len(VALUE_FILE_SUFFIX)]
+            values[eff] = pimms.load(path)
+        elif filename.endswith(ARRAY_FILE_SUFFIX):
+            eff = filename[:-len(ARRAY_FILE_SUFFIX)]
+            values[eff] = np.load(path, mmap_mode='c')
+    return values
+
+
+def node_afferents(plan, node):
+    """Get the names of all model parameters that a plan node depends on
+    (directly or via other nodes).
+
+    Parameters
+    ----------
+    plan : pimms.Plan
+        SCO model
+    node : pimms.Calc
+        Plan node
+
+    Returns
+    -------
+    set(string)
+    """
+    plan_afferents = set(plan.afferents)
+    deps = set()
+    for aff in node.afferents:
+        deps.add(aff)
+        deps.update(plan.dependencies.get(aff, ()))
+    return deps.intersection(plan_afferents)
+
+
+def node_signatures(plan, args, excluded=OUTPUT_AFFERENTS):
+    """Get signatures for the lazy nodes of a plan. Nodes of different plans
+    (e.g., of different models) that have the same signature compute the same
+    values, i.e., they apply the same calculation function to the same model
+    parameter values and to values of upstream nodes with the same
+    signatures. Nodes that depend on any of the excluded parameters have no
+    signature.
+
+    Parameters
+    ----------
+    plan : pimms.Plan
+        SCO model
+    args : dict
+        Model run arguments
+    excluded : list(string), optional
+        Names of excluded model parameters
+
+    Returns
+    -------
+    dict(string:string)
+        Signatures keyed by node name
+    """
+    # Node that computes each efferent value
+    producers = {}
+    for name in plan.nodes:
+        for eff in plan.nodes[name].efferents:
+            producers[eff] = name
+    signatures = {}
+    def signature(name):
+        if name in signatures:
+            return signatures[name]
+        node = plan.nodes[name]
+        values = [node.name, id(node.function), ','.join(sorted(node.efferents))]
+        for aff in sorted(node.afferents):
+            if aff in excluded:
+                values = None
+            elif aff in producers:
+                upstream = signature(producers[aff])
+                if upstream is None:
+                    values = None
+                else:
+                    values.append(aff + ':' + upstream)
+            elif aff in args:
+                values.append(aff + '=' + canonical_value(args[aff]))
+            else:
+                values.append(aff + '=' + canonical_value(plan.defaults.get(aff)))
+            if values is None:
+                break
+        signatures[name] = hash_values(*values) if not values is None else None
+        return signatures[name]
+    result = {}
+    for name in plan.nodes:
+        node = plan.nodes[name]
+        if node.lazy and len(node.efferents) > 0 and not signature(name) is None:
+            result[name] = signatures[name]
+    return result
+
+
+def save_values(directory, values):
+    """Write node values to the given directory. Each efferent value is
+    written to a separate file. Numpy arrays (that do not contain objects)
+    are written in .npy format that can be memory-mapped. All other values are
+    pickled. Values of nodes that cannot be written (e.g., because they cannot
+    be pickled) are skipped.
+
+    Parameters
+    ----------
+    directory : string
+        Path to directory
+    values : dict(string:dict(string:any))
+        Dictionary of efferent values keyed by node name
+    """
+    for name in values:
+        filenames = []
+        try:
+            for eff in values[name]:
+                value = values[name][eff]
+                if is_plain_array(value):
+                    filename = os.path.join(directory, eff + ARRAY_FILE_SUFFIX)
+                    filenames.append(filename)
+                    np.save(filename, value)
+                else:
+                    filename = os.path.join(directory, eff + VALUE_FILE_SUFFIX)
+                    filenames.append(filename)
+                    pimms.save(filename, value)
+        except Exception as ex:
+            logging.info('Cannot cache values of node ' + name + ': ' + str(ex))
+            for filename in filenames:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+
+def value_signature(plan, signatures, args, names):
+    """Get a signature for a list of efferent values and model parameters.
+    Efferent values are represented by the signatures of the nodes that
+    compute them and model parameters by their values.
+
+    Parameters
+    ----------
+    plan : pimms.Plan
+        SCO model
+    signatures : dict(string:string)
+        Node signatures as returned by node_signatures()
+    args : dict
+        Model run arguments
+    names : list(string)
+        Names of efferent values and model parameters
+
+    Returns
+    -------
+    string
+        Signature or None if any of the efferent values has no signature
+    """
+    producers = {}
+    for name in plan.nodes:
+        for eff in plan.nodes[name].efferents:
+            producers[eff] = name
+    values = []
+    for name in names:
+        if name in producers:
+            if not producers[name] in signatures:
+                return None
+            values.append(name + ':' + signatures[producers[name]])
+        elif name in args:
+            values.append(name + '=' + canonical_value(args[name]))
+        else:
+            values.append(name + '=' + canonical_value(plan.defaults.get(name)))
+    return hash_values(*values)
+
+
+# ------------------------------------------------------------------------------
+#
+# Caches for intermediate values
+#
+# ------------------------------------------------------------------------------
+
+class PlanCache(object):
+    """Cache for the values of plan nodes that depend on a given subset of the
+    model parameters (e.g., the subject) but not on any of the excluded
+    parameters (e.g., the stimulus images). Values are kept in a DiskCache.
+    The cache key is derived from a base key that is computed by the caller
+    and the values of all other model parameters that the cached nodes depend
+    on.
+    """
+    def __init__(self, cache, afferents, excluded=()):
+        """Initialize the disk cache and the sets of model parameters.
+
+        Parameters
+        ----------
+        cache : scoworker.cache.DiskCache
+            Cache for node values
+        afferents : list(string)
+            Names of model parameters that are represented by the base key
+        excluded : list(string), optional
+            Names of model parameters whose dependent nodes are not cached
+        """
+        self.cache = cache
+        self.afferents = afferents
+        self.excluded = excluded
+
+    def prepare(self, plan, key, args):
+        """Prepare a model run. If the cache contains values for the given key,
+        a copy of the plan is returned where the cached nodes are replaced by
+        their values. Otherwise, the plan is returned unchanged together with a
+        pending cache entry that is passed to update() after the run.
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+        key : string
+            Base key for the values of the model parameters in afferents
+        args : dict
+            Model run arguments
+
+        Returns
+        -------
+        pimms.Plan, PendingEntry
+        """
+        nodes = dependent_nodes(plan, self.afferents, excluded=self.excluded)
+        if len(nodes) == 0:
+            return plan, None
+        # Add values of all other parameters that the cached nodes depend on
+        # to the key. Parameters that are not given use their default values,
+        # which are defined by the model.
+        params = set()
+        for name in nodes:
+            params.update(node_afferents(plan, plan.nodes[name]))
+        key = hash_values(
+            key,
+            *[p + '=' + canonical_value(args[p]) for p in sorted(params) if p in args and not p in self.afferents]
+        )
+        path = self.cache.get(key)
+        if not path is None:
+            try:
+                values = load_values(path)
+                if len(values) > 0:
+                    return freeze_nodes(plan, values), None
+            except Exception as ex:
+                logging.exception(ex)
+                self.cache.remove(key)
+        return plan, PendingEntry(key, nodes)
+
+    def update(self, entry, data):
+        """Add values that were computed during a model run to the cache.
+
+        Parameters
+        ----------
+        entry : PendingEntry
+            Entry returned by prepare(). Nothing happens if None.
+        data : pimms.IMap
+            Model output
+        """
+        if entry is None:
+            return
+        values = computed_values(data, entry.nodes)
+        if len(values) > 0:
+            self.cache.put(entry.key, lambda d: save_values(d, values))
+
+
+class PendingEntry(object):
+    """Cache entry that is created after a model run.
+
+    Attributes
+    ----------
+    key : string
+        Cache key
+    nodes : list(string)
+        Names of the plan nodes whose values are cached
+    """
+    def __init__(self, key, nodes):
+        """Initialize the object attributes.
+
+        Parameters
+        ----------
+        key : string
+            Cache key
+        nodes : list(string)
+            Names of the plan nodes whose values are cached
+        """
+        self.key = key
+        self.nodes = nodes
+
+
+class SubjectCache(PlanCache):
+    """Cache for the values of plan nodes that depend on the subject of a
+    model run but not on the stimulus images (e.g., cortex indices, labels,
+    and pRF geometry). Entries are keyed by model signature, content hash of
+    the subject directory, and the values of the model options that the
+    cached nodes depend on.
+    """
+    def __init__(self, cache, afferents=SUBJECT_AFFERENTS, excluded=None):
+        """Initialize the disk cache and the sets of model parameters.
+
+        Parameters
+        ----------
+        cache : scoworker.cache.DiskCache
+            Cache for node values
+        afferents : list(string), optional
+            Names of model parameters that identify the subject
+        excluded : list(string), optional
+            Names of model parameters whose dependent nodes are not cached.
+            Defaults to the stimulus and run specific parameters.
+        """
+        if excluded is None:
+            excluded = ('stimulus',) + RUN_AFFERENTS
+        super(SubjectCache, self).__init__(cache, afferents, excluded=excluded)
+
+    def prepare_run(self, plan, model_def, subject_dir, args):
+        """Prepare a model run for the given model and subject (see
+        PlanCache.prepare()).
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+        model_def : scoengine.ModelHandle
+            Descriptor for SCO model
+        subject_dir : string
+            Path to subject directory
+        args : dict
+            Model run arguments
+
+        Returns
+        -------
+        pimms.Plan, PendingEntry
+        """
+        key = hash_values(model_signature(model_def), hash_directory(subject_dir))
+        return self.prepare(plan, key, args)
+
+
+class StimulusCache(PlanCache):
+    """Cache for preprocessed stimulus images, i.e., the values of plan nodes
+    that depend on the stimulus images but not on the subject. Entries are
+    keyed by model signature, content hashes of the image files, and the
+    values of the image options that the cached nodes depend on. Arrays are
+    stored in .npy format and memory-mapped when loaded.
+    """
+    def __init__(self, cache, afferents=STIMULUS_AFFERENTS, excluded=None):
+        """Initialize the disk cache and the sets of model parameters.
+
+        Parameters
+        ----------
+        cache : scoworker.cache.DiskCache
+            Cache for node values
+        afferents : list(string), optional
+            Names of model parameters that identify the stimulus images
+        excluded : list(string), optional
+            Names of model parameters whose dependent nodes are not cached.
+            Defaults to the subject and run specific parameters.
+        """
+        if excluded is None:
+            excluded = SUBJECT_AFFERENTS + RUN_AFFERENTS
+        super(StimulusCache, self).__init__(cache, afferents, excluded=excluded)
+
+    def prepare_run(self, plan, model_def, image_files, args):
+        """Prepare a model run for the given model and stimulus images (see
+        PlanCache.prepare()).
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+        model_def : scoengine.ModelHandle
+            Descriptor for SCO model
+        image_files : list(string)
+            List of image files (in order)
+        args : dict
+            Model run arguments
+
+        Returns
+        -------
+        pimms.Plan, PendingEntry
+        """
+        key = hash_values(model_signature(model_def), *hash_files(image_files))
+        return self.prepare(plan, key, args)
+
+
+class SharedValues(object):
+    """In-memory values of plan nodes that are shared by a group of runs of
+    the same model (e.g., a batch of runs for the same subject and image
+    group). Shared are the values of all nodes that do not depend on run
+    specific parameters or on any of the parameters whose values differ
+    between the runs of the group. The values are taken from the first run of
+    the group that completes.
+
+    Attributes
+    ----------
+    varying : set(string)
+        Names of model parameters whose dependent nodes are not shared
+    values : dict(string:any)
+        Dictionary of shared efferent values (None until the first run of
+        the group completes)
+    """
+    def __init__(self, varying=()):
+        """Initialize the set of varying model parameters.
+
+        Parameters
+        ----------
+        varying : list(string), optional
+            Names of model parameters whose values differ between the runs of
+            the group
+        """
+        self.varying = set(varying).union(RUN_AFFERENTS)
+        self.values = None
+
+    def prepare(self, plan):
+        """Get a copy of the plan where the shared nodes are replaced by their
+        values. Returns the plan unchanged if no values are available yet.
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+
+        Returns
+        -------
+        pimms.Plan
+        """
+        if self.values is None:
+            return plan
+        return freeze_nodes(plan, self.values)
+
+    def update(self, data):
+        """Keep the values of the shared nodes that were computed during a
+        model run. Nothing happens if values are available already.
+
+        Parameters
+        ----------
+        data : pimms.IMap
+            Model output
+        """
+        if not self.values is None:
+            return
+        plan = data.plan
+        nodes = dependent_nodes(plan, plan.afferents, excluded=self.varying)
+        values = {}
+        for node_values in computed_values(data, nodes).values():
+            values.update(node_values)
+        if len(values) > 0:
+            self.values = values
+
+
+class CommonValues(object):
+    """In-memory values of plan nodes that are shared by the runs of different
+    models (or of the same model with different arguments) for the same
+    inputs. Nodes are matched by their signature (see node_signatures()),
+    i.e., the value of a node is reused by every run whose plan contains a
+    node with the same signature. Values are taken from the first run that
+    computes them.
+
+    Attributes
+    ----------
+    values : dict(string:dict(string:any))
+        Dictionary of efferent values keyed by node signature
+    images : dict(string:dict(string:string))
+        Content of rendered cortical images by file name keyed by the
+        signature of the rendered values (see value_signature())
+    """
+    def __init__(self):
+        """Initialize the empty sets of values and images."""
+        self.values = dict()
+        self.images = dict()
+
+    def prepare(self, plan, signatures):
+        """Get a copy of the plan where all nodes with known values are
+        replaced by their values.
+
+        Parameters
+        ----------
+        plan : pimms.Plan
+            SCO model
+        signatures : dict(string:string)
+            Node signatures as returned by node_signatures()
+
+        Returns
+        -------
+        pimms.Plan
+        """
+        values = {}
+        for name in signatures:
+            if signatures[name] in self.values and name in plan.nodes:
+                values.update(self.values[signatures[name]])
+        if len(values) == 0:
+            return plan
+        logging.info('Reuse %d common value(s)' % (len(values)))
+        return freeze_nodes(plan, values)
+
+    def update(self, signatures, data):
+        """Keep the values of nodes that were computed during a model run.
+        Uses the same interface as PlanCache.update().
+
+        Parameters
+        ----------
+        signatures : dict(string:string)
+            Node signatures that were passed to prepare()
+        data : pimms.IMap
+            Model output
+        """
+        nodes = [n for n in signatures if not signatures[n] in self.values]
+        values = computed_values(data, nodes)
+        for name in values:
+            self.values[signatures[name]] = values[name]
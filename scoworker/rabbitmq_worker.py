@@ -5,14 +5,31 @@ RabbitMQ worker.
 import getopt
 import json
 import logging
+import os
 import pika
+import socket
 import sys
+import tempfile
 
 from scocli import SCOClient
 from scodata import SCODataStore
 from scodata.mongo import MongoDBFactory
 from scoengine import ModelRunRequest, SCOEngine
 from scoworker import SCODataStoreWorker, SCOClientWorker
+from scoworker.cache import DiskCache
+from scoworker.consumer import BatchDispatcher, Dispatcher, RequestConsumer
+from scoworker.isolation import RunLimits
+from scoworker.plans import StimulusCache, SubjectCache
+from scoworker.resources import ResourceCache
+from scoworker.checkpoints import CheckpointStore
+from scoworker.incremental import IncrementalCache
+from scoworker.results import ResultIndex
+from scoworker.routing import AffinityRouting
+from scoworker.handoff import staging_directory
+from scoworker.scratch import ScratchSpace
+from scoworker.uploads import UPLOAD_RETRIES, Uploader
+from scoworker.supervisor import POLL_INTERVAL, Supervisor
+from scoworker.zygote import preload
 
 
 # ------------------------------------------------------------------------------
@@ -24,6 +41,34 @@ from scoworker import SCODataStoreWorker, SCOClientWorker
 # Worker instance to handle model run request
 worker = None
 
+# Pipeline that executes the stages of consecutive model runs concurrently.
+# Requests are run one after another if None.
+pipeline = None
+
+# Supervisor for a pool of worker processes. Requests are run in the worker
+# process if None.
+supervisor = None
+
+# Maximum number of requests in a batch and maximum wait time for a batch to
+# fill up (in seconds). Requests are not batched if the batch size is one.
+batch_size = 1
+batch_wait = 0.0
+
+# Evaluate the runs of a batch for the same inputs in a single pass that
+# shares common plan nodes between models
+multi_model = False
+
+# Run each batch as a parameter sweep with the first request of the batch as
+# base run
+sweep = False
+
+# Maximum number of unacknowledged requests. Derived from the number of runs
+# that the worker can handle at the same time if None.
+prefetch = None
+
+# Number of bytes in a megabyte (cache sizes are given in MB)
+MEGABYTE = 1024 * 1024
+
 
 # ------------------------------------------------------------------------------
 #
@@ -32,26 +77,63 @@ worker = None
 # ------------------------------------------------------------------------------
 
 def callback(ch, method, properties, body):
-    """Callback handler for client requests. Uses local worker, i.e. expects to
-    be running on the same machine as the SCO data store.
+    """Callback handler for client requests. The blocking connection does not
+    answer heartbeats while a model run is executed in the connection thread.
+    Requests that are run by the local worker are therefore acknowledged on
+    receipt. Otherwise, the server would close the connection during long runs
+    and redeliver the request to another worker while the run is still
+    active. Use the asynchronous consumer (--async) to acknowledge requests
+    once the model run is done.
     """
-    # Acknowledge that message is received. NOTE: There seems to be an issue
-    # with redelivering messages when we have multiple workers. Thus, for now
-    # we acknowledge immediately
-    ch.basic_ack(delivery_tag = method.delivery_tag)
+    def acknowledge():
+        try:
+            ch.basic_ack(delivery_tag = method.delivery_tag)
+        except Exception as ex:
+            # The channel has been closed in the meantime. The request will be
+            # redelivered (and skipped if it has been completed).
+            logging.exception(ex)
     # Read model run request (expects Json object)
     try:
         request = ModelRunRequest.from_dict(json.loads(body))
     except Exception as ex:
         logging.exception(ex)
-        #ch.basic_ack(delivery_tag = method.delivery_tag)
+        acknowledge()
         return
-    # Request identifier for logging purposes
-    req_id = request.experiment_id + ':' + request.run_id
     # Run request using local worker
-    logging.info('Start model run [' + req_id + ']')
-    worker.run(request)
-    logging.info('Done [' + req_id + ']')
+    acknowledge()
+    run_request(request, lambda: None)
+
+
+def consume_requests(hostname, port, virtual_host, queue, user, password, affinity=None):
+    """Handle requests with an asynchronous consumer. Model runs are executed
+    outside of the I/O loop by a dispatcher thread. Runs until interrupted.
+    Uses subject-affinity routing if an affinity routing is given.
+    """
+    if batch_size > 1:
+        dispatcher = BatchDispatcher(run_batch, batch_size, batch_wait)
+    elif not supervisor is None:
+        dispatcher = Dispatcher(
+            supervisor.submit,
+            poll=supervisor.poll,
+            interval=POLL_INTERVAL
+        )
+    elif not pipeline is None:
+        dispatcher = Dispatcher(pipeline.submit)
+    else:
+        dispatcher = Dispatcher(run_request)
+    consumer = RequestConsumer(
+        pika.ConnectionParameters(
+            host=hostname,
+            port=port,
+            virtual_host=virtual_host,
+            credentials=pika.PlainCredentials(user, password)
+        ),
+        queue,
+        dispatcher,
+        prefetch=prefetch_count(),
+        affinity=affinity
+    )
+    consumer.run()
 
 
 def handle_requests(hostname, port, virtual_host, queue, user, password):
@@ -69,8 +151,9 @@ def handle_requests(hostname, port, virtual_host, queue, user, password):
     ))
     channel = con.channel()
     channel.queue_declare(queue=queue, durable=True)
-    # Fair dispatch. Never give a worker more than one message
-    channel.basic_qos(prefetch_count=1)
+    # Fair dispatch. Never give a worker more messages than it can handle at
+    # the same time.
+    channel.basic_qos(prefetch_count=prefetch_count())
     # Set callback handler to read requests and run the predictive model
     channel.basic_consume(callback, queue=queue)
     # Done. Start by waiting for requests
@@ -78,6 +161,55 @@ def handle_requests(hostname, port, virtual_host, queue, user, password):
     channel.start_consuming()
 
 
+def prefetch_count():
+    """Maximum number of unacknowledged requests. By default the number of
+    runs that the worker can handle at the same time.
+    """
+    if not prefetch is None:
+        count = prefetch
+    elif batch_size > 1:
+        count = batch_size
+    elif not supervisor is None:
+        count = supervisor.processes + 1
+    elif not pipeline is None:
+        count = pipeline.capacity()
+    else:
+        count = 1
+    logging.info('Prefetch : [' + str(count) + ']')
+    return count
+
+
+def run_batch(requests, callbacks):
+    """Run a batch of requests using the local worker. Calls all callbacks
+    when the batch is done.
+    """
+    logging.info('Start batch of %d model run(s)' % (len(requests)))
+    try:
+        if multi_model:
+            worker.run_models(requests)
+        elif sweep:
+            worker.run_sweep(requests)
+        else:
+            worker.run_batch(requests)
+    finally:
+        for callback in callbacks:
+            callback()
+    logging.info('Done batch')
+
+
+def run_request(request, callback):
+    """Run request using the local worker. Calls the callback when the run is
+    done.
+    """
+    req_id = request.experiment_id + ':' + request.run_id
+    logging.info('Start model run [' + req_id + ']')
+    try:
+        worker.run(request)
+    finally:
+        callback()
+    logging.info('Done [' + req_id + ']')
+
+
 if __name__ == '__main__':
     """Run the RabbitMQ worker. Usage:
 
@@ -87,15 +219,48 @@ if __name__ == '__main__':
     -----------
 
     -c, --port <port>         : Port that the RabbitMQ server is listening on (default: 5672)
+    --affinity                : Consume from a per-host queue of a consistent-hash exchange keyed by subject; use the shared queue only while idle (implies --async)
+    --async                   : Consume requests asynchronously (model runs do not block heartbeats; reconnects with backoff)
+    --batch= <K>              : Run up to K queued requests as a batch grouped by subject and image group (implies --async)
+    --batch-wait= <ms>        : Maximum wait time for a batch to fill up (default: 0)
+    --cache= <dir>            : Directory for local caches (default: no caching)
+    --checkpoints= <dir>      : Directory for checkpoints of model runs; restarted runs resume from their checkpoint (default: no checkpoints)
+    --subject-cache= <MB>     : Size budget of the subject cache in MB (default: 4096)
+    --stimulus-cache= <MB>    : Size budget of the stimulus image cache in MB (default: 4096)
+    --incremental             : Incremental re-runs that compute and render only stimuli without cached per-image results; assumes that the prediction for a stimulus does not depend on other stimuli (requires --cache)
+    --incremental-cache= <MB> : Size budget of the per-image result cache for incremental re-runs in MB (default: 4096)
+    --result-cache= <MB>      : Size budget of the result index in MB (default: 4096)
     -d, --data <data-dir>     : Path to data store directory or client cache (default '/tmp/sco')
+    --data-quota= <MB>        : Disk quota for resources in the client cache in MB (remote worker only, default: none)
     -e, --env= <subject_dir>  : Path to directory for average subject [mandatory]
+    --handoff                 : Stage run outputs in the data store directory and hand them off by hard links instead of copies (local worker only)
     -h, --host= <hostname>    : Name of host running RabbitMQ server (default: localhost)
+    --isolate                 : Run each model in a disposable child process
     -l, --log= <filename>     : Log file name (default: standard output)
+    --multi-model             : Evaluate the runs of a batch for the same subject, image group and functional data in a single pass that shares common plan nodes between models (requires --batch)
     -m, --mongodb= <db-name>  : Name of MongoDB database for local datastore worker (default: sco)
     -p, --password <pwd>      : RabbitMQ user password (default: '')
+    --pipeline= <depth>       : Run fetch, compute, render and upload stages of consecutive runs concurrently (default: 0 = off, implies --async and --render=1)
+    --prefetch= <N>           : Maximum number of unacknowledged requests (default: number of runs the worker can handle at once)
     -q, --queue= <quename>    : Name of RabbitMQ message queue (default: sco)
+    --render= <processes>     : Number of processes rendering cortical images (default: 1, 0 = one per CPU)
+    --run-memory= <MB>        : Memory limit for a model run (implies --isolate)
+    --run-timeout= <seconds>  : Time limit for a model run (implies --isolate)
+    --run-scratch= <MB>       : Scratch space for the output of a single run in MB (default: none)
     -s, --server <url>        : Url for SCO Web API server (only if remote worker is used)
+    --scratch= <dir>          : Root directory for run outputs (default: temporary directories without quotas)
+    --scratch-quota= <MB>     : Scratch space for the outputs of all runs in MB (default: none)
+    --sweep                   : Run each batch as a parameter sweep: runs with the same inputs as the first run of the batch share all plan nodes that do not depend on the arguments they differ in (requires --batch)
+    --tmpfs= <dir>            : Scratch root on tmpfs for the outputs of small runs (default: none)
+    --tmpfs-run-size= <MB>    : Maximum estimated output size of runs on tmpfs in MB (default: 256)
+    --upload-retries= <N>     : Number of retries for uploads that fail with a connection error (requires --upload-threads, default: 3)
+    --upload-threads= <N>     : Upload attachments concurrently with N threads after the run state is set to SUCCESS (remote worker only, default: 0 = sequential uploads)
     -u, --user <username>     : RabbitMQ user (default: sco)
+    --workers= <N>            : Run requests in a pool of N worker processes (default: 0 = single process, implies --async)
+    --memory= <MB>            : Memory budget for all active runs in the pool (default: 80% of physical memory)
+    --child-memory= <MB>      : Memory limit for each worker process in the pool (default: none)
+    --zygote                  : Preload modules and average subject once and fork a new worker process per run
+    --preload= <model-ids>    : Comma-separated list of models that are built by the zygote
     -v, --vhost <virtualhost> : RabbitMQ virtual host name
     """
     # Configuration parameter
@@ -108,6 +273,34 @@ if __name__ == '__main__':
     password = ''
     port = 5672
     remote_worker = False
+    render_processes = 1
+    affinity = False
+    async_consumer = False
+    cache_dir = None
+    checkpoint_dir = None
+    handoff = False
+    scratch_dir = None
+    scratch_quota = None
+    run_scratch = None
+    tmpfs_dir = None
+    tmpfs_run_size = 256
+    upload_threads = 0
+    upload_retries = UPLOAD_RETRIES
+    subject_cache_size = 4096
+    stimulus_cache_size = 4096
+    result_cache_size = 4096
+    incremental_runs = False
+    incremental_cache_size = 4096
+    data_quota = None
+    pipeline_depth = 0
+    worker_processes = 0
+    memory_budget = None
+    child_memory = None
+    zygote = False
+    preload_models = None
+    isolate = False
+    run_memory = None
+    run_timeout = None
     server_url = None
     user = 'sco'
     virtual_host = '/'
@@ -116,7 +309,7 @@ if __name__ == '__main__':
         opts, args = getopt.getopt(
             sys.argv[1:],
             'c:d:e:h:q:l:m:p:s:u:v:',
-            ['data=', 'env=', 'host=', 'queue=', 'log=', 'mongodb=', 'password=', 'port=', 'server=', 'user=', 'vhost=']
+            ['affinity', 'async', 'batch=', 'batch-wait=', 'cache=', 'checkpoints=', 'data=', 'data-quota=', 'env=', 'handoff', 'host=', 'incremental', 'incremental-cache=', 'queue=', 'log=', 'mongodb=', 'multi-model', 'password=', 'pipeline=', 'port=', 'prefetch=', 'render=', 'result-cache=', 'server=', 'stimulus-cache=', 'subject-cache=', 'sweep', 'user=', 'vhost=', 'workers=', 'memory=', 'child-memory=', 'zygote', 'preload=', 'isolate', 'run-memory=', 'run-timeout=', 'run-scratch=', 'scratch=', 'scratch-quota=', 'tmpfs=', 'tmpfs-run-size=', 'upload-retries=', 'upload-threads=']
         )
     except getopt.GetoptError:
         print """rabbitmq_worker [parameters]
@@ -125,15 +318,48 @@ if __name__ == '__main__':
         -----------
 
         -c, --port <port>         : Port that the RabbitMQ server is listening on (default: 5672)
+        --affinity                : Consume from a per-host queue of a consistent-hash exchange keyed by subject; use the shared queue only while idle (implies --async)
+        --async                   : Consume requests asynchronously (model runs do not block heartbeats; reconnects with backoff)
+        --batch= <K>              : Run up to K queued requests as a batch grouped by subject and image group (implies --async)
+        --batch-wait= <ms>        : Maximum wait time for a batch to fill up (default: 0)
+        --cache= <dir>            : Directory for local caches (default: no caching)
+        --checkpoints= <dir>      : Directory for checkpoints of model runs; restarted runs resume from their checkpoint (default: no checkpoints)
+        --subject-cache= <MB>     : Size budget of the subject cache in MB (default: 4096)
+        --stimulus-cache= <MB>    : Size budget of the stimulus image cache in MB (default: 4096)
+        --incremental             : Incremental re-runs that compute and render only stimuli without cached per-image results; assumes that the prediction for a stimulus does not depend on other stimuli (requires --cache)
+        --incremental-cache= <MB> : Size budget of the per-image result cache for incremental re-runs in MB (default: 4096)
+        --result-cache= <MB>      : Size budget of the result index in MB (default: 4096)
         -d, --data <data-dir>     : Path to data store directory or client cache (default '/tmp/sco')
+        --data-quota= <MB>        : Disk quota for resources in the client cache in MB (remote worker only, default: none)
         -e, --env= <subject_dir>  : Path to directory for average subject [mandatory]
+        --handoff                 : Stage run outputs in the data store directory and hand them off by hard links instead of copies (local worker only)
         -h, --host= <hostname>    : Name of host running RabbitMQ server (default: localhost)
+        --isolate                 : Run each model in a disposable child process
         -l, --log= <filename>     : Log file name (default: standard output)
+        --multi-model             : Evaluate the runs of a batch for the same subject, image group and functional data in a single pass that shares common plan nodes between models (requires --batch)
         -m, --mongodb= <db-name>  : Name of MongoDB database for local datastore worker (default: sco)
         -p, --password <pwd>      : RabbitMQ user password (default: '')
+        --pipeline= <depth>       : Run fetch, compute, render and upload stages of consecutive runs concurrently (default: 0 = off, implies --async and --render=1)
+        --prefetch= <N>           : Maximum number of unacknowledged requests (default: number of runs the worker can handle at once)
         -q, --queue= <quename>    : Name of RabbitMQ message queue (default: sco)
+        --render= <processes>     : Number of processes rendering cortical images (default: 1, 0 = one per CPU)
+        --run-memory= <MB>        : Memory limit for a model run (implies --isolate)
+        --run-timeout= <seconds>  : Time limit for a model run (implies --isolate)
+        --run-scratch= <MB>       : Scratch space for the output of a single run in MB (default: none)
         -s, --server <url>        : Url for SCO Web API server (only if remote worker is used)
+        --scratch= <dir>          : Root directory for run outputs (default: temporary directories without quotas)
+        --scratch-quota= <MB>     : Scratch space for the outputs of all runs in MB (default: none)
+        --sweep                   : Run each batch as a parameter sweep: runs with the same inputs as the first run of the batch share all plan nodes that do not depend on the arguments they differ in (requires --batch)
+        --tmpfs= <dir>            : Scratch root on tmpfs for the outputs of small runs (default: none)
+        --tmpfs-run-size= <MB>    : Maximum estimated output size of runs on tmpfs in MB (default: 256)
+        --upload-retries= <N>     : Number of retries for uploads that fail with a connection error (requires --upload-threads, default: 3)
+        --upload-threads= <N>     : Upload attachments concurrently with N threads after the run state is set to SUCCESS (remote worker only, default: 0 = sequential uploads)
         -u, --user <username>     : RabbitMQ user (default: sco)
+        --workers= <N>            : Run requests in a pool of N worker processes (default: 0 = single process, implies --async)
+        --memory= <MB>            : Memory budget for all active runs in the pool (default: 80% of physical memory)
+        --child-memory= <MB>      : Memory limit for each worker process in the pool (default: none)
+        --zygote                  : Preload modules and average subject once and fork a new worker process per run
+        --preload= <model-ids>    : Comma-separated list of models that are built by the zygote
         -v, --vhost <virtualhost> : RabbitMQ virtual host name (default: /)
         """
         sys.exit()
@@ -144,6 +370,26 @@ if __name__ == '__main__':
             except ValueError as ex:
                 print 'Invalid port: ' + param
                 sys.exit()
+        elif opt == '--affinity':
+            affinity = True
+        elif opt == '--async':
+            async_consumer = True
+        elif opt == '--batch':
+            try:
+                batch_size = int(param)
+            except ValueError as ex:
+                print 'Invalid batch size: ' + param
+                sys.exit()
+        elif opt == '--batch-wait':
+            try:
+                batch_wait = int(param) / 1000.0
+            except ValueError as ex:
+                print 'Invalid wait time: ' + param
+                sys.exit()
+        elif opt == '--cache':
+            cache_dir = param
+        elif opt == '--checkpoints':
+            checkpoint_dir = param
         elif opt in ('-d', '--data'):
             data_dir = param
         elif opt in ('-e', '--env'):
@@ -152,18 +398,144 @@ if __name__ == '__main__':
             hostname = param
         elif opt in ('-l', '--log'):
             logfile = param
+        elif opt == '--isolate':
+            isolate = True
+        elif opt == '--multi-model':
+            multi_model = True
+        elif opt == '--sweep':
+            sweep = True
         elif opt in ('-m', '--mongodb'):
             mongo_db = param
         elif opt in ('-p', '--password'):
             password = param
         elif opt in ('-q', '--queue'):
             queue = param
+        elif opt == '--child-memory':
+            try:
+                child_memory = int(param)
+            except ValueError as ex:
+                print 'Invalid memory limit: ' + param
+                sys.exit()
+        elif opt == '--memory':
+            try:
+                memory_budget = int(param)
+            except ValueError as ex:
+                print 'Invalid memory budget: ' + param
+                sys.exit()
+        elif opt == '--pipeline':
+            try:
+                pipeline_depth = int(param)
+            except ValueError as ex:
+                print 'Invalid pipeline depth: ' + param
+                sys.exit()
+        elif opt == '--prefetch':
+            try:
+                prefetch = int(param)
+            except ValueError as ex:
+                print 'Invalid prefetch count: ' + param
+                sys.exit()
+        elif opt == '--preload':
+            preload_models = [m.strip() for m in param.split(',') if m.strip() != '']
+        elif opt == '--render':
+            try:
+                render_processes = int(param)
+            except ValueError as ex:
+                print 'Invalid number of processes: ' + param
+                sys.exit()
         elif opt in ('-r', '--remote'):
             remote_worker = True
+        elif opt == '--run-memory':
+            try:
+                run_memory = int(param)
+            except ValueError as ex:
+                print 'Invalid memory limit: ' + param
+                sys.exit()
+        elif opt == '--run-timeout':
+            try:
+                run_timeout = int(param)
+            except ValueError as ex:
+                print 'Invalid time limit: ' + param
+                sys.exit()
+        elif opt == '--handoff':
+            handoff = True
+        elif opt == '--run-scratch':
+            try:
+                run_scratch = int(param)
+            except ValueError as ex:
+                print 'Invalid scratch quota: ' + param
+                sys.exit()
+        elif opt == '--scratch':
+            scratch_dir = param
+        elif opt == '--scratch-quota':
+            try:
+                scratch_quota = int(param)
+            except ValueError as ex:
+                print 'Invalid scratch quota: ' + param
+                sys.exit()
+        elif opt == '--tmpfs':
+            tmpfs_dir = param
+        elif opt == '--tmpfs-run-size':
+            try:
+                tmpfs_run_size = int(param)
+            except ValueError as ex:
+                print 'Invalid run size: ' + param
+                sys.exit()
+        elif opt == '--upload-retries':
+            try:
+                upload_retries = int(param)
+            except ValueError as ex:
+                print 'Invalid number of retries: ' + param
+                sys.exit()
+        elif opt == '--upload-threads':
+            try:
+                upload_threads = int(param)
+            except ValueError as ex:
+                print 'Invalid number of upload threads: ' + param
+                sys.exit()
         elif opt in ('-s', '--server'):
             # Only if the server Url is given the remote worker is used
             server_url = param
             remote_worker = True
+        elif opt == '--data-quota':
+            try:
+                data_quota = int(param)
+            except ValueError as ex:
+                print 'Invalid disk quota: ' + param
+                sys.exit()
+        elif opt == '--incremental':
+            incremental_runs = True
+        elif opt == '--incremental-cache':
+            try:
+                incremental_cache_size = int(param)
+            except ValueError as ex:
+                print 'Invalid cache size: ' + param
+                sys.exit()
+        elif opt == '--result-cache':
+            try:
+                result_cache_size = int(param)
+            except ValueError as ex:
+                print 'Invalid cache size: ' + param
+                sys.exit()
+        elif opt == '--stimulus-cache':
+            try:
+                stimulus_cache_size = int(param)
+            except ValueError as ex:
+                print 'Invalid cache size: ' + param
+                sys.exit()
+        elif opt == '--subject-cache':
+            try:
+                subject_cache_size = int(param)
+            except ValueError as ex:
+                print 'Invalid cache size: ' + param
+                sys.exit()
+        elif opt == '--workers':
+            try:
+                worker_processes = int(param)
+            except ValueError as ex:
+                print 'Invalid number of processes: ' + param
+                sys.exit()
+        elif opt == '--zygote':
+            zygote = True
         elif opt in ('-u', '--user'):
             user = param
         elif opt in ('-v', '--vhost'):
@@ -184,21 +556,173 @@ if __name__ == '__main__':
             level=logging.INFO,
             format='%(asctime)s %(levelname)s:%(message)s'
         )
-    # Set worker instance based on given parameter
-    if remote_worker:
-        worker = SCOClientWorker(
-            SCOClient(api_url=server_url, data_dir=data_dir),
-            env_dir
+    # Initialize local caches if cache directory is given
+    if not cache_dir is None:
+        subject_cache = SubjectCache(DiskCache(
+            os.path.join(cache_dir, 'subjects'),
+            max_size=subject_cache_size * MEGABYTE
+        ))
+        stimulus_cache = StimulusCache(DiskCache(
+            os.path.join(cache_dir, 'stimuli'),
+            max_size=stimulus_cache_size * MEGABYTE
+        ))
+        result_index = ResultIndex(DiskCache(
+            os.path.join(cache_dir, 'results'),
+            max_size=result_cache_size * MEGABYTE
+        ))
+        # Incremental re-runs are optional. They assume that the prediction
+        # for a stimulus is independent of the other stimuli.
+        if incremental_runs:
+            incremental = IncrementalCache(DiskCache(
+                os.path.join(cache_dir, 'incremental'),
+                max_size=incremental_cache_size * MEGABYTE
+            ))
+        else:
+            incremental = None
+        logging.info('Cache : [' + cache_dir + ']')
+    else:
+        subject_cache = None
+        stimulus_cache = None
+        result_index = None
+        incremental = None
+        if incremental_runs:
+            logging.warning('Incremental re-runs require a cache directory')
+    # Keep checkpoints of model runs if checkpoint directory is given
+    if not checkpoint_dir is None:
+        checkpoints = CheckpointStore(checkpoint_dir)
+        logging.info('Checkpoints : [' + checkpoint_dir + ']')
+    else:
+        checkpoints = None
+    # Output directories of the local worker are staged in the data store
+    # directory for zero-copy hand-off
+    if handoff:
+        if remote_worker:
+            print 'Hand-off is only supported by the local worker'
+            sys.exit()
+        if scratch_dir is None:
+            scratch_dir = staging_directory(data_dir)
+    # Manage output directories of model runs in a scratch space if any of the
+    # scratch options is given
+    if not (scratch_dir is None and scratch_quota is None and run_scratch is None and tmpfs_dir is None):
+        if scratch_dir is None:
+            scratch_dir = os.path.join(tempfile.gettempdir(), 'sco-scratch')
+        scratch = ScratchSpace(
+            scratch_dir,
+            tmpfs_dir=tmpfs_dir,
+            tmpfs_max_size=tmpfs_run_size * MEGABYTE,
+            run_quota=run_scratch * MEGABYTE if not run_scratch is None else None,
+            quota=scratch_quota * MEGABYTE if not scratch_quota is None else None
         )
-        logging.info('Worker : [Remote]')
+        logging.info('Scratch : [' + scratch_dir + ']')
     else:
-        mongo = MongoDBFactory(db_name=mongo_db)
-        worker = SCODataStoreWorker(
-            SCODataStore(mongo, data_dir),
-            SCOEngine(mongo),
-            env_dir
+        scratch = None
+    # Run each model in a disposable child process if requested or if resource
+    # limits are given
+    if isolate or not run_memory is None or not run_timeout is None:
+        run_limits = RunLimits(
+            max_memory=run_memory * MEGABYTE if not run_memory is None else None,
+            timeout=run_timeout
         )
+    else:
+        run_limits = None
+    # The render pool cannot be forked safely while the pipeline threads are
+    # running. Pipelined runs render cortical images in the stage thread.
+    if pipeline_depth > 0 and worker_processes == 0 and not zygote and render_processes != 1:
+        logging.warning('Cortical images are rendered in a single process with pipeline')
+        render_processes = 1
+    # Set worker instance based on given parameter. Workers are created by a
+    # factory function to allow each child process of the supervisor to create
+    # its own worker (with its own database connections).
+    def create_worker():
+        if remote_worker:
+            return SCOClientWorker(
+                SCOClient(api_url=server_url, data_dir=data_dir),
+                env_dir,
+                render_processes=render_processes,
+                subject_cache=subject_cache,
+                stimulus_cache=stimulus_cache,
+                result_index=result_index,
+                incremental=incremental,
+                checkpoints=checkpoints,
+                scratch=scratch,
+                run_limits=run_limits,
+                resource_cache=ResourceCache(
+                    data_dir,
+                    max_size=data_quota * MEGABYTE if not data_quota is None else None
+                ),
+                uploader=Uploader(
+                    threads=upload_threads,
+                    retries=upload_retries
+                ) if upload_threads > 0 else None
+            )
+        else:
+            mongo = MongoDBFactory(db_name=mongo_db)
+            return SCODataStoreWorker(
+                SCODataStore(mongo, data_dir),
+                SCOEngine(mongo),
+                env_dir,
+                render_processes=render_processes,
+                subject_cache=subject_cache,
+                stimulus_cache=stimulus_cache,
+                result_index=result_index,
+                incremental=incremental,
+                checkpoints=checkpoints,
+                scratch=scratch,
+                run_limits=run_limits,
+                handoff=handoff
+            )
+    if remote_worker:
+        logging.info('Worker : [Remote]')
+    else:
         logging.info('Worker : [Local]')
+    # In zygote mode modules and the average subject are loaded once by the
+    # supervisor and every run is executed in a freshly forked child.
+    if zygote and worker_processes == 0:
+        worker_processes = 1
+    if worker_processes > 0:
+        # Run requests in a pool of child processes
+        if zygote:
+            preload_func = lambda: preload(env_dir, model_ids=preload_models)
+        else:
+            preload_func = None
+        supervisor = Supervisor(
+            create_worker,
+            worker_processes,
+            memory_budget=memory_budget * MEGABYTE if not memory_budget is None else None,
+            child_memory_limit=child_memory * MEGABYTE if not child_memory is None else None,
+            preload=preload_func,
+            max_runs=1 if zygote else None
+        )
+        supervisor.start()
+        if pipeline_depth > 0:
+            logging.warning('Pipeline is not used with multiple worker processes')
+    else:
+        worker = create_worker()
+        # Execute stages of consecutive model runs concurrently if pipeline
+        # depth is given
+        if pipeline_depth > 0:
+            pipeline = worker.pipeline(depth=pipeline_depth)
+            logging.info('Pipeline : [DEPTH=' + str(pipeline_depth) + ']')
+    # Batches are executed by the local worker
+    if batch_size > 1 and (worker is None or not pipeline is None):
+        logging.warning('Batches are not used with pipeline or multiple worker processes')
+        batch_size = 1
+    if multi_model and batch_size <= 1:
+        logging.warning('Multi-model evaluation is only used with batches')
+    if sweep and batch_size <= 1:
+        logging.warning('Sweeps are only used with batches')
+    # The asynchronous consumer reconnects by itself. Subject-affinity routing
+    # and batches require the asynchronous consumer. Submitting requests to a
+    # pipeline or to worker processes blocks while they are busy. This must
+    # not happen in the connection thread of the blocking consumer.
+    if async_consumer or affinity or batch_size > 1 or not pipeline is None or not supervisor is None:
+        if affinity:
+            routing = AffinityRouting(queue, socket.gethostname())
+            logging.info('Affinity : [' + routing.queue + ']')
+        else:
+            routing = None
+        consume_requests(hostname, port, virtual_host, queue, user, password, affinity=routing)
+        sys.exit()
     # Start an endless loop to handle requests. Necessary because pika throws
     # ConnectionClosed exception occasionally when sending acknowledgement. This
     # way we can keep a remote worker alive by re-connecting.
@@ -0,0 +1,116 @@
+"""Per-process registry of built SCO models. Building a model (i.e., the pimms
+calculation plan for a model identifier) is done once per worker process. The
+built model is reused by all following runs of the same model until the model
+definition changes or the model is invalidated explicitly.
+"""
+
+import logging
+import threading
+
+import sco
+
+
+class ModelRegistry(object):
+    """Cache of built SCO models keyed by model identifier. Each entry keeps
+    the signature of the model definition that was used to build the model.
+    If a run uses a model definition with a different signature the model is
+    rebuilt.
+    """
+    def __init__(self, build_func=None):
+        """Initialize the (empty) registry.
+
+        Parameters
+        ----------
+        build_func : callable, optional
+            Function that builds a model from a model identifier. Uses
+            sco.build_model by default.
+        """
+        self.build_func = build_func if not build_func is None else sco.build_model
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get(self, model_def):
+        """Get the built model for the given model definition. Builds the model
+        if it is not in the registry or if the model definition changed since
+        the model was built.
+
+        Parameters
+        ----------
+        model_def : scoengine.ModelHandle
+            Descriptor for SCO model
+
+        Returns
+        -------
+        pimms.Plan
+        """
+        signature = model_signature(model_def)
+        with self.lock:
+            if model_def.identifier in self.models:
+                entry_signature, model = self.models[model_def.identifier]
+                if entry_signature == signature:
+                    return model
+                # Preloaded models are used with the first definition that
+                # is seen for the model.
+                if entry_signature is None:
+                    self.models[model_def.identifier] = (signature, model)
+                    return model
+                logging.info('Model definition changed: ' + model_def.identifier)
+            model = self.build_func(model_def.identifier)
+            self.models[model_def.identifier] = (signature, model)
+            return model
+
+    def preload(self, identifier):
+        """Build the model with the given identifier before the definition of
+        the model is known (e.g., when the worker process is started).
+
+        Parameters
+        ----------
+        identifier : string
+            Unique model identifier
+        """
+        with self.lock:
+            if not identifier in self.models:
+                self.models[identifier] = (None, self.build_func(identifier))
+
+    def invalidate(self, identifier=None):
+        """Remove a built model from the registry. Removes all models if no
+        identifier is given.
+
+        Parameters
+        ----------
+        identifier : string, optional
+            Unique model identifier
+        """
+        with self.lock:
+            if identifier is None:
+                self.models = {}
+            elif identifier in self.models:
+                del self.models[identifier]
+
+
+def model_signature(model_def):
+    """Signature of a model definition. Two model definitions with the same
+    identifier but different signatures are considered different versions of
+    the model.
+
+    Parameters
+    ----------
+    model_def : scoengine.ModelHandle
+        Descriptor for SCO model
+
+    Returns
+    -------
+    string
+    """
+    properties = getattr(model_def, 'properties', None)
+    if isinstance(properties, dict):
+        properties = sorted(properties.items())
+    return repr((
+        model_def.identifier,
+        str(getattr(model_def, 'timestamp', None)),
+        properties
+    ))
+
+
+# Default model registry of the worker process
+DEFAULT_REGISTRY = ModelRegistry()
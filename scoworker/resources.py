@@ -0,0 +1,146 @@
+"""Local cache of downloaded resources for remote workers. The SCO client
+downloads subjects, image groups, and functional data into separate
+sub-folders of its data directory and downloads them again if the sub-folder
+is missing. The resource cache keeps an index of these sub-folders (with the
+resource identifier and the size) and removes the least
+recently used sub-folders if the total size exceeds the disk quota. Folders
+that are used by a running model run are pinned and never evicted. The index
+is shared by all workers that use the same data directory.
+"""
+
+import logging
+import os
+import time
+
+from cache import DiskCache, directory_size
+
+
+class ResourceCache(DiskCache):
+    """Index of resource folders in the data directory of an SCO client. The
+    cache key for a resource is the name of its folder in the data directory.
+    """
+    def __init__(self, directory, max_size=None):
+        """Initialize the data directory and the disk quota.
+
+        Parameters
+        ----------
+        directory : string
+            Data directory of the SCO client
+        max_size : int, optional
+            Disk quota in bytes
+        """
+        super(ResourceCache, self).__init__(directory, max_size=max_size)
+
+    def acquire(self, resources):
+        """Add resources to the index and pin them for the duration of a model
+        run. Resources that are not in the index yet are counted as misses
+        (i.e., they have been downloaded for this run). All other resources are
+        counted as hits. Evicts least recently used resources if the disk quota
+        is exceeded. The sizes of new resources are computed without holding
+        the index lock, i.e., other workers are not blocked while the
+        resource folders are scanned.
+
+        Parameters
+        ----------
+        resources : list((string, string))
+            List of resource identifier and path to a file or directory of the
+            resource
+
+        Returns
+        -------
+        list(string)
+            Keys of pinned resources (to be passed to release()) or None if one
+            of the resource folders has been evicted after it was fetched
+        """
+        keys = {}
+        for resource_id, path in resources:
+            key = self.resource_key(path)
+            if not key is None:
+                keys[key] = resource_id
+        with self.lock():
+            index = self.read_index()
+            new_keys = [key for key in keys if not key in index]
+        sizes = {}
+        for key in new_keys:
+            path = self.entry_path(key)
+            if os.path.isdir(path):
+                sizes[key] = directory_size(path)
+        with self.lock():
+            index = self.read_index()
+            for key in keys:
+                path = self.entry_path(key)
+                if not os.path.isdir(path):
+                    if key in index:
+                        del index[key]
+                        self.write_index(index)
+                    return None
+            now = time.time()
+            pid = str(os.getpid())
+            for key in keys:
+                if key in index:
+                    self.hits += 1
+                    entry = index[key]
+                    entry['accessed'] = now
+                else:
+                    self.misses += 1
+                    # The entry may have been removed by another worker after
+                    # the sizes were computed
+                    if not key in sizes:
+                        sizes[key] = directory_size(self.entry_path(key))
+                    entry = {
+                        'resource' : keys[key],
+                        'size' : sizes[key],
+                        'created' : now,
+                        'accessed' : now
+                    }
+                    index[key] = entry
+                pins = entry.setdefault('pins', {})
+                pins[pid] = pins.get(pid, 0) + 1
+            self.evict(index)
+            self.write_index(index)
+            total_size = sum([index[key]['size'] for key in index])
+        logging.info(
+            'Resource cache [hits=%d, misses=%d, evictions=%d, size=%.1f MB]' % (
+                self.hits,
+                self.misses,
+                self.evictions,
+                total_size / (1024.0 * 1024.0)
+            )
+        )
+        return sorted(keys.keys())
+
+    def release(self, keys):
+        """Remove pins that were added by acquire().
+
+        Parameters
+        ----------
+        keys : list(string)
+            Keys of pinned resources
+        """
+        for key in keys:
+            self.unpin(key)
+
+    def resource_key(self, path):
+        """Get the cache key for a file or directory in the data directory.
+        The key is the name of the top-level folder in the data directory that
+        contains the given path.
+
+        Parameters
+        ----------
+        path : string
+            Path to file or directory
+
+        Returns
+        -------
+        string
+            Cache key or None if the path is not in the data directory
+        """
+        path = os.path.abspath(path)
+        rel_path = os.path.relpath(path, self.directory)
+        if rel_path == '.' or rel_path.startswith(os.pardir):
+            return None
+        components = rel_path.split(os.sep)
+        # Ignore files in the data directory itself (e.g., the client's index)
+        if len(components) == 1 and os.path.isfile(path):
+            return None
+        return components[0]
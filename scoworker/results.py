@@ -0,0 +1,179 @@
+"""Local index of completed model run results. Model runs with identical
+inputs (i.e., same model, subject, image group, functional data, and
+arguments) produce identical results. The result index keeps the prediction
+file and the attachments of completed runs keyed by a fingerprint of the run
+inputs. Resubmitted runs are served from the index without running the model.
+"""
+
+import json
+import logging
+import os
+import shutil
+
+from cache import hash_values
+from plans import canonical_value
+from registry import model_signature
+
+
+# Name of the file that describes the files in a result index entry
+RESULT_FILE = 'result.json'
+
+
+class ResultIndex(object):
+    """Index of model run results that is kept in a DiskCache. Each entry
+    contains the prediction file and all attachments of a completed run
+    together with a description of these files.
+    """
+    def __init__(self, cache):
+        """Initialize the disk cache.
+
+        Parameters
+        ----------
+        cache : scoworker.cache.DiskCache
+            Cache for result files
+        """
+        self.cache = cache
+
+    def get(self, fingerprint, output_dir):
+        """Get the result of a previous run with the given fingerprint. The
+        result files are placed in the given output directory (to ensure that
+        they remain available even if the entry is evicted while the files are
+        uploaded).
+
+        Parameters
+        ----------
+        fingerprint : string
+            Fingerprint of model run inputs
+        output_dir : string
+            Directory for result files
+
+        Returns
+        -------
+        string, dict
+            Path to prediction file and dictionary of attachments (same format
+            as the result of sco_run()) or None if no result with the given
+            fingerprint exists
+        """
+        path = self.cache.get(fingerprint)
+        if path is None:
+            return None
+        try:
+            with open(os.path.join(path, RESULT_FILE), 'r') as f:
+                result = json.load(f)
+            prediction_file = os.path.join(output_dir, result['prediction'])
+            link_or_copy(os.path.join(path, result['prediction']), prediction_file)
+            attachments = {}
+            for resource_id in result['attachments']:
+                filename, mime_type = result['attachments'][resource_id]
+                target_file = os.path.join(output_dir, filename)
+                link_or_copy(os.path.join(path, filename), target_file)
+                attachments[resource_id] = (target_file, mime_type)
+        except (IOError, OSError, KeyError, ValueError) as ex:
+            # Remove incomplete or corrupted entries
+            logging.exception(ex)
+            self.cache.remove(fingerprint)
+            return None
+        return prediction_file, attachments
+
+    def hit_rate(self):
+        """Fraction of lookups that were served from the index.
+
+        Returns
+        -------
+        float
+        """
+        lookups = self.cache.hits + self.cache.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.cache.hits) / lookups
+
+    def put(self, fingerprint, prediction_file, attachments):
+        """Add the result of a completed model run to the index.
+
+        Parameters
+        ----------
+        fingerprint : string
+            Fingerprint of model run inputs
+        prediction_file : string
+            Path to prediction file
+        attachments : dict
+            Dictionary of attachments (resource identifier: (filename, mime
+            type))
+        """
+        def write_result(directory):
+            # Each file is kept in a separate sub-folder to preserve the
+            # original file names.
+            result = {'attachments' : {}}
+            filename = os.path.join('0', os.path.basename(prediction_file))
+            os.mkdir(os.path.join(directory, '0'))
+            link_or_copy(prediction_file, os.path.join(directory, filename))
+            result['prediction'] = filename
+            for i, resource_id in enumerate(sorted(attachments)):
+                source_file, mime_type = attachments[resource_id]
+                folder = str(i + 1)
+                filename = os.path.join(folder, os.path.basename(source_file))
+                os.mkdir(os.path.join(directory, folder))
+                link_or_copy(source_file, os.path.join(directory, filename))
+                result['attachments'][resource_id] = [filename, mime_type]
+            with open(os.path.join(directory, RESULT_FILE), 'w') as f:
+                json.dump(result, f)
+        self.cache.put(fingerprint, write_result)
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def link_or_copy(source, target):
+    """Create a hard link to the source file. Copies the file if the link
+    cannot be created (e.g., if source and target are on different file
+    systems). Creates the parent directory of the target if necessary.
+
+    Parameters
+    ----------
+    source : string
+        Path to existing file
+    target : string
+        Path to new file
+    """
+    target_dir = os.path.dirname(target)
+    if target_dir != '' and not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def run_fingerprint(model_def, subject, image_group, fmri_data, args):
+    """Fingerprint of the inputs of a model run. The fingerprint is derived
+    from the model signature, the identifiers of the subject, image group, and
+    (optional) functional data, and the canonical representation of the
+    converted image group options and model run arguments.
+
+    Parameters
+    ----------
+    model_def : scoengine.ModelHandle
+        Descriptor for SCO model
+    subject : SubjectHandle
+        Handle for subject
+    image_group : ImageGroupHandle
+        Handle for image group
+    fmri_data : FMRIDataHandle
+        Handle for functional data (may be None)
+    args : dict
+        Converted image group options and model run arguments
+
+    Returns
+    -------
+    string
+    """
+    return hash_values(
+        model_signature(model_def),
+        subject.identifier,
+        image_group.identifier,
+        fmri_data.identifier if not fmri_data is None else None,
+        canonical_value(args)
+    )
@@ -0,0 +1,124 @@
+"""Subject-affinity routing of model run requests. Requests are published to
+a consistent-hash exchange (RabbitMQ plugin rabbitmq_consistent_hash_exchange)
+using the subject identifier as routing key. Each host binds its own affinity
+queue to the exchange, i.e., all requests for a subject end up at the same
+host where the subject has been downloaded and its subject-level values are
+cached. Workers on the same host share the affinity queue (and the caches).
+
+Workers consume from the shared request queue only while they are idle.
+Requests that wait in an affinity queue for longer than the message TTL (e.g.,
+because the host is busy or gone) are dead-lettered to the shared queue.
+"""
+
+import pika
+
+
+# Suffix for the name of the exchange for subject-affinity routing
+AFFINITY_EXCHANGE_SUFFIX = '.affinity'
+
+# Time after which requests in an affinity queue are moved to the shared queue
+# (in seconds)
+AFFINITY_TTL = 600
+
+
+class AffinityRouting(object):
+    """Declaration of the consistent-hash exchange and the affinity queue of
+    a host.
+
+    Attributes
+    ----------
+    shared_queue : string
+        Name of the shared request queue
+    exchange : string
+        Name of the consistent-hash exchange
+    queue : string
+        Name of the affinity queue
+    weight : int
+        Share of the hash space that is assigned to the affinity queue
+    ttl : int
+        Time after which requests are moved to the shared queue (in seconds)
+    """
+    def __init__(self, shared_queue, host, weight=1, ttl=AFFINITY_TTL):
+        """Initialize exchange and queue names.
+
+        Parameters
+        ----------
+        shared_queue : string
+            Name of the shared request queue
+        host : string
+            Unique name of the host
+        weight : int, optional
+            Share of the hash space that is assigned to the affinity queue
+        ttl : int, optional
+            Time after which requests are moved to the shared queue (in
+            seconds)
+        """
+        self.shared_queue = shared_queue
+        self.exchange = shared_queue + AFFINITY_EXCHANGE_SUFFIX
+        self.queue = self.exchange + '.' + host
+        self.weight = weight
+        self.ttl = ttl
+
+    def declare(self, channel, callback):
+        """Declare the exchange and the affinity queue and bind the queue to
+        the exchange. Calls the callback when done.
+
+        Parameters
+        ----------
+        channel : pika.channel.Channel
+            Open channel
+        callback : callable
+            Function without arguments
+        """
+        def on_queue_bound(frame):
+            callback()
+        def on_queue_declared(frame):
+            # For a consistent-hash exchange the routing key of the binding
+            # is the weight of the queue
+            channel.queue_bind(
+                on_queue_bound,
+                self.queue,
+                self.exchange,
+                routing_key=str(self.weight)
+            )
+        def on_exchange_declared(frame):
+            channel.queue_declare(
+                on_queue_declared,
+                queue=self.queue,
+                durable=True,
+                arguments={
+                    'x-message-ttl' : self.ttl * 1000,
+                    'x-dead-letter-exchange' : '',
+                    'x-dead-letter-routing-key' : self.shared_queue
+                }
+            )
+        channel.exchange_declare(
+            on_exchange_declared,
+            exchange=self.exchange,
+            exchange_type='x-consistent-hash',
+            durable=True
+        )
+
+
+def publish_request(channel, body, subject_id, queue='sco'):
+    """Publish a model run request for subject-affinity routing. Used by
+    request publishers in place of publishing to the shared queue. Requires
+    that at least one worker has declared the exchange.
+
+    Parameters
+    ----------
+    channel : pika.channel.Channel or pika.adapters.blocking_connection.BlockingChannel
+        Open channel
+    body : string
+        Json serialization of the model run request
+    subject_id : string
+        Identifier of the subject of the model run
+    queue : string, optional
+        Name of the shared request queue
+    """
+    channel.basic_publish(
+        exchange=queue + AFFINITY_EXCHANGE_SUFFIX,
+        routing_key=subject_id,
+        body=body,
+        properties=pika.BasicProperties(delivery_mode=2)
+    )
@@ -0,0 +1,287 @@
+"""Scratch space for the output directories of model runs. Each run gets its
+own directory below a scratch root. Runs with a small estimated output size
+can be placed on a tmpfs root while larger runs are placed on disk. The
+scratch space enforces a quota for the output of each run and a global quota
+for the output of all runs that share the scratch roots. Directories are
+named by the identifier of the owning process, i.e., directories of processes
+that died without cleaning up are removed when a scratch space is created
+(or when a quota would be exceeded otherwise).
+"""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from cache import CacheLock, directory_size
+
+
+# Prefix for the names of run directories
+RUN_PREFIX = 'run-'
+
+# Name of the file in a run directory that contains the estimated size of the
+# run output (in bytes)
+RESERVED_FILE = '.reserved'
+
+# Parameters of the model that is used to estimate the output size of a model
+# run (in bytes): a fixed amount per run and an amount per stimulus image.
+BASE_SCRATCH = 64 * 1024 * 1024
+IMAGE_SCRATCH = 8 * 1024 * 1024
+
+
+class ScratchQuotaExceeded(Exception):
+    """Exception that is raised if a model run exceeds the scratch quota."""
+    pass
+
+
+class ScratchSpace(object):
+    """Directories for the output of model runs with per-run and global
+    quotas.
+
+    Attributes
+    ----------
+    directory : string
+        Scratch root on disk
+    tmpfs_dir : string
+        Scratch root on tmpfs (may be None)
+    tmpfs_max_size : int
+        Maximum estimated output size of runs that are placed on tmpfs (in
+        bytes)
+    run_quota : int
+        Maximum output size of a single run (in bytes). Unlimited if None.
+    quota : int
+        Maximum output size of all runs (in bytes). Unlimited if None.
+    """
+    def __init__(self, directory, tmpfs_dir=None, tmpfs_max_size=None, run_quota=None, quota=None):
+        """Initialize the scratch roots and quotas. The roots are created if
+        they do not exist. Directories of processes that no longer exist are
+        removed.
+
+        Parameters
+        ----------
+        directory : string
+            Scratch root on disk
+        tmpfs_dir : string, optional
+            Scratch root on tmpfs
+        tmpfs_max_size : int, optional
+            Maximum estimated output size of runs that are placed on tmpfs (in
+            bytes). All runs are placed on tmpfs if None.
+        run_quota : int, optional
+            Maximum output size of a single run (in bytes)
+        quota : int, optional
+            Maximum output size of all runs (in bytes)
+        """
+        self.directory = os.path.abspath(directory)
+        self.tmpfs_dir = os.path.abspath(tmpfs_dir) if not tmpfs_dir is None else None
+        self.tmpfs_max_size = tmpfs_max_size
+        self.run_quota = run_quota
+        self.quota = quota
+        self.thread_lock = threading.Lock()
+        for root in self.roots():
+            if not os.path.isdir(root):
+                os.makedirs(root)
+        with self.lock():
+            self.sweep()
+
+    def allocate(self, estimated_size=0):
+        """Create the output directory for a model run. The directory is
+        placed on tmpfs if the estimated size of the run output does not
+        exceed the tmpfs limit and fits into the free tmpfs space.
+
+        Parameters
+        ----------
+        estimated_size : int, optional
+            Estimated size of the run output (in bytes)
+
+        Returns
+        -------
+        string
+            Path to run directory
+        """
+        if not self.run_quota is None:
+            estimated_size = min(estimated_size, self.run_quota)
+        with self.lock():
+            if not self.quota is None and self.usage() + estimated_size > self.quota:
+                # Reclaim directories of crashed processes before giving up
+                self.sweep()
+                usage = self.usage()
+                if usage + estimated_size > self.quota:
+                    raise ScratchQuotaExceeded(
+                        'scratch quota exceeded: %d bytes in use, %d bytes requested' % (usage, estimated_size)
+                    )
+            root = self.directory
+            if not self.tmpfs_dir is None:
+                if self.tmpfs_max_size is None or estimated_size <= self.tmpfs_max_size:
+                    if free_space(self.tmpfs_dir) > estimated_size:
+                        root = self.tmpfs_dir
+            path = tempfile.mkdtemp(
+                prefix=RUN_PREFIX + str(os.getpid()) + '-',
+                dir=root
+            )
+            with open(os.path.join(path, RESERVED_FILE), 'w') as f:
+                f.write(str(estimated_size))
+        return path
+
+    def check(self, path):
+        """Raise an exception if the output of a run exceeds the per-run
+        quota.
+
+        Parameters
+        ----------
+        path : string
+            Path to run directory
+
+        Returns
+        -------
+        int
+            Size of the run output (in bytes)
+        """
+        size = directory_size(path)
+        if not self.run_quota is None and size > self.run_quota:
+            raise ScratchQuotaExceeded(
+                'run scratch quota exceeded: %d bytes' % (size)
+            )
+        return size
+
+    def lock(self):
+        """Lock that serializes allocations across threads and processes.
+
+        Returns
+        -------
+        scoworker.cache.CacheLock
+        """
+        return CacheLock(self)
+
+    def release(self, path):
+        """Remove the output directory of a model run.
+
+        Parameters
+        ----------
+        path : string
+            Path to run directory
+
+        Returns
+        -------
+        int
+            Size of the run output (in bytes)
+        """
+        try:
+            size = directory_size(path)
+        except OSError:
+            size = 0
+        shutil.rmtree(path, ignore_errors=True)
+        return size
+
+    def roots(self):
+        """List of scratch roots.
+
+        Returns
+        -------
+        list(string)
+        """
+        if self.tmpfs_dir is None:
+            return [self.directory]
+        return [self.directory, self.tmpfs_dir]
+
+    def run_directories(self):
+        """Paths to all run directories in the scratch roots.
+
+        Returns
+        -------
+        list(string)
+        """
+        directories = []
+        for root in self.roots():
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if name.startswith(RUN_PREFIX) and os.path.isdir(path):
+                    directories.append(path)
+        return directories
+
+    def sweep(self):
+        """Remove run directories of processes that no longer exist."""
+        for path in self.run_directories():
+            try:
+                pid = int(os.path.basename(path)[len(RUN_PREFIX):].split('-')[0])
+            except ValueError:
+                continue
+            if not process_exists(pid):
+                logging.info('Remove orphaned scratch directory ' + path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def usage(self):
+        """Total scratch space that is used or reserved by all runs (in
+        bytes). For each run the larger of its current output size and its
+        estimated size is counted.
+
+        Returns
+        -------
+        int
+        """
+        total = 0
+        for path in self.run_directories():
+            try:
+                size = directory_size(path)
+                with open(os.path.join(path, RESERVED_FILE), 'r') as f:
+                    size = max(size, int(f.read()))
+            except (IOError, OSError, ValueError):
+                pass
+            total += size
+        return total
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def estimate_scratch_size(image_count):
+    """Estimate the output size of a model run (in bytes).
+
+    Parameters
+    ----------
+    image_count : int
+        Number of stimulus images
+
+    Returns
+    -------
+    int
+    """
+    return BASE_SCRATCH + image_count * IMAGE_SCRATCH
+
+
+def free_space(directory):
+    """Free space on the file system of a directory (in bytes).
+
+    Parameters
+    ----------
+    directory : string
+
+    Returns
+    -------
+    int
+    """
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def process_exists(pid):
+    """Test if a process with the given identifier exists.
+
+    Parameters
+    ----------
+    pid : int
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        # The process exists but belongs to a different user
+        return ex.errno == errno.EPERM
+    return True
@@ -0,0 +1,508 @@
+"""Supervisor for a pool of worker processes. The supervisor pre-forks a fixed
+number of child processes that each create their own worker instance. Model
+run requests are received by a single consumer in the supervisor and handed
+to idle children. A run is only started if its estimated memory usage fits
+into the remaining memory budget (or if no other run is active). Children
+that crash or exceed the memory limit are replaced by new children. The
+state of a run whose child crashed is set to FAILED.
+
+Children are not daemonic processes because workers start processes of
+their own (e.g., the render pool or isolated model runs). Children that are
+still running when the supervisor exits are killed.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import resource
+import select
+import signal
+import time
+
+
+# Parameters of the memory model that is used to estimate the memory usage of
+# a model run (in bytes): a fixed amount per run, an amount per stimulus image,
+# and a multiple of the size of the subject directory.
+BASE_MEMORY = 1024 * 1024 * 1024
+IMAGE_MEMORY = 32 * 1024 * 1024
+SUBJECT_MEMORY_FACTOR = 4
+
+# Interval for checking the state of child processes (in seconds)
+POLL_INTERVAL = 1.0
+
+
+class ChildProcess(object):
+    """Handle for a worker child process.
+
+    Attributes
+    ----------
+    process : multiprocessing.Process
+        Child process
+    conn : multiprocessing.Connection
+        Supervisor end of the pipe to the child
+    request : scoengine.ModelRunRequest
+        Request that is being executed by the child (None if idle)
+    reserved : int
+        Estimated memory usage of the active request (in bytes)
+    started : float
+        Start time of the active request
+    kill_reason : string
+        Reason why the child was terminated by the supervisor
+    runs : int
+        Number of requests that were handed to the child
+    callback : callable
+        Function that is called when the active request is done
+    """
+    def __init__(self, process, conn):
+        """Initialize process and pipe.
+
+        Parameters
+        ----------
+        process : multiprocessing.Process
+            Child process
+        conn : multiprocessing.Connection
+            Supervisor end of the pipe to the child
+        """
+        self.process = process
+        self.conn = conn
+        self.request = None
+        self.reserved = 0
+        self.started = None
+        self.kill_reason = None
+        self.runs = 0
+        self.callback = None
+
+    @property
+    def is_idle(self):
+        """Flag indicating whether the child is ready to execute a request.
+
+        Returns
+        -------
+        bool
+        """
+        return self.request is None and self.process.is_alive()
+
+
+class Supervisor(object):
+    """Pool of pre-forked worker processes with memory-aware admission of
+    model runs.
+    """
+    def __init__(self, worker_factory, processes, memory_budget=None, child_memory_limit=None, preload=None, max_runs=None):
+        """Initialize the pool configuration. Child processes are started by
+        start().
+
+        Parameters
+        ----------
+        worker_factory : callable
+            Function that creates a new worker instance (scoworker.SCOWorker).
+            Called once in each child process and once in the supervisor (to
+            estimate run sizes and report crashed runs).
+        processes : int
+            Number of child processes
+        memory_budget : int, optional
+            Total memory for all active runs (in bytes). Defaults to 80% of
+            the physical memory.
+        child_memory_limit : int, optional
+            Maximum memory of a single child process and its descendants (in
+            bytes). Children that exceed the limit are killed.
+        preload : callable, optional
+            Function that is called in the supervisor before any child is
+            started (e.g., to import modules that are then shared by all
+            children)
+        max_runs : int, optional
+            Number of runs after which a child is replaced by a new child. If
+            one, every run is executed in a fresh child process.
+        """
+        if processes < 1:
+            raise ValueError('invalid number of processes: ' + str(processes))
+        self.worker_factory = worker_factory
+        self.processes = processes
+        if memory_budget is None:
+            memory_budget = int(physical_memory() * 0.8)
+        self.memory_budget = memory_budget
+        self.child_memory_limit = child_memory_limit
+        self.preload = preload
+        self.max_runs = max_runs
+        self.children = []
+        self.worker = None
+        self.restarts = 0
+
+    def abort(self, request, message):
+        """Set the state of a model run to FAILED.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Request for the model run
+        message : string
+            Error message
+        """
+        try:
+            self.worker.abort(request, [message])
+        except Exception as ex:
+            logging.exception(ex)
+
+    def admit(self, request):
+        """Wait for an idle child and enough free memory to start the given
+        request.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Request for the model run
+
+        Returns
+        -------
+        ChildProcess, int
+            Child that executes the request and estimated memory usage
+        """
+        estimate = self.estimate_memory(request)
+        while True:
+            self.poll()
+            active = [c for c in self.children if not c.request is None]
+            reserved = sum([c.reserved for c in active])
+            # Children that reached the maximum number of runs are about to
+            # exit
+            idle = [
+                c for c in self.children
+                    if c.is_idle and (self.max_runs is None or c.runs < self.max_runs)
+            ]
+            if len(idle) > 0:
+                # Always admit the run if no other run is active. Otherwise,
+                # runs that exceed the budget would never be started.
+                if len(active) == 0 or reserved + estimate <= self.memory_budget:
+                    return idle[0], estimate
+            self.wait()
+
+    def estimate_memory(self, request):
+        """Estimate the memory usage of a model run based on the number of
+        stimulus images and the size of the subject directory. Uses the budget
+        of a single child if the size of the run is unknown.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Request for the model run
+
+        Returns
+        -------
+        int
+        """
+        try:
+            run_size = self.worker.run_size(request)
+        except Exception as ex:
+            logging.exception(ex)
+            run_size = None
+        if run_size is None:
+            return self.memory_budget / self.processes
+        image_count, subject_size = run_size
+        return estimate_run_memory(image_count, subject_size)
+
+    def finish(self, child):
+        """Mark the active request of a child as done.
+
+        Parameters
+        ----------
+        child : ChildProcess
+        """
+        callback = child.callback
+        child.request = None
+        child.reserved = 0
+        child.callback = None
+        if not callback is None:
+            try:
+                callback()
+            except Exception as ex:
+                logging.exception(ex)
+
+    def poll(self):
+        """Check the state of all child processes. Marks children that
+        finished their request as idle, terminates children that exceed the
+        memory limit, and replaces crashed children.
+        """
+        for i in range(len(self.children)):
+            child = self.children[i]
+            try:
+                while child.conn.poll():
+                    peak_memory = child.conn.recv()
+                    if not child.request is None:
+                        logging.info(
+                            'Child %d done in %.1f s (peak memory %.1f MB)' % (
+                                child.process.pid,
+                                time.time() - child.started,
+                                peak_memory / (1024.0 * 1024.0)
+                            )
+                        )
+                    self.finish(child)
+            except (EOFError, IOError):
+                pass
+            if not child.process.is_alive():
+                if child.process.exitcode == 0 and child.request is None:
+                    # Child reached the maximum number of runs
+                    child.conn.close()
+                    self.children[i] = self.start_child()
+                    continue
+                message = child.kill_reason
+                if message is None:
+                    message = 'worker process terminated unexpectedly (exit code ' + str(child.process.exitcode) + ')'
+                logging.error('Child ' + str(child.process.pid) + ': ' + message)
+                if not child.request is None:
+                    self.abort(child.request, message)
+                    self.finish(child)
+                child.conn.close()
+                self.children[i] = self.start_child()
+                self.restarts += 1
+            elif not self.child_memory_limit is None and not child.request is None:
+                if process_memory(child.process.pid) > self.child_memory_limit:
+                    child.kill_reason = 'memory limit exceeded'
+                    kill_process_tree(child.process.pid)
+
+    def start(self):
+        """Start all child processes."""
+        if not self.preload is None:
+            self.preload()
+        self.worker = self.worker_factory()
+        # Non-daemonic children are not terminated automatically on exit
+        atexit.register(self.terminate)
+        for i in range(self.processes):
+            self.children.append(self.start_child())
+        logging.info(
+            'Supervisor : [PROCESSES=%d, MEMORY=%d MB]' % (
+                self.processes,
+                self.memory_budget / (1024 * 1024)
+            )
+        )
+
+    def start_child(self):
+        """Start a new child process.
+
+        Returns
+        -------
+        ChildProcess
+        """
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=run_child,
+            args=(self.worker_factory, child_conn, self.max_runs)
+        )
+        # Daemonic processes are not allowed to have children
+        process.daemon = False
+        process.start()
+        child_conn.close()
+        return ChildProcess(process, conn)
+
+    def stop(self):
+        """Stop all child processes after they finished their active
+        requests.
+        """
+        while len([c for c in self.children if not c.request is None]) > 0:
+            self.wait()
+            self.poll()
+        for child in self.children:
+            try:
+                child.conn.send(None)
+            except IOError:
+                pass
+        for child in self.children:
+            child.process.join()
+        self.children = []
+
+    def submit(self, request, callback=None):
+        """Start the given request in an idle child process. Blocks until the
+        request is admitted. Requests for runs that are already active in one
+        of the children are skipped.
+
+        Parameters
+        ----------
+        request : scoengine.ModelRunRequest
+            Request for the model run
+        callback : callable, optional
+            Function without arguments that is called (by poll()) when the
+            request is done
+        """
+        for child in self.children:
+            active = child.request
+            if not active is None and (active.experiment_id, active.run_id) == (request.experiment_id, request.run_id):
+                logging.info('Skip duplicate request [' + request.experiment_id + ':' + request.run_id + ']')
+                if not callback is None:
+                    callback()
+                return
+        child, estimate = self.admit(request)
+        child.request = request
+        child.reserved = estimate
+        child.started = time.time()
+        child.kill_reason = None
+        child.runs += 1
+        child.callback = callback
+        child.conn.send(request)
+
+    def terminate(self):
+        """Kill all child processes and their descendants without waiting for
+        active requests to finish.
+        """
+        for child in self.children:
+            if child.process.is_alive():
+                kill_process_tree(child.process.pid)
+            child.conn.close()
+        for child in self.children:
+            child.process.join()
+        self.children = []
+
+    def wait(self):
+        """Wait until one of the children sends a message or the poll interval
+        has passed.
+        """
+        try:
+            select.select(
+                [c.conn.fileno() for c in self.children],
+                [],
+                [],
+                POLL_INTERVAL
+            )
+        except (select.error, IOError):
+            time.sleep(POLL_INTERVAL)
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def estimate_run_memory(image_count, subject_size):
+    """Estimate the memory usage of a model run (in bytes).
+
+    Parameters
+    ----------
+    image_count : int
+        Number of stimulus images
+    subject_size : int
+        Size of the subject directory (in bytes)
+
+    Returns
+    -------
+    int
+    """
+    return BASE_MEMORY + image_count * IMAGE_MEMORY + subject_size * SUBJECT_MEMORY_FACTOR
+
+
+def kill_process_tree(pid):
+    """Kill a process and all its descendants.
+
+    Parameters
+    ----------
+    pid : int
+        Process identifier
+    """
+    for proc in [pid] + process_descendants(pid):
+        try:
+            os.kill(proc, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def physical_memory():
+    """Size of the physical memory (in bytes).
+
+    Returns
+    -------
+    int
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def process_descendants(pid):
+    """Get identifiers of all descendants of a process (Linux only).
+
+    Parameters
+    ----------
+    pid : int
+        Process identifier
+
+    Returns
+    -------
+    list(int)
+    """
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat'), 'r') as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The process name (second field) may contain spaces
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        parents.setdefault(ppid, []).append(int(name))
+    descendants = []
+    pending = [pid]
+    while len(pending) > 0:
+        children = parents.get(pending.pop(), [])
+        descendants.extend(children)
+        pending.extend(children)
+    return descendants
+
+
+def process_memory(pid):
+    """Resident memory of a process and all its descendants (in bytes; Linux
+    only).
+
+    Parameters
+    ----------
+    pid : int
+        Process identifier
+
+    Returns
+    -------
+    int
+    """
+    total = 0
+    for proc in [pid] + process_descendants(pid):
+        try:
+            with open(os.path.join('/proc', str(proc), 'status'), 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except IOError:
+            pass
+    return total
+
+
+def run_child(worker_factory, conn, max_runs=None):
+    """Main loop of a worker child process. Receives requests from the
+    supervisor and reports the peak memory usage of the process after each
+    request. Stops when receiving None or after the maximum number of runs.
+
+    Parameters
+    ----------
+    worker_factory : callable
+        Function that creates a new worker instance
+    conn : multiprocessing.Connection
+        Child end of the pipe to the supervisor
+    max_runs : int, optional
+        Maximum number of runs
+    """
+    # Interrupts are handled by the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker = worker_factory()
+    runs = 0
+    while max_runs is None or runs < max_runs:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        req_id = request.experiment_id + ':' + request.run_id
+        logging.info('Start model run [' + req_id + '] in child ' + str(os.getpid()))
+        try:
+            worker.run(request)
+        except Exception as ex:
+            logging.exception(ex)
+        logging.info('Done [' + req_id + ']')
+        # Maximum resident set size is given in kilobytes on Linux
+        conn.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        runs += 1
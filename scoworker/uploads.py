@@ -0,0 +1,145 @@
+"""Background uploads of model run results. Result files are uploaded by a
+bounded number of concurrent threads. Uploads that fail because of transport
+errors (e.g., a dropped connection) are retried with exponential backoff.
+Errors that are reported by the server (raised as ValueError by the SCO
+client) are not retried.
+"""
+
+import logging
+import threading
+import time
+
+from workflow import BackgroundTask
+
+
+# Default number of concurrent uploads
+UPLOAD_THREADS = 4
+
+# Default number of retries for uploads that fail with a transport error
+UPLOAD_RETRIES = 3
+
+# Initial and maximum delay before an upload is retried (in seconds)
+UPLOAD_DELAY = 1.0
+MAX_UPLOAD_DELAY = 30.0
+
+
+class Uploader(object):
+    """Run uploads in background threads with retry.
+
+    Attributes
+    ----------
+    retries : int
+        Number of retries for uploads that fail with a transport error
+    delay : float
+        Initial delay before an upload is retried (in seconds)
+    """
+    def __init__(self, threads=UPLOAD_THREADS, retries=UPLOAD_RETRIES, delay=UPLOAD_DELAY):
+        """Initialize the number of concurrent uploads and the retry policy.
+
+        Parameters
+        ----------
+        threads : int, optional
+            Maximum number of uploads that are running at the same time
+        retries : int, optional
+            Number of retries for uploads that fail with a transport error
+        delay : float, optional
+            Initial delay before an upload is retried (in seconds)
+        """
+        self.slots = threading.Semaphore(threads)
+        self.retries = retries
+        self.delay = delay
+
+    def run(self, func, name, completed=None):
+        """Run an upload in the calling thread. Retries the upload if it fails
+        with a transport error (IOError, which includes the connection errors
+        of the requests library).
+
+        A transport error does not imply that the server did not process the
+        request (e.g., if the connection dropped while waiting for the
+        response). Uploads that are not idempotent should therefore give a
+        function that checks the state on the server before a retry.
+
+        Parameters
+        ----------
+        func : callable
+            Function without arguments that uploads a file
+        name : string
+            Name of the uploaded file (for log messages)
+        completed : callable, optional
+            Function without arguments that returns True if a failed upload
+            has taken effect on the server. The upload is not retried in this
+            case.
+
+        Returns
+        -------
+        any
+            Result of the upload function
+        """
+        delay = self.delay
+        attempt = 0
+        while True:
+            try:
+                with self.slots:
+                    return func()
+            except IOError as ex:
+                if attempt >= self.retries:
+                    raise
+                if not completed is None and is_completed(completed):
+                    logging.info('Upload of %s completed despite error (%s)' % (name, str(ex)))
+                    return None
+                attempt += 1
+                logging.warning(
+                    'Upload of %s failed (%s), retry %d in %.1f s' % (name, str(ex), attempt, delay)
+                )
+                time.sleep(delay)
+                delay = min(2 * delay, MAX_UPLOAD_DELAY)
+
+    def submit(self, func, name, completed=None):
+        """Start an upload in a background thread.
+
+        Parameters
+        ----------
+        func : callable
+            Function without arguments that uploads a file
+        name : string
+            Name of the uploaded file (for log messages)
+        completed : callable, optional
+            Function without arguments that returns True if a failed upload
+            has taken effect on the server (see Uploader.run())
+
+        Returns
+        -------
+        scoworker.workflow.BackgroundTask
+            Background task. The result of the task re-raises any exception
+            of the upload.
+        """
+        task = BackgroundTask(lambda: self.run(func, name, completed=completed))
+        task.start()
+        return task
+
+
+# ------------------------------------------------------------------------------
+#
+# Helper methods
+#
+# ------------------------------------------------------------------------------
+
+def is_completed(completed):
+    """Call a function that checks whether a failed upload has taken effect on
+    the server. The check itself may fail with a transport error. The upload
+    is considered incomplete in this case.
+
+    Parameters
+    ----------
+    completed : callable
+        Function without arguments that returns a boolean
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        return completed()
+    except IOError as ex:
+        logging.warning('Cannot check upload state (%s)' % (str(ex)))
+        return False
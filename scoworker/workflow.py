@@ -4,14 +4,138 @@ from abc import abstractmethod
 import logging
 import os
 import shutil
+import sys
 import tarfile
 import tempfile
+import threading
 
 import sco
-from cortical import create_cortical_image_tar
+from cortical import create_cortical_image_tar, evaluate_cortical_image_data, read_cortical_images
+from incremental import merge_prediction_file
+from plans import CommonValues, SharedValues, canonical_value, node_signatures, value_signature
+from registry import DEFAULT_REGISTRY
+from results import run_fingerprint
 
 
-def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=None):
+# Values that functional cortical images depend on. Runs with the same
+# signature for these values share the functional images.
+FUNCTIONAL_IMAGE_VALUES = [
+    'stimulus',
+    'measurements_filename',
+    'measurement_indices',
+    'measurement_labels',
+    'measurement_pRFs',
+    'max_eccentricity'
+]
+
+
+class BackgroundTask(threading.Thread):
+    """Thread that evaluates a function in the background. Keeps the result or
+    the exception that was raised by the function.
+    """
+    def __init__(self, func):
+        """Initialize the function that is being evaluated.
+
+        Parameters
+        ----------
+        func : callable
+            Function without arguments
+        """
+        super(BackgroundTask, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        """Evaluate the function and keep result or exception."""
+        try:
+            self.value = self.func()
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        """Wait for the function to finish. Re-raises any exception that was
+        raised by the function.
+
+        Returns
+        -------
+        any
+            Result of the function
+        """
+        self.join()
+        if not self.exc_info is None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ModelOutput(object):
+    """Output of the model computation of a model run. Keeps the (lazy) model
+    output together with everything that is needed to generate the result
+    files of the run. If the run was served from the result index the model
+    output is None and the result is set instead.
+
+    Attributes
+    ----------
+    model_def : scomodels.ModelHandle
+        Descriptor for SCO model
+    image_group : Image group handle
+        Handle for image group resource
+    output_dir : string
+        Path to output directory
+    args : dict
+        Model run arguments
+    data : pimms.IMap
+        Model output
+    prediction : numpy.ndarray
+        Prediction matrix
+    pending : list((scoworker.plans.PlanCache, scoworker.plans.PendingEntry))
+        Cache entries that are updated once the run is complete
+    shared_values : scoworker.plans.SharedValues
+        Values that are shared with other runs of the same group (may be None)
+    common_values : scoworker.plans.CommonValues
+        Values that are shared with runs of other models (may be None)
+    signatures : dict(string:string)
+        Node signatures of the model plan (if common values are given)
+    result_index : scoworker.results.ResultIndex
+        Index that the result is added to (may be None)
+    fingerprint : string
+        Fingerprint of the run inputs (if result index is given)
+    result : (string, dict)
+        Prediction file and attachments if served from result index
+    incremental : scoworker.incremental.IncrementalRun
+        Cached and new stimuli of an incremental run (may be None)
+    """
+    def __init__(self, model_def, image_group, output_dir):
+        """Initialize the run information. All other attributes are set by
+        sco_compute().
+
+        Parameters
+        ----------
+        model_def : scomodels.ModelHandle
+            Descriptor for SCO model
+        image_group : Image group handle
+            Handle for image group resource
+        output_dir : string
+            Path to output directory
+        """
+        self.model_def = model_def
+        self.image_group = image_group
+        self.output_dir = output_dir
+        self.args = None
+        self.data = None
+        self.prediction = None
+        self.pending = []
+        self.shared_values = None
+        self.common_values = None
+        self.signatures = None
+        self.result_index = None
+        self.fingerprint = None
+        self.result = None
+        self.incremental = None
+
+
+def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=None, render_processes=1, background_export=True, registry=None, subject_cache=None, stimulus_cache=None, result_index=None, incremental=None, checkpoint=None):
     """Core method to run SCO predictive model. Expects resource handles for
     model run, subject, and image group. Creates results as tar file in given
     output directory.
@@ -33,6 +157,28 @@ def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=No
         Path to output directory
     fmri_data : fMRI handle, optional
         Handle for functional MRI data (either scocli. or scodata.funcdata.FMRIDataHandle). Can be none if no fMRI data is associated with the run experiment .
+    render_processes : int, optional
+        Number of processes used to render cortical images
+    background_export : bool, optional
+        Export model outputs (e.g., prediction file) in a background thread
+        while cortical images are rendered in the same process. Outputs are
+        always exported before rendering if images are rendered by a pool
+        of processes.
+    registry : scoworker.registry.ModelRegistry, optional
+        Registry of built SCO models. Uses the default registry of the process
+        if not given.
+    subject_cache : scoworker.plans.SubjectCache, optional
+        Cache for subject-level intermediate values
+    stimulus_cache : scoworker.plans.StimulusCache, optional
+        Cache for preprocessed stimulus images
+    result_index : scoworker.results.ResultIndex, optional
+        Index of results of previous runs
+    incremental : scoworker.incremental.IncrementalCache, optional
+        Per-image results of previous runs. Only stimuli without cached
+        results are computed and rendered.
+    checkpoint : scoworker.checkpoints.Checkpoint, optional
+        Checkpoint of the run. Node values are written to the checkpoint as
+        soon as they are computed and a restarted run resumes from it.
 
     Returns
     -------
@@ -40,10 +186,84 @@ def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=No
         Path to generated prediction file and dictionary of additional
         attachments
     """
+    output = sco_compute(
+        model_run,
+        model_def,
+        subject,
+        image_group,
+        output_dir,
+        fmri_data=fmri_data,
+        registry=registry,
+        subject_cache=subject_cache,
+        stimulus_cache=stimulus_cache,
+        result_index=result_index,
+        incremental=incremental,
+        checkpoint=checkpoint
+    )
+    return sco_render(
+        output,
+        render_processes=render_processes,
+        background_export=background_export
+    )
+
+
+def sco_compute(model_run, model_def, subject, image_group, output_dir, fmri_data=None, registry=None, subject_cache=None, stimulus_cache=None, result_index=None, shared_values=None, overrides=None, incremental=None, common_values=None, checkpoint=None):
+    """First part of the SCO model run workflow. Runs the model and computes
+    the prediction and all values that are needed for cortical images. See
+    sco_run() for a description of the parameters. Values of plan nodes that
+    are shared with other runs of the same group are taken from (or added to)
+    the optional shared values. Values of plan nodes that are common with
+    runs of other models are taken from (or added to) the optional common
+    values. The optional overrides replace model run arguments (values are
+    given in the representation that is expected by the SCO model).
+
+    Returns
+    -------
+    scoworker.workflow.ModelOutput
+    """
+    output = ModelOutput(model_def, image_group, output_dir)
     # Get subject directory
     subject_dir = subject.data_directory
     # Create list of image files
     image_files = [img.filename for img in image_group.images]
+    # Converted image group options and model run arguments
+    run_args = {}
+    # Add image group options
+    for attr in image_group.options:
+        run_args[attr] = convert_parameter_value(image_group.options[attr].value)
+    # Add run options
+    run_args.update(run_arguments(model_run))
+    if not overrides is None:
+        run_args.update(overrides)
+    # Serve the result of a previous run with identical inputs if available
+    if not result_index is None:
+        output.result_index = result_index
+        output.fingerprint = run_fingerprint(
+            model_def,
+            subject,
+            image_group,
+            fmri_data,
+            run_args
+        )
+        output.result = result_index.get(output.fingerprint, output_dir)
+        logging.info(
+            'Result index hit rate %.3f' % (result_index.hit_rate())
+        )
+        if not output.result is None:
+            logging.info('Reuse result ' + output.fingerprint + ' for ' + model_def.identifier)
+            return output
+    # Only compute stimuli that have no result in the incremental cache. Not
+    # combined with shared values since the stimuli may differ between the
+    # runs of a group.
+    if not incremental is None and shared_values is None:
+        output.incremental = incremental.prepare(
+            model_def,
+            subject,
+            fmri_data,
+            run_args,
+            image_files
+        )
+        image_files = output.incremental.stimulus(image_files)
     # Compose run arguments from image group options and model run arguments.
     args = {'subject' : subject_dir, 'stimulus' : image_files, 'output_directory' : output_dir}
     # Set ground truth data (directory) if fMRI data handle is given
@@ -51,23 +271,144 @@ def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=No
         args['measurements_filename'] = fmri_data.data_file
     else:
         args['measurements_filename'] = None
-    # Add image group options
-    for attr in image_group.options:
-        args[attr] = convert_parameter_value(image_group.options[attr].value)
-    # Add run options
-    for attr in model_run.arguments:
-        args[attr] = convert_parameter_value(model_run.arguments[attr].value)
+    args.update(run_args)
+    output.args = args
     # Run model. Exceptions are not caught here to allow callers to adjust run
     # run states according to their respective implementations (i.e., remote or
     # local worker will use different methods to change run state).
     logging.info('Run ' + model_def.identifier + ' with ' + str(args))
-    model = sco.build_model(model_def.identifier)
-    data  = model(args)
-    output_files = data['exported_files']
+    if registry is None:
+        registry = DEFAULT_REGISTRY
+    model = registry.get(model_def)
+    # Node signatures are computed before any nodes are replaced by cached
+    # values (which changes the node signatures)
+    if not common_values is None:
+        output.common_values = common_values
+        output.signatures = node_signatures(model, args)
+    # Reuse subject-level intermediate values of previous runs
+    if not subject_cache is None:
+        model, subject_entry = subject_cache.prepare_run(
+            model,
+            model_def,
+            subject_dir,
+            args
+        )
+        output.pending.append((subject_cache, subject_entry))
+    # Reuse preprocessed stimulus images of previous runs
+    if not stimulus_cache is None:
+        model, stimulus_entry = stimulus_cache.prepare_run(
+            model,
+            model_def,
+            image_files,
+            args
+        )
+        output.pending.append((stimulus_cache, stimulus_entry))
+    # Reuse values that have been computed by another run of the same group
+    if not shared_values is None:
+        model = shared_values.prepare(model)
+        output.shared_values = shared_values
+    # Reuse values that have been computed by runs of other models
+    if not common_values is None:
+        model = common_values.prepare(model, output.signatures)
+        output.pending.append((common_values, output.signatures))
+    # Resume from the checkpoint of an interrupted run
+    if not checkpoint is None:
+        model = checkpoint.prepare(model, args)
+    output.data = model(args)
+    # The prediction matrix is passed to the cortical image generator directly
+    # instead of reading it back from the exported prediction file.
+    output.prediction = output.data['prediction']
+    if not output.incremental is None:
+        output.prediction = output.incremental.merge(output.prediction)
+    # Evaluate all values that are needed for cortical images. The lazy model
+    # output is not thread-safe, i.e., the export thread and the rendering code
+    # should not compute the same values concurrently.
+    evaluate_cortical_image_data(output.data, args['measurements_filename'])
+    return output
+
+
+def sco_render(output, render_processes=1, background_export=True):
+    """Second part of the SCO model run workflow. Generates cortical images
+    and exports model outputs for a model output that was returned by
+    sco_compute(). See sco_run() for a description of the parameters.
+
+    Parameters
+    ----------
+    output : scoworker.workflow.ModelOutput
+        Output of model computation
+    render_processes : int, optional
+        Number of processes used to render cortical images
+    background_export : bool, optional
+        Export model outputs in a background thread (only if images are
+        rendered in a single process)
+
+    Returns
+    -------
+    string, dict(string:string)
+        Path to generated prediction file and dictionary of additional
+        attachments
+    """
+    # Nothing to do if the result was served from the result index
+    if not output.result is None:
+        return output.result
+    data = output.data
+    args = output.args
+    output_dir = output.output_dir
+    image_group = output.image_group
+    # The render pool must not be forked while the export thread is running
+    # (the child processes could inherit locks that are held by the thread)
+    if background_export and render_processes == 1:
+        export = BackgroundTask(lambda: data['exported_files'])
+        export.start()
+    else:
+        export = None
+        output_files = data['exported_files']
+    cached_images = dict()
+    if not output.incremental is None:
+        cached_images.update(output.incremental.cached_images())
+    # Functional images are rendered only once for all runs that share the
+    # values that these images depend on
+    func_key = None
+    if not output.common_values is None and not args['measurements_filename'] is None:
+        func_key = value_signature(
+            data.plan,
+            output.signatures,
+            args,
+            FUNCTIONAL_IMAGE_VALUES
+        )
+        if func_key in output.common_values.images:
+            cached_images.update(output.common_values.images[func_key])
+    try:
+        cortical_tar = create_cortical_image_tar(
+            data,
+            image_group,
+            args['measurements_filename'],
+            output_dir,
+            processes=render_processes,
+            prediction=output.prediction,
+            cached_images=cached_images
+        )
+    finally:
+        # Wait for the model to finish exporting files (even if rendering
+        # failed, to make sure that nothing is written to the output directory
+        # afterwards).
+        if not export is None:
+            export.join()
+    # Raises any exception that occurred during export.
+    if not export is None:
+        output_files = export.result()
     prediction_file = os.path.join(
         output_dir,
-        model_def.outputs.prediction_file.filename
+        output.model_def.outputs.prediction_file.filename
     )
+    # The exported prediction file of an incremental run only contains the
+    # new stimuli
+    if not output.incremental is None:
+        merge_prediction_file(
+            prediction_file,
+            data['cortex_indices'],
+            output.prediction
+        )
     attachments = {}
     # Overwrite the generated images file with folders and names of images
     # in image group
@@ -77,21 +418,151 @@ def sco_run(model_run, model_def, subject, image_group, output_dir, fmri_data=No
             f.write(img.folder + img.name + '\n')
     # Add image list file as attachments
     attachments['images.txt'] = (image_list_file, 'text/plain')
-    cortical_tar = create_cortical_image_tar(
-        data,
-        image_group,
-        args['measurements_filename'],
-        output_dir
-    )
     attachments[cortical_tar] = (
         os.path.join(output_dir, cortical_tar),
         'application/tar'
     )
 
+    # Add subject-level intermediate values and preprocessed stimulus images
+    # to the caches
+    for cache, entry in output.pending:
+        try:
+            cache.update(entry, data)
+        except Exception as ex:
+            logging.exception(ex)
+    if not output.shared_values is None:
+        output.shared_values.update(data)
+    if not func_key is None and not func_key in output.common_values.images:
+        output.common_values.images[func_key] = read_cortical_images(
+            os.path.join(output_dir, cortical_tar),
+            'FUNCTIONAL'
+        )
+    if not output.incremental is None:
+        try:
+            output.incremental.update(
+                output.prediction,
+                os.path.join(output_dir, cortical_tar)
+            )
+        except Exception as ex:
+            logging.exception(ex)
+    # Add the result to the result index
+    if not output.result_index is None:
+        try:
+            output.result_index.put(output.fingerprint, prediction_file, attachments)
+        except Exception as ex:
+            logging.exception(ex)
     # Return information about generated files
     return prediction_file, attachments
 
 
+def sco_sweep(model_run, model_def, subject, image_group, overrides, output_dirs, fmri_data=None, render_processes=1, background_export=True, registry=None, subject_cache=None, stimulus_cache=None, result_index=None):
+    """Run a parameter sweep, i.e., a series of runs of the same model for the
+    same subject and image group that only differ in some of the model run
+    arguments. The base model run defines all arguments. Each parameter set
+    overrides some of them. Values of plan nodes that do not depend on any of
+    the overridden arguments are computed only once. See sco_run() for a
+    description of the other parameters.
+
+    Parameters
+    ----------
+    model_run : Model Run handle
+        Handle for the base model run
+    overrides : list(dict)
+        Argument values for each parameter set (in the representation that
+        is expected by the SCO model)
+    output_dirs : list(string)
+        Output directory for each parameter set
+
+    Returns
+    -------
+    list
+        For each parameter set either the path to the generated prediction
+        file and the dictionary of attachments or the exception that was
+        raised
+    """
+    varying = set()
+    for values in overrides:
+        varying.update(values.keys())
+    shared_values = SharedValues(varying)
+    results = []
+    for values, output_dir in zip(overrides, output_dirs):
+        try:
+            output = sco_compute(
+                model_run,
+                model_def,
+                subject,
+                image_group,
+                output_dir,
+                fmri_data=fmri_data,
+                registry=registry,
+                subject_cache=subject_cache,
+                stimulus_cache=stimulus_cache,
+                result_index=result_index,
+                shared_values=shared_values,
+                overrides=values
+            )
+            results.append(sco_render(
+                output,
+                render_processes=render_processes,
+                background_export=background_export
+            ))
+        except Exception as ex:
+            logging.exception(ex)
+            results.append(ex)
+    return results
+
+
+def sco_evaluate(model_runs, model_defs, subject, image_group, output_dirs, fmri_data=None, render_processes=1, background_export=True, registry=None, subject_cache=None, stimulus_cache=None, result_index=None):
+    """Evaluate several models for the same subject, image group, and
+    functional data in a single pass. Values of plan nodes that the models
+    have in common (i.e., nodes with the same calculation function and the
+    same inputs) are computed only once. Functional cortical images are
+    rendered only once for all models that share the measurement values. See
+    sco_run() for a description of the other parameters.
+
+    Parameters
+    ----------
+    model_runs : list(Model Run handle)
+        Handle for the model run of each model
+    model_defs : list(scomodels.ModelHandle)
+        Descriptor for each model
+    output_dirs : list(string)
+        Output directory for each model run
+
+    Returns
+    -------
+    list
+        For each model run either the path to the generated prediction file
+        and the dictionary of attachments or the exception that was raised
+    """
+    common_values = CommonValues()
+    results = []
+    for model_run, model_def, output_dir in zip(model_runs, model_defs, output_dirs):
+        try:
+            output = sco_compute(
+                model_run,
+                model_def,
+                subject,
+                image_group,
+                output_dir,
+                fmri_data=fmri_data,
+                registry=registry,
+                subject_cache=subject_cache,
+                stimulus_cache=stimulus_cache,
+                result_index=result_index,
+                common_values=common_values
+            )
+            results.append(sco_render(
+                output,
+                render_processes=render_processes,
+                background_export=background_export
+            ))
+        except Exception as ex:
+            logging.exception(ex)
+            results.append(ex)
+    return results
+
+
 def convert_parameter_value(db_value):
     """Converter for parameter values. Converts a parameter value from its
     storage format in the database into the representation that is expected by
@@ -120,3 +591,50 @@ def convert_parameter_value(db_value):
         return result
     else:
         return db_value
+
+
+def run_arguments(model_run):
+    """Get the arguments of a model run in the representation that is
+    expected by the SCO model.
+
+    Parameters
+    ----------
+    model_run : Model Run handle
+        Handle for model run resource
+
+    Returns
+    -------
+    dict
+    """
+    args = {}
+    for attr in model_run.arguments:
+        args[attr] = convert_parameter_value(model_run.arguments[attr].value)
+    return args
+
+
+def varying_arguments(model_runs):
+    """Get the names of all model run arguments whose values differ between
+    the given model runs (including arguments that are not given for all
+    runs).
+
+    Parameters
+    ----------
+    model_runs : list(Model Run handle)
+        Handles for model run resources
+
+    Returns
+    -------
+    set(string)
+    """
+    values = {}
+    for model_run in model_runs:
+        args = run_arguments(model_run)
+        for attr in args:
+            values.setdefault(attr, set()).add(canonical_value(args[attr]))
+    varying = set()
+    for attr in values:
+        if len(values[attr]) > 1:
+            varying.add(attr)
+        elif len([r for r in model_runs if attr in r.arguments]) < len(model_runs):
+            varying.add(attr)
+    return varying
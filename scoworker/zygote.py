@@ -0,0 +1,62 @@
+"""Preloading of modules and data for warm worker processes. Importing the
+SCO model and its dependencies and loading the average subject takes several
+seconds. In zygote mode, the supervisor loads everything once and forks a new
+child process for every model run. The children share the loaded pages with
+the supervisor (copy-on-write) and start without any of the loading cost.
+"""
+
+import gc
+import importlib
+import logging
+import time
+
+from neuropythy.freesurfer import add_subject_path
+
+from registry import DEFAULT_REGISTRY
+
+
+# Modules that are imported by the zygote
+PRELOAD_MODULES = ['numpy', 'nibabel', 'pint', 'pimms', 'neuropythy', 'sco']
+
+# Name of the average subject
+AVERAGE_SUBJECT = 'fsaverage_sym'
+
+
+def preload(env_subject, model_ids=None):
+    """Import all modules that are used by model runs, load the average
+    subject, and build the given models in the default model registry.
+
+    Parameters
+    ----------
+    env_subject : string
+        Path to directory containing subject fsaverage_sym.
+    model_ids : list(string), optional
+        Identifiers of models that are built
+
+    Returns
+    -------
+    float
+        Time spent on loading (in seconds)
+    """
+    start = time.time()
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    add_subject_path(env_subject)
+    # Load the average subject (if supported by the installed version of
+    # neuropythy)
+    neuropythy = importlib.import_module('neuropythy')
+    load_subject = getattr(neuropythy, 'freesurfer_subject', None)
+    if not load_subject is None:
+        try:
+            load_subject(AVERAGE_SUBJECT)
+        except Exception as ex:
+            logging.exception(ex)
+    if not model_ids is None:
+        for model_id in model_ids:
+            DEFAULT_REGISTRY.preload(model_id)
+    # Collect garbage before forking to avoid that children copy pages when
+    # the garbage collector runs for the first time.
+    gc.collect()
+    elapsed = time.time() - start
+    logging.info('Preload : [%.3f s]' % (elapsed))
+    return elapsed
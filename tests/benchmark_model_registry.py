@@ -0,0 +1,48 @@
+"""Benchmark for the per-process model registry. Compares the latency of
+getting a model from a cold registry (i.e., building the pimms plan, as done
+for every run before) with the latency of getting the model from a warm
+registry. Also reports the cost of sco.reload_sco() that was previously called
+during every run.
+
+Usage: python benchmark_model_registry.py [<model-id> [<repeat>]]
+"""
+
+import sys
+import time
+
+import sco
+
+from scoworker.registry import ModelRegistry
+
+
+class ModelDefinition(object):
+    """Minimal stand-in for scoengine.ModelHandle."""
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+def timed(func, repeat):
+    """Average run time of func (in milliseconds)."""
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) * 1000.0 / repeat
+
+
+if __name__ == '__main__':
+    model_id = sys.argv[1] if len(sys.argv) > 1 else 'benson17'
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    model_def = ModelDefinition(model_id)
+    # Cold: new registry for every request
+    t_cold = timed(lambda: ModelRegistry().get(model_def), repeat)
+    # Warm: the same registry is used for all requests
+    registry = ModelRegistry()
+    registry.get(model_def)
+    t_warm = timed(lambda: registry.get(model_def), repeat)
+    # Reload of the sco package
+    t_reload = timed(sco.reload_sco, max(1, repeat / 10))
+    print 'Model ' + model_id
+    print 'cold registry : %10.3f ms' % t_cold
+    print 'warm registry : %10.3f ms' % t_warm
+    print 'reload_sco()  : %10.3f ms' % t_reload
+    print 'saved per run : %10.3f ms' % (t_cold + t_reload - t_warm)
@@ -0,0 +1,54 @@
+"""Benchmark for the startup latency of worker processes. Compares a cold
+start (new Python process that imports all modules and loads the average
+subject) with a warm start (child that is forked from a process where
+everything has been preloaded, as done in zygote mode).
+
+Usage: python benchmark_startup.py <subject_dir> [<model-id> [<repeat>]]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+from scoworker.zygote import preload
+
+
+# Script that is run by a cold worker process
+COLD_START = 'import sys; from scoworker.zygote import preload; preload(sys.argv[1], model_ids=sys.argv[2:])'
+
+
+def cold_start(env_subject, model_ids):
+    """Wall time of starting a new worker process (in seconds)."""
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', COLD_START, env_subject] + model_ids)
+    return time.time() - start
+
+
+def warm_start():
+    """Wall time of forking a worker process from the current process (in
+    seconds). The child touches the preloaded modules before it exits.
+    """
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        import sco
+        sco.build_model
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit()
+    env_subject = sys.argv[1]
+    model_ids = [sys.argv[2]] if len(sys.argv) > 2 else []
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    t_cold = sum([cold_start(env_subject, model_ids) for i in range(repeat)]) / repeat
+    t_preload = preload(env_subject, model_ids=model_ids)
+    t_warm = sum([warm_start() for i in range(repeat)]) / repeat
+    print 'cold start : %10.3f s' % t_cold
+    print 'preload    : %10.3f s (once)' % t_preload
+    print 'warm start : %10.3f s' % t_warm
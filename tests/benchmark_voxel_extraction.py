@@ -0,0 +1,72 @@
+"""Benchmark for the extraction of voxel time series from 4-D NIfTI volumes.
+Compares the original voxel-by-voxel extraction in create_cortical_image_tar
+with the batched extractor scoworker.cortical.extract_voxels on a synthetic
+volume (uncompressed and gzipped).
+
+Usage: python benchmark_voxel_extraction.py [<voxels> [<images>]]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+from scoworker.cortical import extract_voxels
+
+
+# Shape of the synthetic volume (without the image dimension)
+VOLUME_SHAPE = (128, 128, 128)
+
+
+def extract_voxels_loop(filename, indices):
+    """Original extraction code. Loads the whole volume and collects voxel
+    time series one at a time.
+    """
+    dat = nib.load(filename).dataobj.get_unscaled()
+    return np.asarray([dat[ii,jj,kk,:] for (ii,jj,kk) in indices])
+
+
+def benchmark(filename, indices, repeat=3):
+    """Time both extractors on the given file. Returns the best run time (in
+    seconds) for the original and batched extractor.
+    """
+    t_loop = []
+    t_batch = []
+    for i in range(repeat):
+        start = time.time()
+        loop_result = extract_voxels_loop(filename, indices)
+        t_loop.append(time.time() - start)
+        start = time.time()
+        batch_result = extract_voxels(filename, indices)
+        t_batch.append(time.time() - start)
+        if not np.array_equal(loop_result, batch_result):
+            raise ValueError('extractor results differ for ' + filename)
+    return min(t_loop), min(t_batch)
+
+
+if __name__ == '__main__':
+    n_voxels = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_images = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    temp_dir = tempfile.mkdtemp()
+    try:
+        volume = np.random.rand(*(VOLUME_SHAPE + (n_images,))).astype(np.float32)
+        # Random set of distinct voxel indices
+        flat = np.random.choice(np.prod(VOLUME_SHAPE), n_voxels, replace=False)
+        indices = np.transpose(np.unravel_index(flat, VOLUME_SHAPE))
+        print 'Volume ' + str(volume.shape) + ', ' + str(n_voxels) + ' voxels'
+        for suffix in ['.nii', '.nii.gz']:
+            filename = os.path.join(temp_dir, 'prediction' + suffix)
+            nib.Nifti1Image(volume, np.eye(4)).to_filename(filename)
+            t_loop, t_batch = benchmark(filename, indices)
+            print '%-8s loop: %8.3fs  batched: %8.3fs  speedup: %6.1fx' % (
+                suffix,
+                t_loop,
+                t_batch,
+                t_loop / t_batch
+            )
+    finally:
+        shutil.rmtree(temp_dir)
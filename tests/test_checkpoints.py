@@ -0,0 +1,106 @@
+"""Test checkpoints and resume of interrupted model runs. Uses a small pimms
+plan in place of an SCO model.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pimms
+
+from scoworker.checkpoints import CheckpointStore
+
+
+# List of names of nodes that were evaluated by the test plan
+CALLS = []
+
+# Simulate a worker that dies while computing the prediction
+FAIL = []
+
+
+@pimms.calc('image_array')
+def calc_images(stimulus, pixels_per_degree=6):
+    CALLS.append('images')
+    return np.arange(len(stimulus)) * pixels_per_degree
+
+
+@pimms.calc('prediction')
+def calc_prediction(image_array, scale):
+    CALLS.append('prediction')
+    if len(FAIL) > 0:
+        raise RuntimeError('worker died')
+    return image_array * scale
+
+
+@pimms.calc('exported_files')
+def calc_export(prediction, output_directory):
+    CALLS.append('export')
+    return [os.path.join(output_directory, 'prediction.npy')]
+
+
+PLAN = pimms.plan(
+    images=calc_images,
+    prediction=calc_prediction,
+    export=calc_export
+)
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory for checkpoints."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.args = {'stimulus' : ['a', 'b', 'c'], 'scale' : 2, 'output_directory' : 'out'}
+        del CALLS[:]
+        del FAIL[:]
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_resume(self):
+        """Test that a restarted run resumes from the last computed node."""
+        store = CheckpointStore(os.path.join(self.temp_dir, 'checkpoints'))
+        FAIL.append(True)
+        data = store.checkpoint('run').prepare(PLAN, self.args)(self.args)
+        with self.assertRaises(RuntimeError):
+            data['exported_files']
+        self.assertEqual(CALLS, ['images', 'prediction'])
+        # The restarted run does not compute the images again
+        del CALLS[:]
+        del FAIL[:]
+        data = store.checkpoint('run').prepare(PLAN, self.args)(self.args)
+        self.assertTrue(np.array_equal(data['prediction'], [0, 12, 24]))
+        data['exported_files']
+        self.assertEqual(CALLS, ['prediction', 'export'])
+        # Checkpoints for different arguments are not used
+        del CALLS[:]
+        self.args['scale'] = 3
+        data = store.checkpoint('run').prepare(PLAN, self.args)(self.args)
+        self.assertTrue(np.array_equal(data['prediction'], [0, 18, 36]))
+        self.assertEqual(CALLS, ['images', 'prediction'])
+        # Removed checkpoints are not used
+        store.remove('run')
+        self.assertFalse(os.path.isdir(store.checkpoint_path('run')))
+        del CALLS[:]
+        store.checkpoint('run').prepare(PLAN, self.args)(self.args)['prediction']
+        self.assertEqual(CALLS, ['images', 'prediction'])
+
+    def test_sweep(self):
+        """Test removing stale checkpoints."""
+        directory = os.path.join(self.temp_dir, 'checkpoints')
+        store = CheckpointStore(directory)
+        store.checkpoint('a').prepare(PLAN, self.args)
+        store.checkpoint('b').prepare(PLAN, self.args)
+        stale = time.time() - 3600
+        os.utime(store.checkpoint_path('a'), (stale, stale))
+        CheckpointStore(directory, max_age=60)
+        self.assertFalse(os.path.isdir(store.checkpoint_path('a')))
+        self.assertTrue(os.path.isdir(store.checkpoint_path('b')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Test the asynchronous request consumer without a RabbitMQ server. Messages
+are delivered by calling the consumer's message handler directly.
+"""
+
+import json
+import threading
+import time
+import unittest
+
+import scoworker.consumer as consumer
+from scoworker.consumer import BatchDispatcher, Dispatcher, RequestConsumer
+
+
+class Request(object):
+    """Minimal stand-in for scoengine.ModelRunRequest."""
+    def __init__(self, experiment_id, run_id):
+        self.experiment_id = experiment_id
+        self.run_id = run_id
+
+    @staticmethod
+    def from_dict(obj):
+        return Request(obj['experiment_id'], obj['run_id'])
+
+
+class Channel(object):
+    """Channel that records acknowledgements."""
+    def __init__(self):
+        self.is_open = True
+        self.acks = []
+
+    def basic_ack(self, delivery_tag=0):
+        self.acks.append(delivery_tag)
+
+
+class Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+def message(run_id):
+    return json.dumps({'experiment_id' : 'experiment', 'run_id' : run_id})
+
+
+class TestConsumer(unittest.TestCase):
+
+    def setUp(self):
+        """Use stand-in for model run requests."""
+        self.request_class = consumer.ModelRunRequest
+        consumer.ModelRunRequest = Request
+
+    def tearDown(self):
+        consumer.ModelRunRequest = self.request_class
+
+    def test_in_flight(self):
+        """Test that duplicates and redeliveries of active requests are not
+        executed again and that requests are acknowledged on the current
+        channel.
+        """
+        submitted = []
+        dispatcher = Dispatcher(lambda request, callback: submitted.append((request.run_id, callback)))
+        requests = RequestConsumer(None, 'sco', dispatcher)
+        channel = requests.channel = Channel()
+        requests.on_message(channel, Method(1), None, message('a'))
+        requests.on_message(channel, Method(2), None, message('b'))
+        requests.on_message(channel, Method(3), None, message('a'))
+        requests.on_message(channel, Method(4), None, 'invalid')
+        # Duplicate and invalid messages are acknowledged immediately
+        self.assertEqual(channel.acks, [3, 4])
+        dispatcher.start()
+        while len(submitted) < 2:
+            time.sleep(0.01)
+        dispatcher.close()
+        self.assertEqual([r for r, c in submitted], ['a', 'b'])
+        # Reconnect. Request 'a' is redelivered while it is still running.
+        channel.is_open = False
+        new_channel = requests.channel = Channel()
+        requests.on_message(new_channel, Method(1), None, message('a'))
+        self.assertEqual(len(submitted), 2)
+        requests.acknowledge('experiment:a')
+        requests.acknowledge('experiment:b')
+        self.assertEqual(new_channel.acks, [1])
+        self.assertEqual(channel.acks, [3, 4])
+        self.assertEqual(requests.in_flight, {})
+
+    def test_redelivery_while_running(self):
+        """Test that a request that is redelivered after a reconnect while its
+        model run is executed is neither run again nor acknowledged before the
+        run is done.
+        """
+        running = threading.Event()
+        done = threading.Event()
+        runs = []
+        def run(request, callback):
+            runs.append(request.run_id)
+            running.set()
+            done.wait()
+            callback()
+        dispatcher = Dispatcher(run)
+        requests = RequestConsumer(None, 'sco', dispatcher)
+        # Acknowledge in the dispatcher thread instead of the I/O loop
+        requests.complete = requests.acknowledge
+        channel = requests.channel = Channel()
+        dispatcher.start()
+        requests.on_message(channel, Method(1), None, message('a'))
+        running.wait()
+        channel.is_open = False
+        new_channel = requests.channel = Channel()
+        requests.on_message(new_channel, Method(7), None, message('a'))
+        self.assertEqual(new_channel.acks, [])
+        done.set()
+        while len(requests.in_flight) > 0:
+            time.sleep(0.01)
+        dispatcher.close()
+        self.assertEqual(runs, ['a'])
+        self.assertEqual(channel.acks, [])
+        self.assertEqual(new_channel.acks, [7])
+
+    def test_dispatcher_poll(self):
+        """Test that the dispatcher polls regularly while it is idle."""
+        polled = threading.Event()
+        dispatcher = Dispatcher(None, poll=polled.set, interval=0.01)
+        dispatcher.start()
+        self.assertTrue(polled.wait(1.0))
+        dispatcher.close()
+
+    def test_batches(self):
+        """Test that requests are handed over in batches of limited size."""
+        batches = []
+        dispatcher = BatchDispatcher(
+            lambda requests, callbacks: batches.append(requests),
+            3,
+            0.2
+        )
+        for i in range(4):
+            dispatcher.put(i, None)
+        dispatcher.start()
+        # The last batch is incomplete and submitted after the wait time
+        start = time.time()
+        while len(batches) < 2:
+            time.sleep(0.01)
+        self.assertTrue(time.time() - start >= 0.15)
+        dispatcher.put(4, None)
+        dispatcher.close()
+        self.assertEqual(batches, [[0, 1, 2], [3], [4]])
+
+    def test_queued_batches(self):
+        """Test that queued requests are handed over in batches without wait
+        time.
+        """
+        batches = []
+        dispatcher = BatchDispatcher(
+            lambda requests, callbacks: batches.append(requests),
+            4,
+            0
+        )
+        for i in range(10):
+            dispatcher.put(i, None)
+        dispatcher.start()
+        dispatcher.close()
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+
+if __name__ == '__main__':
+    unittest.main()
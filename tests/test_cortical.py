@@ -0,0 +1,170 @@
+"""Test rendering of cortical images in a single process and in a pool of
+processes. Uses a replacement for sco.util.cortical_image() that serializes
+the values and pRF geometries an image is rendered from.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+import pimms
+
+import scoworker.cortical as cortical
+
+
+class Figure(object):
+    """Figure that writes a given string instead of a PNG image."""
+    def __init__(self, content):
+        self.content = content
+
+    def clf(self):
+        pass
+
+    def savefig(self, f, format=None):
+        if isinstance(f, basestring):
+            with open(f, 'wb') as fout:
+                fout.write(self.content)
+        else:
+            f.write(self.content)
+
+
+class Image(object):
+    """Minimal stand-in for the images of an image group."""
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+class ImageGroup(object):
+    """Minimal stand-in for image group handles."""
+    def __init__(self, count):
+        self.images = [Image('image' + str(i)) for i in range(count)]
+
+
+class PRF(object):
+    """pRF with center and radius as quantities (as generated by the SCO
+    model).
+    """
+    def __init__(self, x, y, radius):
+        self.center = pimms.quant(np.asarray([x, y]), 'deg')
+        self.radius = pimms.quant(radius, 'deg')
+
+
+class SCO(object):
+    """Replacement for the sco module."""
+    def __init__(self):
+        self.util = self
+
+    def cortical_image(self, prediction, labels, pRFs, max_eccentricity, image_number=None, visual_area=1, **kwargs):
+        geometry = [
+            (tuple(pimms.mag(p.center, 'deg')), float(pimms.mag(p.radius, 'deg')))
+                for p, l in zip(pRFs, labels) if l == visual_area
+        ]
+        return Figure(repr((list(prediction[:, image_number]), geometry, sorted(kwargs.items()))))
+
+
+class TestCorticalImages(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory and replace the sco module."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.sco = cortical.sco
+        cortical.sco = SCO()
+
+    def tearDown(self):
+        """Delete temporary directory and restore the sco module."""
+        cortical.sco = self.sco
+        shutil.rmtree(self.temp_dir)
+
+    def read_tar(self, filename):
+        """Get list of (name, content) pairs for all members of a tar file."""
+        members = []
+        tar = tarfile.open(filename, 'r')
+        try:
+            for member in tar.getmembers():
+                members.append((member.name, tar.extractfile(member).read()))
+        finally:
+            tar.close()
+        return members
+
+    def test_render_processes(self):
+        """Test that images rendered by a pool of processes are the same as
+        images rendered in a single process.
+        """
+        labels = np.asarray([1, 1, 2, 2, 3])
+        pRFs = [PRF(i, -i, 0.5 * i) for i in range(len(labels))]
+        render_data = {
+            'FUNCTIONAL' : (np.arange(10.0).reshape(5, 2), labels, pRFs),
+            'PREDICTION' : (np.arange(15.0).reshape(5, 3) / 7, labels, pRFs)
+        }
+        tasks = [
+            (img_type, imno, va)
+                for img_type, count in [('FUNCTIONAL', 2), ('PREDICTION', 3)]
+                    for imno in range(count)
+                        for va in [1, 2, 3]
+        ]
+        max_eccentricity = pimms.quant(12.0, 'deg')
+        serial = list(cortical.render_cortical_images(render_data, max_eccentricity, tasks))
+        pooled = list(cortical.render_cortical_images(render_data, max_eccentricity, tasks, processes=2))
+        self.assertEqual(len(serial), len(tasks))
+        self.assertEqual(serial, pooled)
+        self.assertEqual(len(set(content for name, content in serial)), len(tasks))
+        # The rendering processes are stopped if the caller stops consuming
+        # the results
+        images = cortical.render_cortical_images(render_data, max_eccentricity, tasks, processes=2)
+        self.assertEqual(next(images), serial[0])
+        images.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_stream(self):
+        """Test that a streamed tar file has the same members in the same
+        order as a tar file that is created from rendered image files.
+        """
+        labels = np.asarray([1, 2, 3, 1])
+        pRFs = [PRF(i, 1, 0.5) for i in range(len(labels))]
+        indices = [(0, 0, i) for i in range(len(labels))]
+        func_filename = os.path.join(self.temp_dir, 'func.nii.gz')
+        nib.save(
+            nib.Nifti1Image(np.arange(24.0).reshape(1, 1, 4, 6), np.eye(4)),
+            func_filename
+        )
+        data = {
+            'cortex_indices' : indices,
+            'measurement_indices' : indices,
+            'labels' : labels,
+            'pRFs' : pRFs,
+            'measurement_labels' : labels,
+            'measurement_pRFs' : pRFs,
+            'max_eccentricity' : pimms.quant(12.0, 'deg')
+        }
+        prediction = np.arange(8.0).reshape(4, 2)
+        # One of the images is taken from the cached images
+        cached_images = {'pred_1.v2.png' : 'cached'}
+        members = []
+        for stream in [True, False]:
+            output_dir = tempfile.mkdtemp(dir=self.temp_dir)
+            cortical.create_cortical_image_tar(
+                data,
+                ImageGroup(2),
+                func_filename,
+                output_dir,
+                stream=stream,
+                prediction=prediction,
+                cached_images=cached_images
+            )
+            members.append(self.read_tar(os.path.join(output_dir, cortical.DEFAULT_TARFILE_NAME)))
+            # The temporary image directory is removed
+            self.assertEqual(os.listdir(output_dir), [cortical.DEFAULT_TARFILE_NAME])
+        self.assertEqual(members[0], members[1])
+        names = [name for name, content in members[0]]
+        self.assertEqual(names[0], 'index.csv')
+        self.assertEqual(len(names), 13)
+        self.assertEqual(dict(members[0])['pred_1.v2.png'], 'cached')
+
+
+if __name__ == '__main__':
+    unittest.main()
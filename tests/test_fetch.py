@@ -0,0 +1,142 @@
+"""Test concurrent fetching of model run resources in the remote worker. Uses
+resource handles that fail or return after a given delay.
+"""
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from scoworker import SCOClientWorker
+
+
+class Resource(object):
+    """Resource that is returned after a delay. Raises ValueError instead if
+    the resource is marked as missing.
+    """
+    def __init__(self, name, delay=0.0, missing=False):
+        self.name = name
+        self.delay = delay
+        self.missing = missing
+
+    def get(self):
+        time.sleep(self.delay)
+        if self.missing:
+            raise ValueError('missing ' + self.name)
+        return self.name
+
+
+class Experiment(object):
+    """Experiment handle with functional data, subject, and image group."""
+    def __init__(self, resources):
+        self.resources = resources
+        self.fmri_url = 'fmri-url'
+        self.image_group_url = 'images-url'
+
+    @property
+    def fmri_data(self):
+        return self.resources['fmri'].get()
+
+    @property
+    def image_group(self):
+        return self.resources['images'].get()
+
+    @property
+    def subject(self):
+        return self.resources['subject'].get()
+
+
+class ModelRun(object):
+    """Model run handle that records state changes to FAILED."""
+    def __init__(self, **kwargs):
+        self.resources = {
+            name : Resource(name)
+                for name in ['experiment', 'fmri', 'subject', 'images', 'model']
+        }
+        self.resources.update(kwargs)
+        self.experiment_url = 'experiment-url'
+        self.model_url = 'model-url'
+        self.subject_url = 'subject-url'
+        self.errors = []
+
+    @property
+    def experiment(self):
+        self.resources['experiment'].get()
+        return Experiment(self.resources)
+
+    @property
+    def model(self):
+        return self.resources['model'].get()
+
+    def update_state_error(self, *args):
+        self.errors.append(args)
+
+
+class TestFetchResources(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory for worker environment."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.worker = SCOClientWorker(None, self.temp_dir)
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_concurrent_fetch(self):
+        """Test that resources are fetched concurrently."""
+        model_run = ModelRun(**dict(
+            (name, Resource(name, delay=0.2))
+                for name in ['fmri', 'subject', 'images', 'model']
+        ))
+        start = time.time()
+        resources = self.worker.fetch_resources(model_run)
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(resources[1:], ('fmri', 'subject', 'images', 'model'))
+        self.assertEqual(model_run.errors, [])
+
+    def test_error_order(self):
+        """Test that the first failing resource in the order of a sequential
+        fetch is reported even if a later resource fails first.
+        """
+        model_run = ModelRun(
+            subject=Resource('subject', delay=0.2, missing=True),
+            images=Resource('images', missing=True),
+            model=Resource('model', missing=True)
+        )
+        self.assertIsNone(self.worker.fetch_resources(model_run))
+        self.assertEqual(
+            model_run.errors,
+            [(['unknown subject: subject-url', 'missing subject'],)]
+        )
+        # The image group error has the arguments of the sequential fetch
+        model_run = ModelRun(
+            images=Resource('images', delay=0.2, missing=True),
+            model=Resource('model', missing=True)
+        )
+        self.assertIsNone(self.worker.fetch_resources(model_run))
+        self.assertEqual(
+            model_run.errors,
+            [('unknown image group: images-url', ['missing images'])]
+        )
+        # The model is reported after all experiment resources
+        model_run = ModelRun(model=Resource('model', missing=True))
+        self.assertIsNone(self.worker.fetch_resources(model_run))
+        self.assertEqual(
+            model_run.errors,
+            [(['unknown model: model-url', 'missing model'],)]
+        )
+        # A missing experiment is reported before the model
+        model_run = ModelRun(
+            experiment=Resource('experiment', delay=0.2, missing=True),
+            model=Resource('model', missing=True)
+        )
+        self.assertIsNone(self.worker.fetch_resources(model_run))
+        self.assertEqual(
+            model_run.errors,
+            [(['unknown experiment: experiment-url', 'missing experiment'],)]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
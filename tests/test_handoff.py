@@ -0,0 +1,109 @@
+"""Test the zero-copy hand-off of result files to the data store."""
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+from scodata import funcdata, modelrun
+from scoworker.handoff import HandOff
+
+
+class Collection(object):
+    """MongoDB collection that keeps inserted documents in memory."""
+    def __init__(self):
+        self.documents = []
+
+    def insert_one(self, document):
+        self.documents.append(document)
+
+
+class ModelRunManager(modelrun.DefaultModelRunManager):
+    """Model run manager for a single model run without a database."""
+    def __init__(self, model_run):
+        self.model_run = model_run
+
+    def get_object(self, identifier, include_inactive=False):
+        return self.model_run
+
+    def replace_object(self, db_object):
+        pass
+
+
+class TestHandOff(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory with result files."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = []
+        for name in ['prediction.nii.gz', 'images.txt']:
+            filename = os.path.join(self.temp_dir, name)
+            with open(filename, 'w') as f:
+                f.write(name)
+            self.files.append(filename)
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_datastore(self):
+        """Test that the data store links the prediction file and the
+        attachments of a model run.
+        """
+        data_dir = os.path.join(self.temp_dir, 'data')
+        os.makedirs(os.path.join(data_dir, 'run'))
+        funcdata_store = funcdata.DefaultFunctionalDataManager(Collection(), data_dir)
+        model_run = modelrun.ModelRunHandle(
+            'run',
+            {'name' : 'run'},
+            os.path.join(data_dir, 'run'),
+            modelrun.ModelRunSuccess('prediction'),
+            'experiment',
+            'model',
+            {}
+        )
+        predictions = ModelRunManager(model_run)
+        with HandOff(self.files):
+            prediction = funcdata_store.create_object(self.files[0])
+            predictions.create_data_file_attachment('run', 'images.txt', self.files[1])
+        self.assertTrue(os.path.samefile(self.files[0], prediction.upload_file))
+        self.assertTrue(
+            os.path.samefile(
+                self.files[1],
+                os.path.join(model_run.attachment_directory, 'images.txt')
+            )
+        )
+        self.assertTrue(funcdata.shutil is shutil)
+        self.assertTrue(modelrun.shutil is shutil)
+
+    def test_handoff(self):
+        """Test that handed off files are linked and other files are
+        copied.
+        """
+        module = types.ModuleType('handoff_store')
+        module.shutil = shutil
+        sys.modules[module.__name__] = module
+        copyfile = shutil.copyfile
+        target = os.path.join(self.temp_dir, 'target')
+        try:
+            with HandOff(self.files[:1], modules=[module.__name__]):
+                module.shutil.copyfile(self.files[0], target + '0')
+                module.shutil.copy(self.files[1], target + '1')
+                # Copies in other modules are not affected
+                shutil.copyfile(self.files[0], target + '2')
+        finally:
+            del sys.modules[module.__name__]
+        self.assertTrue(module.shutil is shutil)
+        self.assertTrue(shutil.copyfile is copyfile)
+        self.assertEqual(os.stat(self.files[0]).st_nlink, 2)
+        self.assertTrue(os.path.samefile(self.files[0], target + '0'))
+        self.assertFalse(os.path.samefile(self.files[1], target + '1'))
+        self.assertFalse(os.path.samefile(self.files[0], target + '2'))
+        with open(target + '1', 'r') as f:
+            self.assertEqual(f.read(), 'images.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Test the per-image result cache for incremental re-runs."""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+from scoworker.cache import DiskCache
+from scoworker.cortical import add_tar_member, cortical_image_filename
+from scoworker.incremental import IncrementalCache, merge_prediction_file
+
+
+class Resource(object):
+    """Minimal stand-in for resource handles and model definitions."""
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory with image files."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.images = []
+        for i in range(3):
+            filename = os.path.join(self.temp_dir, 'img' + str(i) + '.png')
+            with open(filename, 'w') as f:
+                f.write('image' + str(i))
+            self.images.append(filename)
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def run_images(self, cache, image_files, prediction):
+        """Simulate a model run for the given images. The predicted response
+        for each image is taken from the given dictionary.
+        """
+        run = cache.prepare(
+            Resource('model'),
+            Resource('subject'),
+            None,
+            {'a' : 1},
+            image_files
+        )
+        columns = [prediction[f] for f in run.stimulus(image_files)]
+        result = run.merge(np.asarray(columns).T)
+        tar_filename = os.path.join(self.temp_dir, 'cortical.tar')
+        tar = tarfile.open(tar_filename, 'w')
+        for imno in range(len(image_files)):
+            for va in range(1, 4):
+                name = cortical_image_filename('PREDICTION', imno, va)
+                add_tar_member(tar, name, os.path.basename(image_files[imno]))
+        tar.close()
+        run.update(result, tar_filename)
+        return run, result
+
+    def test_incremental_run(self):
+        """Test that only new images are computed and that the merged result
+        is complete.
+        """
+        cache = IncrementalCache(DiskCache(os.path.join(self.temp_dir, 'cache')))
+        prediction = {}
+        for i in range(len(self.images)):
+            prediction[self.images[i]] = np.arange(4) + 10 * i
+        run, result = self.run_images(cache, self.images[:2], prediction)
+        self.assertEqual(run.new, [0, 1])
+        # Add a new image in front of the existing images
+        image_files = [self.images[2]] + self.images[:2]
+        run, result = self.run_images(cache, image_files, prediction)
+        self.assertEqual(run.new, [0])
+        for imno in range(len(image_files)):
+            self.assertTrue(np.all(result[:, imno] == prediction[image_files[imno]]))
+        images = run.cached_images()
+        self.assertEqual(len(images), 6)
+        self.assertEqual(images[cortical_image_filename('PREDICTION', 1, 2)], 'img0.png')
+        # The model is run for at least one image
+        run, result = self.run_images(cache, image_files, prediction)
+        self.assertEqual(run.new, [0])
+        self.assertEqual(sorted(run.entries.keys()), [1, 2])
+
+    def test_merge_prediction_file(self):
+        """Test replacing the content of an exported prediction file."""
+        filename = os.path.join(self.temp_dir, 'prediction.nii.gz')
+        nib.Nifti1Image(np.zeros((3, 3, 3, 1)), np.eye(4)).to_filename(filename)
+        cortex_indices = np.asarray([[0, 0, 0], [1, 2, 0], [2, 2, 2]])
+        prediction = np.asarray([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+        merge_prediction_file(filename, cortex_indices, prediction)
+        data = nib.load(filename).get_data()
+        self.assertEqual(data.shape, (3, 3, 3, 2))
+        self.assertEqual(list(data[1, 2, 0]), [3.0, 4.0])
+        self.assertEqual(data.sum(), prediction.sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Test execution of functions in disposable child processes with resource
+limits.
+"""
+
+import os
+import time
+import unittest
+
+from scoworker.isolation import RunLimitExceeded, RunLimits, run_isolated
+from scoworker.metrics import Metrics
+
+
+def allocate(size):
+    """Allocate the given number of bytes and keep them for a while."""
+    data = bytearray(size)
+    time.sleep(5)
+    return len(data)
+
+
+def fail():
+    raise ValueError('invalid run')
+
+
+class TestIsolation(unittest.TestCase):
+
+    def test_result(self):
+        """Test passing results and exceptions to the parent process."""
+        metrics = Metrics()
+        self.assertEqual(run_isolated(lambda: ('a', {'b' : 1}), metrics=metrics), ('a', {'b' : 1}))
+        self.assertTrue(metrics.get('peak_memory')['last'] > 0)
+        self.assertNotEqual(run_isolated(os.getpid), os.getpid())
+        with self.assertRaises(ValueError) as cm:
+            run_isolated(fail)
+        self.assertEqual(str(cm.exception), 'invalid run')
+        self.assertRaises(RuntimeError, run_isolated, lambda: os._exit(1))
+
+    def test_limits(self):
+        """Test that children that exceed their limits are killed."""
+        start = time.time()
+        with self.assertRaises(RunLimitExceeded) as cm:
+            run_isolated(
+                lambda: allocate(200 * 1024 * 1024),
+                limits=RunLimits(max_memory=100 * 1024 * 1024)
+            )
+        self.assertTrue(str(cm.exception).startswith('memory limit exceeded'))
+        with self.assertRaises(RunLimitExceeded) as cm:
+            run_isolated(lambda: time.sleep(10), limits=RunLimits(timeout=1))
+        self.assertTrue(str(cm.exception).startswith('time limit exceeded'))
+        self.assertTrue(time.time() - start < 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Test staged execution of jobs in a pipeline."""
+
+import threading
+import time
+import unittest
+
+from scoworker.metrics import Metrics
+from scoworker.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_overlap(self):
+        """Test that stages of consecutive jobs are executed concurrently."""
+        lock = threading.Lock()
+        active = set()
+        overlaps = []
+        done = []
+        def stage(name):
+            def run_stage(job):
+                with lock:
+                    active.add(name)
+                    if len(active) > 1:
+                        overlaps.append(sorted(active))
+                time.sleep(0.05)
+                with lock:
+                    active.remove(name)
+                return job
+            return run_stage
+        def finish(job):
+            done.append(job)
+            return job
+        metrics = Metrics()
+        pipeline = Pipeline(
+            [('fetch', stage('fetch')), ('compute', stage('compute')), ('upload', finish)],
+            depth=2,
+            metrics=metrics
+        )
+        start = time.time()
+        for i in range(6):
+            pipeline.submit(i)
+        pipeline.close()
+        self.assertEqual(done, range(6))
+        self.assertTrue(len(overlaps) > 0)
+        # Sequential execution would take at least 0.6 seconds
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(metrics.get('stage.fetch')['count'], 6)
+
+    def test_failure(self):
+        """Test that failed jobs are passed to the failure handler and removed
+        from the pipeline. The callback is called for every job.
+        """
+        failures = []
+        done = []
+        completed = []
+        def compute(job):
+            if job % 2 == 1:
+                raise ValueError('odd job ' + str(job))
+            return job
+        def fetch(job):
+            # Dropped by the stage itself
+            return job if job != 4 else None
+        pipeline = Pipeline(
+            [('fetch', fetch), ('compute', compute), ('upload', done.append)],
+            on_failure=lambda stage, job, ex: failures.append((stage, job, str(ex)))
+        )
+        for i in range(6):
+            pipeline.submit(i, callback=lambda i=i: completed.append(i))
+        pipeline.close()
+        self.assertEqual(done, [0, 2])
+        self.assertEqual(sorted(completed), range(6))
+        self.assertEqual(
+            failures,
+            [
+                ('compute', 1, 'odd job 1'),
+                ('compute', 3, 'odd job 3'),
+                ('compute', 5, 'odd job 5')
+            ]
+        )
+        self.assertRaises(ValueError, Pipeline, [], 1)
+        self.assertRaises(ValueError, Pipeline, [('a', done.append)], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+"""Test the disk cache and the caches for subject-level intermediate values
+and preprocessed stimulus images. Uses a small pimms plan in place of an SCO model.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pimms
+
+from scoworker.cache import DiskCache
+from scoworker.plans import CommonValues, SharedValues, StimulusCache, SubjectCache, dependent_nodes, node_signatures
+
+
+# List of names of nodes that were evaluated by the test plan
+CALLS = []
+
+
+@pimms.calc('cortex_indices', 'labels')
+def calc_anatomy(subject, max_eccentricity=10):
+    CALLS.append('anatomy')
+    return np.arange(5) + len(subject), np.ones(5) * max_eccentricity
+
+
+@pimms.calc('pRFs')
+def calc_pRFs(labels, normalized_pixels_per_degree):
+    CALLS.append('pRFs')
+    return labels * normalized_pixels_per_degree
+
+
+@pimms.calc('image_array')
+def calc_images(stimulus, pixels_per_degree=6):
+    CALLS.append('images')
+    return np.asarray([len(open(s).read()) * pixels_per_degree for s in stimulus])
+
+
+@pimms.calc('prediction')
+def calc_prediction(pRFs, image_array, cortex_indices):
+    CALLS.append('prediction')
+    return np.outer(pRFs + cortex_indices, image_array)
+
+
+@pimms.calc('prediction')
+def calc_linear_prediction(pRFs, image_array):
+    CALLS.append('linear_prediction')
+    return np.outer(pRFs, image_array)
+
+
+PLAN = pimms.plan(
+    anatomy=calc_anatomy,
+    pRFs=calc_pRFs,
+    images=calc_images,
+    prediction=calc_prediction
+)
+
+# Second model that has all nodes except the prediction in common with PLAN
+LINEAR_PLAN = pimms.plan(
+    anatomy=calc_anatomy,
+    pRFs=calc_pRFs,
+    images=calc_images,
+    prediction=calc_linear_prediction
+)
+
+
+
+class Model(object):
+    """Minimal stand-in for model definitions."""
+    def __init__(self, identifier, timestamp):
+        self.identifier = identifier
+        self.timestamp = timestamp
+        self.properties = {}
+
+
+MODEL = Model('model', '2017-01-01T00:00:00')
+
+
+class TestPlanCache(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory for subject and cache."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.subject_dir = os.path.join(self.temp_dir, 'subject')
+        os.mkdir(self.subject_dir)
+        with open(os.path.join(self.subject_dir, 'mri'), 'w') as f:
+            f.write('subject')
+        self.images = []
+        for name in ['a', 'b']:
+            filename = os.path.join(self.temp_dir, name + '.png')
+            with open(filename, 'w') as f:
+                f.write(name * 3)
+            self.images.append(filename)
+        del CALLS[:]
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_common_values(self):
+        """Test sharing of values between runs of different models."""
+        common = CommonValues()
+        args = {
+            'subject' : self.subject_dir,
+            'stimulus' : self.images,
+            'normalized_pixels_per_degree' : 2
+        }
+        signatures = node_signatures(PLAN, args)
+        data = common.prepare(PLAN, signatures)(args)
+        data['prediction']
+        common.update(signatures, data)
+        self.assertEqual(len(common.values), 4)
+        # Only the prediction of the second model is computed
+        del CALLS[:]
+        signatures = node_signatures(LINEAR_PLAN, args)
+        prediction = common.prepare(LINEAR_PLAN, signatures)(args)['prediction']
+        self.assertEqual(CALLS, ['linear_prediction'])
+        self.assertTrue(np.array_equal(prediction, LINEAR_PLAN(args)['prediction']))
+        # Nodes that depend on a different parameter value are not shared
+        del CALLS[:]
+        args['pixels_per_degree'] = 4
+        signatures = node_signatures(LINEAR_PLAN, args)
+        common.prepare(LINEAR_PLAN, signatures)(args)['prediction']
+        self.assertEqual(sorted(CALLS), ['images', 'linear_prediction'])
+
+    def test_disk_cache_eviction(self):
+        """Test that least recently used entries are evicted."""
+        cache = DiskCache(os.path.join(self.temp_dir, 'cache'), max_size=250)
+        def write_entry(directory):
+            with open(os.path.join(directory, 'data'), 'w') as f:
+                f.write('x' * 100)
+        cache.put('a', write_entry)
+        cache.put('b', write_entry)
+        # Access a to make b the least recently used entry. Lookups do not
+        # rewrite the index.
+        index_file = os.path.join(cache.directory, 'index.json')
+        inode = os.stat(index_file).st_ino
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(os.stat(index_file).st_ino, inode)
+        cache.put('c', write_entry)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size(), 200)
+
+    def test_subject_cache(self):
+        """Test reuse of subject-level values in subsequent runs."""
+        self.assertEqual(
+            dependent_nodes(PLAN, ['subject'], excluded=['stimulus']),
+            ['anatomy', 'pRFs']
+        )
+        cache = SubjectCache(DiskCache(os.path.join(self.temp_dir, 'cache')))
+        args = {
+            'subject' : self.subject_dir,
+            'stimulus' : self.images,
+            'normalized_pixels_per_degree' : 2
+        }
+        # First run computes all values
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.subject_dir, args)
+        data = plan(args)
+        prediction = data['prediction']
+        cache.update(entry, data)
+        self.assertIsNotNone(entry)
+        self.assertEqual(sorted(CALLS), ['anatomy', 'images', 'pRFs', 'prediction'])
+        # Second run uses cached subject-level values
+        del CALLS[:]
+        args['stimulus'] = list(self.images)
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.subject_dir, args)
+        self.assertIsNone(entry)
+        data = plan(args)
+        self.assertTrue(np.array_equal(data['prediction'], prediction))
+        self.assertEqual(sorted(CALLS), ['images', 'prediction'])
+        # Cached arrays can be modified without changing the cache entry
+        data['cortex_indices'][:] = 0
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.subject_dir, args)
+        self.assertTrue(np.array_equal(plan(args)['prediction'], prediction))
+        # A new version of the model does not use the cached values
+        new_model = Model('model', '2018-01-01T00:00:00')
+        plan, entry = cache.prepare_run(PLAN, new_model, self.subject_dir, args)
+        self.assertIsNotNone(entry)
+        # Different option values or subject content invalidate the entry
+        args['normalized_pixels_per_degree'] = 3
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.subject_dir, args)
+        self.assertIsNotNone(entry)
+        args['normalized_pixels_per_degree'] = 2
+        with open(os.path.join(self.subject_dir, 'mri'), 'w') as f:
+            f.write('modified subject')
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.subject_dir, args)
+        self.assertIsNotNone(entry)
+
+    def test_stimulus_cache(self):
+        """Test reuse of preprocessed stimulus images in subsequent runs."""
+        cache = StimulusCache(DiskCache(os.path.join(self.temp_dir, 'cache')))
+        args = {
+            'subject' : self.subject_dir,
+            'stimulus' : self.images,
+            'normalized_pixels_per_degree' : 2
+        }
+        plan, entry = cache.prepare_run(PLAN, MODEL, self.images, args)
+        self.assertEqual(entry.nodes, ['images'])
+        data = plan(args)
+        prediction = data['prediction']
+        cache.update(entry, data)
+        self.assertTrue(
+            os.path.isfile(os.path.join(cache.cache.entry_path(entry.key), 'image_array.npy'))
+        )
+        # Copies of the images at a different location use the cached values
+        del CALLS[:]
+        copies = []
+        for filename in self.images:
+            copy = filename + '.copy'
+            shutil.copyfile(filename, copy)
+            copies.append(copy)
+        args['stimulus'] = copies
+        plan, entry = cache.prepare_run(PLAN, MODEL, copies, args)
+        self.assertIsNone(entry)
+        self.assertTrue(np.array_equal(plan(args)['prediction'], prediction))
+        self.assertEqual(sorted(CALLS), ['anatomy', 'pRFs', 'prediction'])
+        # Image options and image content are part of the key
+        args['pixels_per_degree'] = 8
+        plan, entry = cache.prepare_run(PLAN, MODEL, copies, args)
+        self.assertIsNotNone(entry)
+        del args['pixels_per_degree']
+        with open(copies[0], 'w') as f:
+            f.write('modified image')
+        plan, entry = cache.prepare_run(PLAN, MODEL, copies, args)
+        self.assertIsNotNone(entry)
+
+    def test_shared_values(self):
+        """Test sharing of values between runs that differ in a model
+        parameter.
+        """
+        shared = SharedValues(['normalized_pixels_per_degree'])
+        args = {
+            'subject' : self.subject_dir,
+            'stimulus' : self.images,
+            'normalized_pixels_per_degree' : 2
+        }
+        data = shared.prepare(PLAN)(args)
+        data['prediction']
+        shared.update(data)
+        self.assertEqual(sorted(shared.values.keys()), ['cortex_indices', 'image_array', 'labels'])
+        # Only nodes that depend on the varying parameter are computed again
+        del CALLS[:]
+        args['normalized_pixels_per_degree'] = 3
+        prediction = shared.prepare(PLAN)(args)['prediction']
+        self.assertEqual(sorted(CALLS), ['pRFs', 'prediction'])
+        self.assertTrue(np.array_equal(prediction, PLAN(args)['prediction']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""Test the index of downloaded resources in the data directory of a remote
+worker.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scoworker.resources as resources
+from scoworker.resources import ResourceCache
+
+
+class TestResourceCache(unittest.TestCase):
+
+    def setUp(self):
+        """Create data directory with three resource folders of 100 bytes
+        each.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        for name in ['subject', 'images', 'fmri']:
+            self.create_folder(name)
+        self.directory_size = resources.directory_size
+
+    def tearDown(self):
+        """Delete data directory and restore module globals."""
+        resources.directory_size = self.directory_size
+        shutil.rmtree(self.temp_dir)
+
+    def create_folder(self, name):
+        """Create a resource folder in the data directory."""
+        os.mkdir(os.path.join(self.temp_dir, name))
+        with open(os.path.join(self.temp_dir, name, 'data'), 'w') as f:
+            f.write('x' * 100)
+
+    def resource(self, name):
+        """Resource identifier and path to the file of a resource."""
+        return name + '-id', os.path.join(self.temp_dir, name, 'data')
+
+    def test_disappearing_folder(self):
+        """Test that acquire() returns None if a resource folder is removed
+        while the sizes of new resources are computed.
+        """
+        cache = ResourceCache(self.temp_dir)
+        def remove_folder(path):
+            shutil.rmtree(os.path.join(self.temp_dir, 'images'), ignore_errors=True)
+            return self.directory_size(path)
+        resources.directory_size = remove_folder
+        self.assertIsNone(
+            cache.acquire([self.resource('subject'), self.resource('images')])
+        )
+        resources.directory_size = self.directory_size
+        with cache.lock():
+            self.assertFalse('images' in cache.read_index())
+        # The resource is fetched again
+        self.create_folder('images')
+        keys = cache.acquire([self.resource('subject'), self.resource('images')])
+        self.assertEqual(keys, ['images', 'subject'])
+
+    def test_pinned_resources(self):
+        """Test that pinned resources are never evicted and that hits,
+        misses, and evictions are counted.
+        """
+        cache = ResourceCache(self.temp_dir, max_size=250)
+        keys = cache.acquire([self.resource('subject'), self.resource('images')])
+        self.assertEqual(keys, ['images', 'subject'])
+        # The quota is exceeded but all resources are pinned
+        pinned = cache.acquire([self.resource('fmri'), self.resource('subject')])
+        self.assertEqual(pinned, ['fmri', 'subject'])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 0))
+        for name in ['subject', 'images', 'fmri']:
+            self.assertTrue(os.path.isdir(os.path.join(self.temp_dir, name)))
+        # Once released, resources can be evicted. Resources of the new run
+        # are pinned, i.e., the image group is evicted.
+        cache.release(keys)
+        cache.release(pinned)
+        cache.acquire([self.resource('fmri'), self.resource('subject')])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 3, 1))
+        self.assertFalse(os.path.isdir(os.path.join(self.temp_dir, 'images')))
+        self.assertEqual(cache.size(), 200)
+        # Files in the data directory itself are not indexed
+        with open(os.path.join(self.temp_dir, 'index'), 'w') as f:
+            f.write('index')
+        self.assertEqual(
+            cache.acquire([('index', os.path.join(self.temp_dir, 'index'))]),
+            []
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
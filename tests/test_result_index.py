@@ -0,0 +1,79 @@
+"""Test the local index of model run results."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scoworker.cache import DiskCache
+from scoworker.results import ResultIndex, run_fingerprint
+
+
+class Resource(object):
+    """Minimal stand-in for resource handles and model definitions."""
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+class TestResultIndex(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory."""
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_fingerprint(self):
+        """Test that fingerprints only depend on the run inputs."""
+        model = Resource('model')
+        subject = Resource('subject')
+        images = Resource('images')
+        fp = run_fingerprint(model, subject, images, None, {'a' : {1 : 2}, 'b' : 1})
+        self.assertEqual(
+            fp,
+            run_fingerprint(model, subject, images, None, {'b' : 1, 'a' : {1 : 2}})
+        )
+        self.assertNotEqual(
+            fp,
+            run_fingerprint(model, subject, images, Resource('fmri'), {'a' : {1 : 2}, 'b' : 1})
+        )
+        self.assertNotEqual(
+            fp,
+            run_fingerprint(model, subject, images, None, {'a' : {1 : 3}, 'b' : 1})
+        )
+
+    def test_get_and_put(self):
+        """Test serving results from the index."""
+        index = ResultIndex(DiskCache(os.path.join(self.temp_dir, 'cache')))
+        run_dir = os.path.join(self.temp_dir, 'run')
+        os.mkdir(run_dir)
+        files = {}
+        for name in ['prediction.tar.gz', 'images.txt', 'cortical.tar']:
+            files[name] = os.path.join(run_dir, name)
+            with open(files[name], 'w') as f:
+                f.write(name)
+        attachments = {
+            'images.txt' : (files['images.txt'], 'text/plain'),
+            'cortical.tar' : (files['cortical.tar'], 'application/tar')
+        }
+        output_dir = os.path.join(self.temp_dir, 'output')
+        self.assertIsNone(index.get('run', output_dir))
+        index.put('run', files['prediction.tar.gz'], attachments)
+        shutil.rmtree(run_dir)
+        prediction_file, result = index.get('run', output_dir)
+        self.assertEqual(os.path.basename(prediction_file), 'prediction.tar.gz')
+        self.assertEqual(sorted(result.keys()), ['cortical.tar', 'images.txt'])
+        for resource_id in result:
+            filename, mime_type = result[resource_id]
+            self.assertTrue(filename.startswith(output_dir))
+            self.assertEqual(os.path.basename(filename), resource_id)
+            self.assertEqual(mime_type, attachments[resource_id][1])
+            with open(filename, 'r') as f:
+                self.assertEqual(f.read(), resource_id)
+        self.assertEqual(index.hit_rate(), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+"""Test subject-affinity routing with an in-process stand-in for the RabbitMQ
+server (consistent-hash exchange, queues and channels).
+"""
+
+import hashlib
+import json
+import unittest
+
+import scoworker.consumer as consumer
+from scoworker.consumer import RequestConsumer
+from scoworker.routing import AffinityRouting, publish_request
+
+
+class Request(object):
+    """Minimal stand-in for scoengine.ModelRunRequest."""
+    def __init__(self, experiment_id, run_id):
+        self.experiment_id = experiment_id
+        self.run_id = run_id
+
+    @staticmethod
+    def from_dict(obj):
+        return Request(obj['experiment_id'], obj['run_id'])
+
+
+class Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class Broker(object):
+    """Message queues, consistent-hash exchanges and consumers."""
+    def __init__(self):
+        self.queues = dict()
+        self.exchanges = dict()
+        self.consumers = []
+        self.delivery_tag = 0
+
+    def deliver(self):
+        """Deliver all messages to the consumers of their queues (in order of
+        consumer registration).
+        """
+        for queue in self.queues:
+            messages = self.queues[queue]
+            while len(messages) > 0:
+                consumers = [c for c in self.consumers if c[1] == queue]
+                if len(consumers) == 0:
+                    break
+                channel, queue, callback = consumers[0]
+                # Move consumer to the end of the list (round-robin)
+                self.consumers.remove(consumers[0])
+                self.consumers.append(consumers[0])
+                self.delivery_tag += 1
+                callback(channel, Method(self.delivery_tag), None, messages.pop(0))
+
+    def publish(self, exchange, routing_key, body):
+        if exchange == '':
+            self.queues[routing_key].append(body)
+            return
+        bindings = []
+        for queue, weight in self.exchanges[exchange]:
+            bindings.extend([queue] * weight)
+        h = int(hashlib.md5(routing_key).hexdigest(), 16)
+        self.queues[bindings[h % len(bindings)]].append(body)
+
+
+class Channel(object):
+    """Channel on the stand-in broker."""
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.acks = []
+
+    def basic_ack(self, delivery_tag=0):
+        self.acks.append(delivery_tag)
+
+    def basic_cancel(self, consumer_tag=''):
+        self.broker.consumers.remove(consumer_tag)
+
+    def basic_consume(self, callback, queue=''):
+        consumer_tag = (self, queue, callback)
+        self.broker.consumers.append(consumer_tag)
+        return consumer_tag
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body)
+
+    def exchange_declare(self, callback, exchange=None, exchange_type='direct', durable=False):
+        self.broker.exchanges.setdefault(exchange, [])
+        callback(None)
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None):
+        self.broker.exchanges[exchange].append((queue, int(routing_key)))
+        callback(None)
+
+    def queue_declare(self, callback, queue='', durable=False, arguments=None):
+        self.broker.queues.setdefault(queue, [])
+        callback(None)
+
+
+class Dispatcher(object):
+    """Records submitted requests."""
+    def __init__(self):
+        self.requests = []
+
+    def put(self, request, callback):
+        self.requests.append(request.run_id)
+
+
+def message(run_id):
+    return json.dumps({'experiment_id' : 'experiment', 'run_id' : run_id})
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        """Start two consumers on different hosts."""
+        self.request_class = consumer.ModelRunRequest
+        consumer.ModelRunRequest = Request
+        self.broker = Broker()
+        self.broker.queues['sco'] = []
+        self.consumers = []
+        for host in ['host-a', 'host-b']:
+            requests = RequestConsumer(
+                None,
+                'sco',
+                Dispatcher(),
+                affinity=AffinityRouting('sco', host)
+            )
+            requests.channel = Channel(self.broker)
+            requests.on_queue_declared(None)
+            self.consumers.append(requests)
+
+    def tearDown(self):
+        consumer.ModelRunRequest = self.request_class
+
+    def test_affinity(self):
+        """Test that requests for the same subject are executed on the same
+        host.
+        """
+        channel = Channel(self.broker)
+        subjects = ['subject-%d' % (i) for i in range(8)]
+        for i in range(4):
+            for subject in subjects:
+                publish_request(channel, message(subject + ':' + str(i)), subject)
+        for requests in self.consumers:
+            # Keep both consumers busy to exclude the shared queue
+            requests.in_flight['busy'] = (None, None)
+            requests.update_shared_consumer()
+        self.broker.deliver()
+        hosts = dict()
+        for i in range(len(self.consumers)):
+            for run_id in self.consumers[i].dispatcher.requests:
+                hosts.setdefault(run_id.split(':')[0], set()).add(i)
+        self.assertEqual(sorted(hosts.keys()), subjects)
+        for subject in subjects:
+            self.assertEqual(len(hosts[subject]), 1)
+        # Both hosts get a share of the subjects
+        self.assertEqual(len(set([list(h)[0] for h in hosts.values()])), 2)
+
+    def test_shared_queue(self):
+        """Test that requests in the shared queue are only consumed by idle
+        workers.
+        """
+        a, b = self.consumers
+        self.broker.queues['sco'].append(message('0'))
+        self.broker.deliver()
+        # Worker a is busy now and stops consuming from the shared queue
+        self.assertEqual(a.dispatcher.requests, ['0'])
+        self.assertIsNone(a.shared_consumer)
+        self.assertIsNotNone(b.shared_consumer)
+        self.broker.queues['sco'].extend([message('1'), message('2')])
+        self.broker.deliver()
+        self.assertEqual(a.dispatcher.requests, ['0'])
+        self.assertEqual(b.dispatcher.requests, ['1'])
+        # Both workers are busy. Request 2 waits until a is done.
+        self.assertEqual(self.broker.queues['sco'], [message('2')])
+        a.acknowledge('experiment:0')
+        self.assertEqual(a.channel.acks, [1])
+        self.broker.deliver()
+        self.assertEqual(a.dispatcher.requests, ['0', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Test the scratch space for output directories of model runs."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scoworker.scratch import ScratchSpace, ScratchQuotaExceeded, RUN_PREFIX
+
+
+class TestScratchSpace(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory for scratch roots."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.disk_dir = os.path.join(self.temp_dir, 'disk')
+        self.tmpfs_dir = os.path.join(self.temp_dir, 'tmpfs')
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def test_allocate(self):
+        """Test placement of run directories and quotas."""
+        scratch = ScratchSpace(
+            self.disk_dir,
+            tmpfs_dir=self.tmpfs_dir,
+            tmpfs_max_size=100,
+            run_quota=1000,
+            quota=2000
+        )
+        small = scratch.allocate(estimated_size=10)
+        self.assertEqual(os.path.dirname(small), self.tmpfs_dir)
+        large = scratch.allocate(estimated_size=500)
+        self.assertEqual(os.path.dirname(large), self.disk_dir)
+        # Estimates are limited by the per-run quota
+        scratch.allocate(estimated_size=5000)
+        with self.assertRaises(ScratchQuotaExceeded):
+            scratch.allocate(estimated_size=500)
+        # Per-run quota
+        with open(os.path.join(large, 'output.bin'), 'wb') as f:
+            f.write('0' * 2000)
+        with self.assertRaises(ScratchQuotaExceeded):
+            scratch.check(large)
+        self.assertTrue(scratch.release(large) >= 2000)
+        self.assertFalse(os.path.isdir(large))
+        scratch.allocate(estimated_size=400)
+
+    def test_sweep(self):
+        """Test removing run directories of processes that no longer exist."""
+        os.makedirs(self.disk_dir)
+        # Process identifiers are limited to 2^22 on Linux
+        orphan = os.path.join(self.disk_dir, RUN_PREFIX + '99999999-abc')
+        os.makedirs(orphan)
+        scratch = ScratchSpace(self.disk_dir)
+        self.assertFalse(os.path.isdir(orphan))
+        path = scratch.allocate()
+        ScratchSpace(self.disk_dir)
+        self.assertTrue(os.path.isdir(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
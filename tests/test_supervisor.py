@@ -0,0 +1,153 @@
+"""Test the supervisor for a pool of worker processes. Uses a minimal worker
+in place of an SCO worker.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from scoworker.supervisor import Supervisor
+
+
+class Request(object):
+    """Minimal stand-in for scoengine.ModelRunRequest."""
+    def __init__(self, run_id, duration=0.2, crash=False, size=None):
+        self.experiment_id = 'experiment'
+        self.run_id = run_id
+        self.duration = duration
+        self.crash = crash
+        self.size = size
+
+
+class Worker(object):
+    """Worker that records start and end of each run in a directory."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.aborted = []
+
+    def abort(self, request, errors):
+        self.aborted.append((request.run_id, errors))
+
+    def run(self, request):
+        filename = os.path.join(self.directory, request.run_id)
+        with open(filename, 'w') as f:
+            f.write(str(time.time()))
+        if request.crash:
+            os._exit(1)
+        time.sleep(request.duration)
+        with open(filename, 'a') as f:
+            f.write(' ' + str(time.time()) + ' ' + str(os.getpid()))
+
+    def run_size(self, request):
+        return request.size
+
+
+class ForkingWorker(Worker):
+    """Worker that executes each run in a child process of its own (like the
+    render pool or isolated model runs).
+    """
+    def run(self, request):
+        process = multiprocessing.Process(
+            target=Worker.run,
+            args=(self, request)
+        )
+        process.start()
+        process.join()
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory."""
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def intervals(self):
+        """Start and end times of all runs."""
+        result = {}
+        for name in os.listdir(self.temp_dir):
+            with open(os.path.join(self.temp_dir, name), 'r') as f:
+                result[name] = [float(t) for t in f.read().split()]
+        return result
+
+    def test_admission(self):
+        """Test that runs are only started if they fit into the memory
+        budget.
+        """
+        worker = Worker(self.temp_dir)
+        supervisor = Supervisor(lambda: worker, 3, memory_budget=int(3.5 * 1024 ** 3))
+        supervisor.start()
+        # Each run needs more than 1GB. Only two runs fit into the budget.
+        for i in range(4):
+            supervisor.submit(Request(str(i), size=(10, 0)))
+        supervisor.stop()
+        intervals = self.intervals()
+        self.assertEqual(sorted(intervals.keys()), ['0', '1', '2', '3'])
+        for t in sorted([intervals[r][0] for r in intervals]):
+            active = [r for r in intervals if intervals[r][0] <= t < intervals[r][1]]
+            self.assertTrue(len(active) <= 2)
+
+    def test_crash(self):
+        """Test that crashed children are replaced and their runs are set to
+        failed. Callbacks are called for successful and failed runs.
+        """
+        worker = Worker(self.temp_dir)
+        supervisor = Supervisor(lambda: worker, 2)
+        supervisor.start()
+        completed = []
+        supervisor.submit(Request('crash', crash=True), callback=lambda: completed.append('crash'))
+        for run_id in ['0', '1', '2']:
+            supervisor.submit(Request(run_id), callback=lambda r=run_id: completed.append(r))
+        supervisor.stop()
+        self.assertEqual(sorted(completed), ['0', '1', '2', 'crash'])
+        self.assertEqual(supervisor.restarts, 1)
+        self.assertEqual(len(worker.aborted), 1)
+        self.assertEqual(worker.aborted[0][0], 'crash')
+        self.assertEqual(sorted(self.intervals().keys()), ['0', '1', '2', 'crash'])
+
+    def test_forking_worker(self):
+        """Test that workers in child processes can start processes of their
+        own.
+        """
+        worker = ForkingWorker(self.temp_dir)
+        supervisor = Supervisor(lambda: worker, 2)
+        supervisor.start()
+        for i in range(3):
+            supervisor.submit(Request(str(i), duration=0.05))
+        supervisor.stop()
+        intervals = self.intervals()
+        self.assertEqual(sorted(intervals.keys()), ['0', '1', '2'])
+        for run_id in intervals:
+            self.assertEqual(len(intervals[run_id]), 3)
+        self.assertEqual(supervisor.restarts, 0)
+
+    def test_fresh_child_per_run(self):
+        """Test that every run is executed in a new child if the maximum number
+        of runs per child is one.
+        """
+        worker = Worker(self.temp_dir)
+        preloaded = []
+        supervisor = Supervisor(
+            lambda: worker,
+            2,
+            preload=lambda: preloaded.append(os.getpid()),
+            max_runs=1
+        )
+        supervisor.start()
+        for i in range(4):
+            supervisor.submit(Request(str(i), duration=0.05))
+        supervisor.stop()
+        self.assertEqual(preloaded, [os.getpid()])
+        pids = set([int(t[2]) for t in self.intervals().values()])
+        self.assertEqual(len(pids), 4)
+        self.assertEqual(supervisor.restarts, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
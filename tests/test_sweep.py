@@ -0,0 +1,198 @@
+"""Test parameter sweeps that share the values of plan nodes that do not
+depend on the overridden arguments. Uses a small pimms plan in place of an
+SCO model and skips rendering of cortical images.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+import pimms
+
+import scoworker.workflow as workflow
+from scoworker import RunJob, SCOWorker
+from scoworker.registry import ModelRegistry
+
+
+# List of names of nodes that were evaluated by the test plan
+CALLS = []
+
+
+@pimms.calc('image_array')
+def calc_images(subject, stimulus):
+    CALLS.append('images')
+    return np.arange(len(stimulus)) + len(subject)
+
+
+@pimms.calc('prediction', 'cortex_indices', 'measurement_indices', 'labels', 'pRFs', 'max_eccentricity', 'exported_files')
+def calc_prediction(image_array, output_directory, measurements_filename=None, scale=1.0):
+    CALLS.append('prediction')
+    if scale < 0:
+        raise ValueError('invalid scale: ' + str(scale))
+    with open(os.path.join(output_directory, 'prediction.nii.gz'), 'w') as f:
+        f.write(str(scale))
+    indices = [(1, 1, 1), (2, 2, 2)]
+    return (
+        np.outer([1.0, 2.0], image_array) * scale,
+        indices,
+        indices,
+        np.asarray([1, 2]),
+        None,
+        10,
+        ['prediction.nii.gz']
+    )
+
+
+PLAN = pimms.plan(images=calc_images, prediction=calc_prediction)
+
+
+def create_tar(data, image_group, func_filename, output_dir, processes=1, prediction=None, cached_images=None):
+    """Replacement for cortical.create_cortical_image_tar() that writes an
+    empty tar file.
+    """
+    tarfile.open(os.path.join(output_dir, 'cortical-images.tar'), 'w').close()
+    return 'cortical-images.tar'
+
+
+class Resource(object):
+    """Minimal stand-in for resource handles and model definitions."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Request(object):
+    """Minimal stand-in for scoengine.ModelRunRequest."""
+    def __init__(self, run_id, scale, subject='subject'):
+        self.experiment_id = 'experiment'
+        self.run_id = run_id
+        self.resource_url = None
+        self.scale = scale
+        self.subject = subject
+
+
+class Worker(SCOWorker):
+    """Worker that records uploaded and failed runs."""
+    def __init__(self, env_subject, temp_dir):
+        super(Worker, self).__init__(env_subject)
+        self.temp_dir = temp_dir
+        self.results = {}
+        self.groups = []
+
+    def abort(self, request, errors):
+        self.results[request.run_id] = errors
+
+    def fail(self, job, ex):
+        self.results[job.request.run_id] = ex
+        self.cleanup(job)
+
+    def fetch(self, request):
+        return RunJob(
+            model_run(request.run_id, request.scale),
+            Resource(identifier='model', outputs=Resource(prediction_file=Resource(filename='prediction.nii.gz'))),
+            Resource(identifier=request.subject, data_directory=request.subject),
+            image_group(),
+            None,
+            tempfile.mkdtemp(dir=self.temp_dir)
+        )
+
+    def run_group(self, jobs):
+        self.groups.append([job.request.run_id for job in jobs])
+        super(Worker, self).run_group(jobs)
+
+    def upload(self, job):
+        with open(job.prediction_file, 'r') as f:
+            self.results[job.request.run_id] = float(f.read())
+        self.cleanup(job)
+
+
+def image_group():
+    """Image group with two images."""
+    images = [
+        Resource(filename=name, folder='/', name=name)
+            for name in ['a.png', 'b.png']
+    ]
+    return Resource(identifier='images', images=images, options={})
+
+
+def model_run(run_id, scale):
+    """Model run handle with a single argument."""
+    return Resource(
+        identifier=run_id,
+        experiment_id='experiment',
+        arguments={'scale' : Resource(value=scale)}
+    )
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory and replace model registry and
+        cortical image rendering.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.registry = workflow.DEFAULT_REGISTRY
+        self.create_tar = workflow.create_cortical_image_tar
+        workflow.DEFAULT_REGISTRY = ModelRegistry(lambda model_id: PLAN)
+        workflow.create_cortical_image_tar = create_tar
+        del CALLS[:]
+
+    def tearDown(self):
+        """Delete temporary directory and restore module globals."""
+        workflow.DEFAULT_REGISTRY = self.registry
+        workflow.create_cortical_image_tar = self.create_tar
+        shutil.rmtree(self.temp_dir)
+
+    def test_run_sweep(self):
+        """Test that runs of a sweep are uploaded or failed individually and
+        that runs with different inputs are executed as a group.
+        """
+        worker = Worker(self.temp_dir, self.temp_dir)
+        worker.run_sweep([
+            Request('base', 1.0),
+            Request('double', 2.0),
+            Request('invalid', -1.0),
+            Request('other', 3.0, subject='other')
+        ])
+        self.assertEqual(worker.results['base'], 1.0)
+        self.assertEqual(worker.results['double'], 2.0)
+        self.assertTrue(isinstance(worker.results['invalid'], ValueError))
+        self.assertEqual(worker.results['other'], 3.0)
+        self.assertEqual(worker.groups, [['other']])
+        # Images are computed once for the sweep and once for the group
+        self.assertEqual(CALLS.count('images'), 2)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_sco_sweep(self):
+        """Test that the shared upstream node is computed only once and that
+        each parameter set gets its own result or exception.
+        """
+        overrides = [{}, {'scale' : 2.0}, {'scale' : -1.0}, {'scale' : 3.0}]
+        output_dirs = []
+        for i in range(len(overrides)):
+            output_dirs.append(os.path.join(self.temp_dir, str(i)))
+            os.mkdir(output_dirs[-1])
+        results = workflow.sco_sweep(
+            model_run('base', 1.0),
+            Resource(identifier='model', outputs=Resource(prediction_file=Resource(filename='prediction.nii.gz'))),
+            Resource(identifier='subject', data_directory='subject'),
+            image_group(),
+            overrides,
+            output_dirs,
+            background_export=False
+        )
+        self.assertEqual(CALLS.count('images'), 1)
+        self.assertEqual(CALLS.count('prediction'), 4)
+        self.assertTrue(isinstance(results[2], ValueError))
+        for i, scale in [(0, 1.0), (1, 2.0), (3, 3.0)]:
+            prediction_file, attachments = results[i]
+            self.assertEqual(os.path.dirname(prediction_file), output_dirs[i])
+            with open(prediction_file, 'r') as f:
+                self.assertEqual(float(f.read()), scale)
+            self.assertEqual(sorted(attachments.keys()), ['cortical-images.tar', 'images.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Test background uploads with retry."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from scoworker import RunJob, SCOClientWorker
+from scoworker.uploads import Uploader
+
+
+class FlakyUpload(object):
+    """Upload function that fails with a connection error for the first
+    attempts.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError('connection reset')
+        return self.attempts
+
+
+class ModelRun(object):
+    """Model run handle that only accepts attachments for runs in state
+    SUCCESS and rejects repeated transitions to SUCCESS (as the SCO data
+    store does).
+    """
+    def __init__(self, failing=None, dropped=False):
+        self.state = State(False)
+        self.calls = []
+        self.failing = failing
+        self.dropped = dropped
+
+    def attach_file(self, filename, resource_id=None):
+        if not self.state.is_success:
+            raise ValueError('cannot attach file to model run in state: RUNNING')
+        if resource_id == self.failing:
+            raise IOError('connection reset')
+        self.calls.append(resource_id)
+
+    def update_state_success(self, filename):
+        if self.state.is_success:
+            raise ValueError('invalid state change: SUCCESS -> SUCCESS')
+        self.state = State(True)
+        self.calls.append('SUCCESS')
+        if self.dropped:
+            # Connection drops after the server changed the state
+            self.dropped = False
+            raise IOError('connection reset')
+
+
+class SCOClient(object):
+    """SCO client that returns the same model run handle for every Url."""
+    def __init__(self, model_run):
+        self.model_run = model_run
+
+    def experiments_predictions_get(self, resource_url):
+        return self.model_run
+
+
+class State(object):
+    def __init__(self, is_success):
+        self.is_success = is_success
+
+
+class Request(object):
+    """Minimal stand-in for scoengine.ModelRunRequest."""
+    experiment_id = 'experiment'
+    run_id = 'run'
+    resource_url = 'http://localhost/experiments/experiment/predictions/run'
+
+
+class TestUploader(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory for worker environment."""
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete temporary directory."""
+        shutil.rmtree(self.temp_dir)
+
+    def run_upload(self, model_run):
+        """Upload the results of a model run with a background uploader."""
+        worker = SCOClientWorker(
+            SCOClient(model_run),
+            self.temp_dir,
+            uploader=Uploader(threads=2, retries=1, delay=0.01)
+        )
+        output_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        job = RunJob(model_run, None, None, None, None, output_dir)
+        job.request = Request()
+        job.prediction_file = os.path.join(output_dir, 'prediction.nii.gz')
+        job.attachments = {
+            'images.txt' : (os.path.join(output_dir, 'images.txt'), 'text/plain'),
+            'cortical-images.tar' : (os.path.join(output_dir, 'cortical-images.tar'), 'application/tar')
+        }
+        try:
+            worker.upload(job)
+        finally:
+            self.assertFalse(os.path.isdir(output_dir))
+
+    def test_client_worker_upload(self):
+        """Test that attachments are uploaded after the run state is set to
+        SUCCESS and that failed attachment uploads do not raise an error.
+        """
+        model_run = ModelRun()
+        self.run_upload(model_run)
+        self.assertEqual(model_run.calls[0], 'SUCCESS')
+        self.assertEqual(
+            sorted(model_run.calls[1:]),
+            ['cortical-images.tar', 'images.txt']
+        )
+        model_run = ModelRun(failing='images.txt')
+        self.run_upload(model_run)
+        self.assertEqual(model_run.calls, ['SUCCESS', 'cortical-images.tar'])
+
+    def test_dropped_state_change(self):
+        """Test that the state change to SUCCESS is not repeated if the
+        connection dropped after the server changed the state.
+        """
+        model_run = ModelRun(dropped=True)
+        self.run_upload(model_run)
+        self.assertEqual(model_run.calls[0], 'SUCCESS')
+        self.assertEqual(
+            sorted(model_run.calls[1:]),
+            ['cortical-images.tar', 'images.txt']
+        )
+
+    def test_concurrent_uploads(self):
+        """Test that uploads run concurrently up to the number of threads."""
+        uploader = Uploader(threads=2)
+        lock = threading.Lock()
+        active = [0, 0]
+        def upload():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.1)
+            with lock:
+                active[0] -= 1
+        tasks = [uploader.submit(upload, str(i)) for i in range(4)]
+        for task in tasks:
+            task.result()
+        self.assertEqual(active[1], 2)
+
+    def test_retry(self):
+        """Test retrying uploads that fail with a connection error."""
+        uploader = Uploader(retries=2, delay=0.01)
+        self.assertEqual(uploader.submit(FlakyUpload(2), 'file').result(), 3)
+        upload = FlakyUpload(3)
+        with self.assertRaises(IOError):
+            uploader.run(upload, 'file')
+        self.assertEqual(upload.attempts, 3)
+        # Errors that are reported by the server are not retried
+        def rejected():
+            raise ValueError('invalid attachment')
+        with self.assertRaises(ValueError):
+            uploader.submit(rejected, 'file').result()
+
+
+if __name__ == '__main__':
+    unittest.main()
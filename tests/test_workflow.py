@@ -0,0 +1,124 @@
+"""Test that the exported prediction file and the cortical images of a model
+run are generated from the same prediction matrix. Uses a small pimms plan in
+place of an SCO model and records the arguments of cortical image rendering.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import pimms
+
+import scoworker.workflow as workflow
+from scoworker.registry import ModelRegistry
+
+
+# Names of the threads that exported model outputs and the arguments of
+# cortical image rendering
+EXPORTS = []
+RENDERS = []
+
+
+@pimms.calc('prediction', 'cortex_indices', 'measurement_indices', 'labels', 'pRFs', 'max_eccentricity')
+def calc_prediction(subject, stimulus, scale=1.0):
+    indices = [(1, 1, 1), (2, 2, 2), (3, 3, 3)]
+    return (
+        np.outer([1.0, 2.0, 3.0], np.arange(len(stimulus)) + 1) * scale,
+        indices,
+        indices,
+        np.asarray([1, 2, 3]),
+        None,
+        10
+    )
+
+
+@pimms.calc('exported_files')
+def calc_export(prediction, output_directory):
+    EXPORTS.append(threading.current_thread().name)
+    np.save(os.path.join(output_directory, 'prediction.npy'), prediction)
+    return ['prediction.npy']
+
+
+PLAN = pimms.plan(prediction=calc_prediction, export=calc_export)
+
+
+def create_tar(data, image_group, func_filename, output_dir, processes=1, prediction=None, cached_images=None):
+    """Replacement for cortical.create_cortical_image_tar() that records the
+    prediction matrix and the number of active threads.
+    """
+    RENDERS.append((processes, prediction, threading.active_count()))
+    tarfile.open(os.path.join(output_dir, 'cortical-images.tar'), 'w').close()
+    return 'cortical-images.tar'
+
+
+class Resource(object):
+    """Minimal stand-in for resource handles and model definitions."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestWorkflow(unittest.TestCase):
+
+    def setUp(self):
+        """Create temporary directory and replace cortical image rendering."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.create_tar = workflow.create_cortical_image_tar
+        workflow.create_cortical_image_tar = create_tar
+        del EXPORTS[:]
+        del RENDERS[:]
+
+    def tearDown(self):
+        """Delete temporary directory and restore module globals."""
+        workflow.create_cortical_image_tar = self.create_tar
+        shutil.rmtree(self.temp_dir)
+
+    def run_model(self, render_processes):
+        """Run the test plan and return the exported prediction matrix."""
+        output_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        images = [
+            Resource(filename=name, folder='/', name=name)
+                for name in ['a.png', 'b.png']
+        ]
+        prediction_file, attachments = workflow.sco_run(
+            Resource(
+                identifier='run',
+                experiment_id='experiment',
+                arguments={'scale' : Resource(value=2.0)}
+            ),
+            Resource(identifier='model', outputs=Resource(prediction_file=Resource(filename='prediction.npy'))),
+            Resource(identifier='subject', data_directory='subject'),
+            Resource(identifier='images', images=images, options={}),
+            output_dir,
+            render_processes=render_processes,
+            registry=ModelRegistry(lambda model_id: PLAN)
+        )
+        return np.load(prediction_file)
+
+    def test_background_export(self):
+        """Test that the prediction file is exported in a background thread
+        while images are rendered in the same process.
+        """
+        prediction = self.run_model(1)
+        processes, rendered, threads = RENDERS[0]
+        self.assertTrue(np.array_equal(prediction, rendered))
+        self.assertEqual(prediction.shape, (3, 2))
+        self.assertNotEqual(EXPORTS[0], threading.current_thread().name)
+
+    def test_export_before_render_pool(self):
+        """Test that the prediction file is exported before a render pool is
+        created, i.e., no export thread is running while the pool is forked.
+        """
+        threads = threading.active_count()
+        prediction = self.run_model(2)
+        processes, rendered, render_threads = RENDERS[0]
+        self.assertTrue(np.array_equal(prediction, rendered))
+        self.assertEqual(EXPORTS[0], threading.current_thread().name)
+        self.assertEqual(render_threads, threads)
+
+
+if __name__ == '__main__':
+    unittest.main()